@@ -0,0 +1 @@
+"""Benchmarks of the job server, see the README"""
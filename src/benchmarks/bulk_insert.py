@@ -0,0 +1,104 @@
+"""Benchmark of adding a list of jobs to a project.
+
+Compares inserting the jobs one by one, with one existence check and one
+INSERT per job, with the bulk insert of SqlJobDatabase, and reports the
+time to add new jobs and to post the same jobs again as JSON.
+
+Without USERVICE_DATABASE_URI a temporary SQLite database is used.
+
+Example, from the src directory:
+
+    python -m benchmarks.bulk_insert --jobs 1000 10000 100000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+
+def _make_jobs(nr_jobs):
+    return [{'id': 'job{:08d}'.format(i), 'type': 'benchmark',
+             'source_url': 'http://example.com/source/{}'.format(i)}
+            for i in range(nr_jobs)]
+
+
+def _time_insert(insert, nr_jobs):
+    """Return the seconds to insert new jobs and to insert them again"""
+    from uservice.database.sqldb import SqlJobDatabase
+    db = SqlJobDatabase('bulkinsert{}'.format(uuid.uuid4().hex[:8]))
+    try:
+        timings = []
+        for _ in range(2):
+            jobs = _make_jobs(nr_jobs)
+            t0 = time.monotonic()
+            with db.db.transaction():
+                insert(db, jobs)
+            timings.append(time.monotonic() - t0)
+        return timings
+    finally:
+        db.drop()
+
+
+def run(nr_jobs, per_job_max):
+    """Return the timings in seconds for nr_jobs jobs"""
+    from uservice.database.basedb import BaseJobDatabaseAPI
+    result = {'Jobs': nr_jobs}
+    result['BulkNew'], result['BulkDuplicates'] = _time_insert(
+        lambda db, jobs: db.insert_jobs_if_not_duplicate(jobs), nr_jobs)
+    if nr_jobs <= per_job_max:
+        result['PerJobNew'], result['PerJobDuplicates'] = _time_insert(
+            BaseJobDatabaseAPI.insert_jobs_if_not_duplicate, nr_jobs)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--jobs', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='Nr of jobs to add')
+    parser.add_argument('--per-job-max', type=int, default=10000,
+                        help='Only time the per job insert up to this nr '
+                             'of jobs')
+    parser.add_argument('--output', help='Write the JSON report to this '
+                                         'file instead of stdout')
+    args = parser.parse_args(argv)
+
+    tmpdir = None
+    if not os.environ.get('USERVICE_DATABASE_URI'):
+        tmpdir = tempfile.mkdtemp(prefix='uservice-benchmark')
+        os.environ['USERVICE_DATABASE_URI'] = 'sqlite:///{}'.format(
+            os.path.join(tmpdir, 'uservice.db'))
+    try:
+        from uservice.core.app import app
+        with app.app_context():
+            results = [run(n, args.per_job_max) for n in args.jobs]
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report = {
+        'Benchmark': 'bulk_insert',
+        'Time': datetime.utcnow().isoformat(),
+        'Database': os.environ['USERVICE_DATABASE_URI'].split(':')[0],
+        'Results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output + '\n')
+    else:
+        print(output)
+    for result in results:
+        print('{} jobs: bulk {:.2f} s, per job {}'.format(
+            result['Jobs'], result['BulkNew'],
+            '{:.2f} s'.format(result['PerJobNew'])
+            if 'PerJobNew' in result else '-'), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+"""Load benchmark of the worker cycle: fetch -> claim -> status -> output.
+
+Simulates concurrent workers that process all jobs of a project and
+reports throughput, latency per endpoint, claim conflicts and database
+queries per cycle as JSON.
+
+The job server is started in this process (default), under gunicorn
+(--gunicorn) or is a running server (--url). Without
+USERVICE_DATABASE_URI a temporary SQLite database is used.
+
+Example, from the src directory:
+
+    python -m benchmarks.fetch_claim --workers 16 --jobs 2000 \\
+        --output fetch_claim.json
+"""
+import argparse
+import base64
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+import requests
+
+API = '/rest_api/v4'
+# Max nr of jobs to add in one request
+ADD_JOBS_CHUNK = 500
+# Tokens are valid for ten minutes
+TOKEN_REFRESH_INTERVAL = 300
+
+
+def percentile(values, q):
+    """Return the q:th percentile (nearest rank) of values or None"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(q / 100. * len(values)))
+    return values[max(rank - 1, 0)]
+
+
+class InProcessClient:
+    """Send requests to the app with the flask test client"""
+
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def request(self, method, path, json=None, auth=None):
+        headers = {}
+        if auth:
+            headers['Authorization'] = 'Basic ' + base64.b64encode(
+                '{}:{}'.format(*auth).encode('utf-8')).decode('ascii')
+        response = self._client.open(
+            path, method=method, json=json, headers=headers)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpClient:
+    """Send requests to a running server"""
+
+    def __init__(self, url):
+        self._url = url.rstrip('/')
+        self._session = requests.Session()
+
+    def request(self, method, path, json=None, auth=None):
+        response = self._session.request(
+            method, self._url + path, json=json, auth=auth)
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        return response.status_code, data
+
+
+class QueryCounter:
+    """Count the queries sent to the database by this process"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def install(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        event.listen(Engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+class _WorkerStats:
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.cycles = 0
+        self.claims = 0
+        self.conflicts = 0
+
+
+class FetchClaimBenchmark:
+    """Let workers process all jobs of a new project.
+
+    Modes:
+      fetch-claim: GET jobs/fetch and PUT jobs/<id>/claim.
+      claim-next: PUT jobs/claim-next.
+    Both modes then PUT the status and the output of the job.
+    """
+
+    def __init__(self, make_client, admin_auth, nr_workers=8, nr_jobs=1000,
+                 mode='fetch-claim', query_counter=None):
+        self.make_client = make_client
+        self.admin_auth = admin_auth
+        self.nr_workers = nr_workers
+        self.nr_jobs = nr_jobs
+        self.mode = mode
+        self.query_counter = query_counter
+        self.project = 'benchmark{}'.format(uuid.uuid4().hex[:8])
+        self._user = None
+        self._password = uuid.uuid4().hex
+        self._user_id = None
+        self._token = None
+        self._token_time = None
+        self._token_lock = threading.Lock()
+
+    def setup(self):
+        """Add a worker user and a project with jobs"""
+        client = self.make_client()
+        self._user = 'benchmark-{}'.format(uuid.uuid4().hex[:8])
+        status, data = client.request(
+            'POST', '/rest_api/admin/users',
+            json={'username': self._user, 'password': self._password},
+            auth=self.admin_auth)
+        _check(status, 201, 'add user')
+        self._user_id = data['userid']
+        status, _ = client.request(
+            'PUT', '{}/{}'.format(API, self.project), auth=self._get_auth())
+        _check(status, 201, 'add project')
+        for start in range(0, self.nr_jobs, ADD_JOBS_CHUNK):
+            jobs = [
+                {'id': 'job{:08d}'.format(i), 'type': 'benchmark',
+                 'source_url': 'http://example.com/source/{}'.format(i)}
+                for i in range(start, min(start + ADD_JOBS_CHUNK,
+                                          self.nr_jobs))]
+            status, _ = client.request(
+                'POST', '{}/{}/jobs'.format(API, self.project), json=jobs,
+                auth=self._get_auth())
+            _check(status, 201, 'add jobs')
+
+    def teardown(self):
+        """Remove the project and the worker user"""
+        client = self.make_client()
+        client.request('DELETE', '{}/{}'.format(API, self.project),
+                       auth=self._get_auth())
+        if self._user_id is not None:
+            client.request(
+                'DELETE', '/rest_api/admin/users/{}'.format(self._user_id),
+                auth=self.admin_auth)
+
+    def _get_auth(self):
+        """Return token auth, basic auth is too slow to benchmark"""
+        with self._token_lock:
+            now = time.monotonic()
+            if self._token is None or (
+                    now - self._token_time > TOKEN_REFRESH_INTERVAL):
+                status, data = self.make_client().request(
+                    'GET', '/rest_api/token',
+                    auth=(self._user, self._password))
+                _check(status, 200, 'get token')
+                self._token = data['token']
+                self._token_time = now
+            return (self._token, '')
+
+    def run(self):
+        """Run the workers until all jobs are processed, return report"""
+        stats = [_WorkerStats() for _ in range(self.nr_workers)]
+        threads = [
+            threading.Thread(
+                target=self._work, args=('worker{}'.format(i), stats[i]))
+            for i in range(self.nr_workers)]
+        queries = self.query_counter.count if self.query_counter else None
+        t0 = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - t0
+        if self.query_counter:
+            queries = self.query_counter.count - queries
+        return self._report(stats, duration, queries)
+
+    def _work(self, worker, stats):
+        client = self.make_client()
+        jobs_path = '{}/{}/jobs'.format(API, self.project)
+
+        def call(endpoint, method, path, json=None):
+            t0 = time.monotonic()
+            status, data = client.request(
+                method, path, json=json, auth=self._get_auth())
+            stats.latencies[endpoint].append(time.monotonic() - t0)
+            if status >= 400 and status not in (404, 409):
+                stats.errors[endpoint] += 1
+            return status, data
+
+        while True:
+            if self.mode == 'claim-next':
+                status, data = call(
+                    'claim-next', 'PUT', '{}/claim-next'.format(jobs_path),
+                    json={'Worker': worker})
+                if status != 200:
+                    break
+                job_id = data['Job']['JobID']
+            else:
+                status, data = call(
+                    'fetch', 'GET',
+                    '{}/fetch?worker={}'.format(jobs_path, worker))
+                if status != 200:
+                    break
+                job_id = data['Job']['JobID']
+                status, _ = call(
+                    'claim', 'PUT', '{}/{}/claim'.format(jobs_path, job_id),
+                    json={'Worker': worker})
+                stats.claims += 1
+                if status == 409:
+                    stats.conflicts += 1
+                    continue
+                if status != 200:
+                    continue
+            call('status', 'PUT', '{}/{}/status'.format(jobs_path, job_id),
+                 json={'Status': 'FINISHED', 'ProcessingTime': 1})
+            call('output', 'PUT', '{}/{}/output'.format(jobs_path, job_id),
+                 json={'Output': 'Processed by {}'.format(worker)})
+            stats.cycles += 1
+
+    def _report(self, stats, duration, queries):
+        latencies = defaultdict(list)
+        errors = defaultdict(int)
+        for worker_stats in stats:
+            for endpoint, values in worker_stats.latencies.items():
+                latencies[endpoint].extend(values)
+            for endpoint, count in worker_stats.errors.items():
+                errors[endpoint] += count
+        cycles = sum(s.cycles for s in stats)
+        claims = sum(s.claims for s in stats)
+        conflicts = sum(s.conflicts for s in stats)
+        return {
+            'Mode': self.mode,
+            'Workers': self.nr_workers,
+            'Jobs': self.nr_jobs,
+            'Duration': duration,
+            'Cycles': cycles,
+            'JobsPerSecond': cycles / duration if duration else None,
+            'Claims': claims,
+            'ClaimConflicts': conflicts,
+            'ConflictRate': conflicts / float(claims) if claims else None,
+            'Queries': queries,
+            'QueriesPerCycle': (
+                queries / float(cycles) if queries is not None and cycles
+                else None),
+            'Endpoints': {
+                endpoint: {
+                    'Requests': len(values),
+                    'Errors': errors[endpoint],
+                    'Mean': sum(values) / len(values),
+                    'P50': percentile(values, 50),
+                    'P95': percentile(values, 95),
+                    'P99': percentile(values, 99),
+                }
+                for endpoint, values in latencies.items()
+            },
+        }
+
+
+def _check(status, expected, what):
+    if status != expected:
+        raise RuntimeError(
+            'Failed to {}: status {}, expected {}'.format(
+                what, status, expected))
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _start_gunicorn(nr_processes, env):
+    """Start the app under gunicorn and return the process and url"""
+    port = _free_port()
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(
+        ['gunicorn', '-w', str(nr_processes), '-k', 'gevent',
+         '-b', '127.0.0.1:{}'.format(port), 'uservice.core.app:app'],
+        cwd=src_dir, env=env)
+    url = 'http://127.0.0.1:{}'.format(port)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            requests.get('{}{}/projects'.format(url, API), timeout=5)
+            return process, url
+        except requests.ConnectionError:
+            if process.poll() is not None:
+                break
+            time.sleep(.5)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Nr of concurrent workers')
+    parser.add_argument('--jobs', type=int, default=1000,
+                        help='Nr of jobs to process')
+    parser.add_argument('--mode', choices=['fetch-claim', 'claim-next'],
+                        default='fetch-claim')
+    parser.add_argument('--gunicorn', type=int, metavar='PROCESSES',
+                        help='Run the app under gunicorn with this many '
+                             'worker processes')
+    parser.add_argument('--url', help='Use the server at this url')
+    parser.add_argument('--output', help='Write the JSON report to this '
+                                         'file instead of stdout')
+    args = parser.parse_args(argv)
+
+    tmpdir = None
+    if not os.environ.get('USERVICE_DATABASE_URI') and not args.url:
+        tmpdir = tempfile.mkdtemp(prefix='uservice-benchmark')
+        os.environ['USERVICE_DATABASE_URI'] = 'sqlite:///{}'.format(
+            os.path.join(tmpdir, 'uservice.db'))
+    os.environ.setdefault('USERVICE_ADMIN_USER', 'admin')
+    os.environ.setdefault('USERVICE_ADMIN_PASSWORD', uuid.uuid4().hex)
+    admin_auth = (os.environ['USERVICE_ADMIN_USER'],
+                  os.environ['USERVICE_ADMIN_PASSWORD'])
+
+    process = None
+    query_counter = None
+    try:
+        if args.url:
+            server = args.url
+            make_client = lambda: HttpClient(args.url)  # noqa: E731
+        elif args.gunicorn:
+            process, url = _start_gunicorn(args.gunicorn, dict(os.environ))
+            server = 'gunicorn -w {}'.format(args.gunicorn)
+            make_client = lambda: HttpClient(url)  # noqa: E731
+        else:
+            from uservice.core.app import app
+            server = 'in-process'
+            query_counter = QueryCounter()
+            query_counter.install()
+            make_client = lambda: InProcessClient(app)  # noqa: E731
+
+        benchmark = FetchClaimBenchmark(
+            make_client, admin_auth, nr_workers=args.workers,
+            nr_jobs=args.jobs, mode=args.mode, query_counter=query_counter)
+        benchmark.setup()
+        try:
+            report = benchmark.run()
+        finally:
+            benchmark.teardown()
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report.update({
+        'Benchmark': 'fetch_claim',
+        'Time': datetime.utcnow().isoformat(),
+        'Server': server,
+        'Database': (
+            os.environ['USERVICE_DATABASE_URI'].split(':')[0]
+            if not args.url else None),
+    })
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output + '\n')
+    else:
+        print(output)
+    print('{Cycles} jobs in {Duration:.1f} s, {JobsPerSecond:.1f} jobs/s, '
+          'conflict rate {ConflictRate}'.format(**report), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Micro benchmark of weighted project sampling for prio fetches.
+
+Compares the linear walk of ProjectsDB.weighted_choice, which needs the
+list of all (project, score) pairs, with the Fenwick tree of
+WeightedSampler, and reports the mean time per draw and per score update
+as JSON.
+
+Example, from the src directory:
+
+    python -m benchmarks.prio_sampling --projects 10 1000 100000
+"""
+import argparse
+import json
+import random
+import sys
+import timeit
+from datetime import datetime
+
+from uservice.database.projects import ProjectsDB
+from uservice.utils.weighted_sampler import WeightedSampler
+
+
+def _mean_time(func, repeat):
+    return timeit.timeit(func, number=repeat) / repeat
+
+
+def run(nr_projects, repeat):
+    """Return the timings in seconds for nr_projects projects"""
+    scores = [('project{}'.format(i), random.uniform(0, 10))
+              for i in range(nr_projects)]
+    sampler = WeightedSampler(scores)
+    projects = [project for project, _ in scores]
+
+    def linear_update():
+        # Without the tree the list of all scores is rebuilt
+        i = random.randrange(nr_projects)
+        updated = list(scores)
+        updated[i] = (projects[i], random.uniform(0, 10))
+
+    return {
+        'Projects': nr_projects,
+        'Build': _mean_time(lambda: WeightedSampler(scores), 1),
+        'LinearDraw': _mean_time(
+            lambda: ProjectsDB.weighted_choice(scores), repeat),
+        'LinearUpdate': _mean_time(linear_update, repeat),
+        'FenwickDraw': _mean_time(sampler.sample, repeat),
+        'FenwickUpdate': _mean_time(
+            lambda: sampler.set(
+                random.choice(projects), random.uniform(0, 10)),
+            repeat),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--projects', type=int, nargs='+',
+                        default=[10, 1000, 100000],
+                        help='Nr of projects to benchmark with')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='Nr of draws and updates to time')
+    parser.add_argument('--output', help='Write the JSON report to this '
+                                         'file instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = {
+        'Benchmark': 'prio_sampling',
+        'Time': datetime.utcnow().isoformat(),
+        'Results': [run(n, args.repeat) for n in args.projects],
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output + '\n')
+    else:
+        print(output)
+    for result in report['Results']:
+        print('{Projects} projects: linear draw {LinearDraw:.2e} s, '
+              'fenwick draw {FenwickDraw:.2e} s'.format(**result),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+"""Discrete event simulator of the schedulers of prio fetches.
+
+Replays a trace of added jobs with their processing times and outcomes
+through a scheduler from uservice.database.schedulers and a fleet of
+simulated workers. Each idle worker asks the scheduler for a project and
+processes its oldest unclaimed job. Reports per project completion times
+and deadline misses, and the idle time of the workers, as JSON.
+
+Traces are exported from the projects and jobs_* tables of the database
+(--export) or synthesized (--synthesize). A trace is a JSON object:
+
+    {"Start": "2016-01-01T00:00:00",
+     "Projects": [{"Id": "p", "User": "u", "Created": 0, "Deadline": 3600}],
+     "Jobs": [{"Project": "p", "Id": "1", "Added": 0,
+               "ProcessingTime": 120, "Failed": false}]}
+
+where Created, Deadline and Added are seconds after Start, and Deadline
+may be null.
+
+Example, from the src directory:
+
+    python -m benchmarks.scheduler_simulator --synthesize --days 7 \\
+        --workers 50 --scheduler prio fair-share deadline
+"""
+import argparse
+import heapq
+import json
+import random
+import sys
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from dateutil.parser import parse as parse_datetime
+
+from uservice.database.projects import ProjectsDB
+from uservice.database.schedulers import SCHEDULERS, make_scheduler
+
+
+class _Project:
+
+    def __init__(self, project, start):
+        self.id = project['Id']
+        self.deadline = project.get('Deadline')
+        self.data = {
+            'id': self.id,
+            'created_by_user': project.get('User'),
+            'created_timestamp': start + timedelta(
+                seconds=project.get('Created') or 0),
+            'deadline': (
+                start + timedelta(seconds=self.deadline)
+                if self.deadline is not None else None),
+            'nr_added': 0, 'nr_claimed': 0, 'nr_finished': 0,
+            'nr_failed': 0, 'processing_time': 0.,
+        }
+        self.jobs = deque()
+        self.nr_jobs = 0
+        self.first_added = None
+        self.completed = None
+
+    @property
+    def active(self):
+        return bool(self.jobs)
+
+
+class SimCache:
+    """The part of the PrioCache interface that the schedulers use, on the
+    simulated projects and clock.
+    """
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def get_projects(self, projects_db, job_types=None):
+        return [dict(project.data)
+                for project in self.simulator.projects.values()
+                if project.active]
+
+    def get_prio_project(self, projects_db, job_types=None, exclude=None,
+                         images=None):
+        return projects_db.weighted_choice([
+            (project, score) for project, score in self.get_scores().items()
+            if project not in (exclude or ())])
+
+    def get_scores(self):
+        now = self.simulator.now()
+        return {
+            project.id: ProjectsDB.calc_prio_score(project.data, now)
+            for project in self.simulator.projects.values()
+            if project.active}
+
+    def expire(self):
+        pass
+
+    def project_drained(self, project, job_types=None):
+        pass
+
+
+class SimProjectsDB:
+    """The part of the ProjectsDB interface that the schedulers use"""
+
+    calc_prio_score = staticmethod(ProjectsDB.calc_prio_score)
+    weighted_choice = staticmethod(ProjectsDB.weighted_choice)
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get_prio_project(self, job_types=None, exclude=None, images=None):
+        return self.cache.get_prio_project(self, exclude=exclude)
+
+
+class Simulator:
+    """Simulate a scheduler and a fixed number of workers on a trace"""
+
+    def __init__(self, trace, scheduler='prio', nr_workers=10, seed=None,
+                 **scheduler_kwargs):
+        """
+        Args:
+           trace (dict): The trace, see the module docstring.
+           scheduler (str): Name of the scheduler, see SCHEDULERS.
+           nr_workers (int): Size of the worker fleet.
+           seed (int): Seed of the random choices of the scheduler.
+           scheduler_kwargs: Passed to the scheduler.
+        """
+        self.start = parse_datetime(trace['Start'])
+        self.projects = {
+            project['Id']: _Project(project, self.start)
+            for project in trace['Projects']}
+        self.jobs = sorted(trace['Jobs'], key=lambda job: job['Added'])
+        self.scheduler_name = scheduler
+        self.nr_workers = nr_workers
+        self.seed = seed
+        self._cache = SimCache(self)
+        self._projects_db = SimProjectsDB(self._cache)
+        self.scheduler = make_scheduler(
+            scheduler, cache=self._cache, clock=self.now,
+            **scheduler_kwargs)
+        self._time = 0.
+
+    def now(self):
+        """Return the simulated time"""
+        return self.start + timedelta(seconds=self._time)
+
+    def run(self):
+        """Run the simulation and return the report"""
+        t0 = time.monotonic()
+        random.seed(self.seed)
+        # (time, sequence nr, worker or None, job)
+        events = [(job['Added'], i, None, job)
+                  for i, job in enumerate(self.jobs)]
+        heapq.heapify(events)
+        seq = len(events)
+        # Worker -> time when it became idle
+        idle = {worker: 0. for worker in range(self.nr_workers)}
+        idle_time = 0.
+        busy_time = 0.
+        while events:
+            self._time, _, worker, job = heapq.heappop(events)
+            project = self.projects[job['Project']]
+            if worker is None:
+                project.jobs.append(job)
+                project.nr_jobs += 1
+                project.data['nr_added'] += 1
+                if project.first_added is None:
+                    project.first_added = self._time
+            else:
+                done = 'nr_failed' if job.get('Failed') else 'nr_finished'
+                project.data[done] += 1
+                project.data['processing_time'] += job['ProcessingTime']
+                project.completed = self._time
+                idle[worker] = self._time
+            # Dispatch the idle workers
+            while idle:
+                project_id = self.scheduler.pick_project(self._projects_db)
+                if project_id is None:
+                    break
+                project = self.projects[project_id]
+                next_job = project.jobs.popleft()
+                project.data['nr_claimed'] += 1
+                worker, idle_since = idle.popitem()
+                idle_time += self._time - idle_since
+                busy_time += next_job['ProcessingTime']
+                heapq.heappush(events, (
+                    self._time + next_job['ProcessingTime'], seq, worker,
+                    next_job))
+                seq += 1
+        end = self._time
+        idle_time += sum(end - idle_since for idle_since in idle.values())
+        return self._report(end, idle_time, busy_time, time.monotonic() - t0)
+
+    def _report(self, end, idle_time, busy_time, runtime):
+        projects = {}
+        for project in self.projects.values():
+            if not project.nr_jobs:
+                continue
+            missed = None
+            lateness = None
+            if project.deadline is not None:
+                lateness = project.completed - project.deadline
+                missed = lateness > 0
+            projects[project.id] = {
+                'Jobs': project.nr_jobs,
+                'FirstAdded': project.first_added,
+                'Completed': project.completed,
+                'CompletionTime': project.completed - project.first_added,
+                'Deadline': project.deadline,
+                'Lateness': lateness,
+                'MissedDeadline': missed,
+            }
+        capacity = self.nr_workers * end
+        return {
+            'Scheduler': self.scheduler_name,
+            'Workers': self.nr_workers,
+            'Jobs': len(self.jobs),
+            'SimulatedTime': end,
+            'Runtime': runtime,
+            'WorkerIdleTime': idle_time,
+            'Utilisation': busy_time / capacity if capacity else None,
+            'DeadlineMisses': sum(
+                1 for p in projects.values() if p['MissedDeadline']),
+            'ProjectsWithDeadline': sum(
+                1 for p in projects.values() if p['Deadline'] is not None),
+            'Projects': projects,
+        }
+
+
+def synthesize_trace(nr_projects=20, nr_users=5, days=7,
+                     jobs_per_project=500, seed=None):
+    """Return a random trace.
+
+    Projects are created during the first two thirds of the period and
+    add their jobs within a day. Every project has its own mean processing
+    time, most projects have a deadline one to five days after creation.
+    """
+    rng = random.Random(seed)
+    period = days * 24 * 3600.
+    projects = []
+    jobs = []
+    for i in range(nr_projects):
+        project = 'project{}'.format(i)
+        created = rng.uniform(0, period * 2 / 3.)
+        deadline = None
+        if rng.random() < .7:
+            deadline = created + rng.uniform(1, 5) * 24 * 3600
+        projects.append({
+            'Id': project,
+            'User': 'user{}'.format(rng.randrange(nr_users)),
+            'Created': created,
+            'Deadline': deadline,
+        })
+        mean_processing_time = rng.uniform(60, 3600)
+        for j in range(jobs_per_project):
+            jobs.append({
+                'Project': project,
+                'Id': str(j),
+                'Added': created + rng.uniform(0, 24 * 3600),
+                'ProcessingTime': rng.expovariate(1 / mean_processing_time),
+                'Failed': rng.random() < .05,
+            })
+    return {'Start': datetime(2000, 1, 1).isoformat(),
+            'Projects': projects, 'Jobs': jobs}
+
+
+def export_trace(projects_db, get_jobs_db):
+    """Return a trace of the projects and jobs in the database.
+
+    The processing time of a job is the one reported by the worker, or
+    the time from claim to finish. Jobs that are not done get the mean
+    processing time of the project.
+
+    Args:
+       projects_db (ProjectsDB): The projects database.
+       get_jobs_db (callable): Returns the jobs database of a project.
+    """
+    projects = list(projects_db.get_projects(fields=[
+        'id', 'created_by_user', 'created_timestamp', 'deadline']))
+    jobs = []
+    for project in projects:
+        project_jobs = []
+        for job in get_jobs_db(project['id']).get_jobs(fields=[
+                'id', 'added_timestamp', 'claimed_timestamp',
+                'finished_timestamp', 'failed_timestamp',
+                'processing_time']):
+            done = job['finished_timestamp'] or job['failed_timestamp']
+            processing_time = job['processing_time']
+            if not processing_time and done and job['claimed_timestamp']:
+                processing_time = (
+                    done - job['claimed_timestamp']).total_seconds()
+            project_jobs.append({
+                'Project': project['id'],
+                'Id': job['id'],
+                'Added': job['added_timestamp'],
+                'ProcessingTime': processing_time,
+                'Failed': bool(job['failed_timestamp']),
+            })
+        known = [job['ProcessingTime'] for job in project_jobs
+                 if job['ProcessingTime']]
+        mean = (sum(known) / len(known) if known
+                else ProjectsDB.DEFAULT_MEAN_PROCESSING_TIME)
+        for job in project_jobs:
+            job['ProcessingTime'] = job['ProcessingTime'] or mean
+        jobs.extend(project_jobs)
+
+    times = [job['Added'] for job in jobs if job['Added']]
+    times.extend(p['created_timestamp'] for p in projects
+                 if p['created_timestamp'])
+    start = min(times) if times else datetime.utcnow()
+
+    def seconds(dt):
+        return (dt - start).total_seconds() if dt else None
+
+    for job in jobs:
+        job['Added'] = seconds(job['Added']) or 0.
+    return {
+        'Start': start.isoformat(),
+        'Projects': [{
+            'Id': project['id'],
+            'User': project['created_by_user'],
+            'Created': seconds(project['created_timestamp']),
+            'Deadline': seconds(project['deadline']),
+        } for project in projects],
+        'Jobs': jobs,
+    }
+
+
+def _export(output):
+    from uservice.core.app import app
+    from uservice.database.sqldb import SqlJobDatabase
+    with app.app_context():
+        trace = export_trace(ProjectsDB(), SqlJobDatabase)
+    with open(output, 'w') as out:
+        json.dump(trace, out)
+    print('Exported {} jobs in {} projects to {}'.format(
+        len(trace['Jobs']), len(trace['Projects']), output),
+        file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--trace', help='Simulate this trace file')
+    source.add_argument('--synthesize', action='store_true',
+                        help='Simulate a random trace')
+    source.add_argument('--export', metavar='FILE',
+                        help='Write a trace of the database in '
+                             'USERVICE_DATABASE_URI to this file and exit')
+    parser.add_argument('--scheduler', nargs='+', default=['prio'],
+                        choices=sorted(SCHEDULERS),
+                        help='Simulate these schedulers')
+    parser.add_argument('--workers', type=int, default=50,
+                        help='Nr of simulated workers')
+    parser.add_argument('--projects', type=int, default=20,
+                        help='Nr of projects of a synthesized trace')
+    parser.add_argument('--users', type=int, default=5,
+                        help='Nr of users of a synthesized trace')
+    parser.add_argument('--jobs', type=int, default=500,
+                        help='Nr of jobs per project of a synthesized trace')
+    parser.add_argument('--days', type=float, default=7,
+                        help='Length of a synthesized trace')
+    parser.add_argument('--seed', type=int, help='Random seed')
+    parser.add_argument('--output', help='Write the JSON report to this '
+                                         'file instead of stdout')
+    args = parser.parse_args(argv)
+
+    if args.export:
+        _export(args.export)
+        return
+    if args.trace:
+        with open(args.trace) as trace_file:
+            trace = json.load(trace_file)
+    else:
+        trace = synthesize_trace(
+            nr_projects=args.projects, nr_users=args.users, days=args.days,
+            jobs_per_project=args.jobs, seed=args.seed)
+
+    results = [
+        Simulator(trace, scheduler=name, nr_workers=args.workers,
+                  seed=args.seed).run()
+        for name in args.scheduler]
+    report = {
+        'Benchmark': 'scheduler_simulator',
+        'Time': datetime.utcnow().isoformat(),
+        'Trace': args.trace or 'synthesized',
+        'Results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output + '\n')
+    else:
+        print(output)
+    for result in results:
+        print('{Scheduler}: {DeadlineMisses}/{ProjectsWithDeadline} '
+              'deadlines missed, utilisation {Utilisation:.2f}, '
+              'simulated {SimulatedTime:.0f} s in {Runtime:.1f} s'.format(
+                  **result), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Fakes of the databases for unit tests"""
+from datetime import datetime
+
+from uservice.database.projects import ProjectsDB
+
+
+class FakeProjectsDB(ProjectsDB):
+    """ProjectsDB with the projects and job type counters in dicts"""
+
+    def __init__(self):
+        self.projects = {}
+        self.job_types = {}
+        self.queries = 0
+        self.locked = []
+
+    def add_project(self, project, nr_added=0, nr_claimed=0, job_types=None,
+                    **data):
+        """Add a project, job_types maps a job type to its counters"""
+        self.projects[project] = dict({
+            'id': project, 'nr_added': nr_added, 'nr_claimed': nr_claimed,
+            'nr_finished': 0, 'nr_failed': 0, 'processing_time': 0.,
+            'deadline': None, 'created_by_user': 'u',
+            'created_timestamp': datetime(2000, 1, 1),
+            'processing_image_url': None, 'fetch_strategy': None,
+            'weight': 1., 'paused': False}, **data)
+        self.job_types[project] = {
+            job_type: dict({'nr_added': 0, 'nr_claimed': 0}, **counts)
+            for job_type, counts in (job_types or {}).items()}
+
+    def get_projects(self, fields=None, only_active=False, **kwargs):
+        """Yield the projects, like ProjectsDB.get_projects"""
+        self.queries += 1
+        for p in list(self.projects.values()):
+            if not only_active or (
+                    p['nr_added'] > p['nr_claimed'] and not p['paused']):
+                yield {field: p[field] for field in fields or p}
+
+    def get_project(self, project_id, fields=None):
+        project = self.projects.get(project_id)
+        if project is None:
+            return None
+        return {field: project[field] for field in fields or project}
+
+    def lock_project(self, project_id):
+        self.locked.append(project_id)
+        return project_id in self.projects
+
+    def get_job_type_counts(self, project_id):
+        return {job_type: dict(counts) for job_type, counts
+                in self.job_types[project_id].items()}
+
+    def get_unclaimed_job_type_counts(self):
+        return {project: self.get_job_type_counts(project)
+                for project in self.job_types}
+
+    def update_project(self, project_id, **data):
+        for field, value in data.items():
+            if field in self.INCREMENTAL_FIELDS:
+                value += self.projects[project_id][field]
+            self.projects[project_id][field] = value
+        return True
+
+    def _update_job_type_counts(self, project_id, field, job_types):
+        for job_type, value in job_types.items():
+            counts = self.job_types[project_id].setdefault(
+                job_type, {'nr_added': 0, 'nr_claimed': 0})
+            counts[field] += value
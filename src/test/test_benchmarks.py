@@ -0,0 +1,18 @@
+from benchmarks.fetch_claim import percentile
+
+
+class TestPercentile:
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 95) == 95
+        assert percentile(values, 99) == 99
+        assert percentile(values, 100) == 100
+        assert percentile(values, 0) == 1
+
+    def test_percentile_of_unsorted_values(self):
+        assert percentile([3, 1, 2], 50) == 2
+
+    def test_percentile_without_values(self):
+        assert percentile([], 50) is None
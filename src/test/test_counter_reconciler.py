@@ -0,0 +1,154 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+
+from test.fakes import FakeProjectsDB
+from uservice.core.counter_reconciler import CounterReconciler
+
+
+def job_counts(nr_added=0, nr_claimed=0, nr_finished=0, nr_failed=0,
+               processing_time=0., job_types=None):
+    return {
+        'nr_added': nr_added, 'nr_claimed': nr_claimed,
+        'nr_finished': nr_finished, 'nr_failed': nr_failed,
+        'processing_time': processing_time, 'job_types': job_types or {}}
+
+
+class FakeSqlDB:
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+
+class FakeJobsDB:
+
+    def __init__(self, counts, watermark=(None, None, None, None)):
+        self.db = FakeSqlDB()
+        self.counts = counts
+        self.watermark = watermark
+        self.nr_counts = 0
+
+    def release_stranded_jobs(self, projects_db=None):
+        return 0
+
+    def get_counts(self):
+        self.nr_counts += 1
+        return self.counts
+
+    def get_watermark(self):
+        return self.watermark
+
+
+class TestCounterReconciler:
+
+    @pytest.fixture
+    def projects_db(self):
+        db = FakeProjectsDB()
+        db.add_project(
+            'p1', nr_added=3, nr_claimed=2, nr_finished=-1,
+            job_types={'a': {'nr_added': 3, 'nr_claimed': 3}})
+        db.add_project('p2', nr_added=1)
+        return db
+
+    @pytest.fixture
+    def jobs_dbs(self):
+        return {
+            'p1': FakeJobsDB(job_counts(
+                nr_added=3, nr_claimed=2, nr_finished=1,
+                processing_time=10.,
+                job_types={'a': {'nr_added': 2, 'nr_claimed': 2},
+                           'b': {'nr_added': 1, 'nr_claimed': 0}})),
+            'p2': FakeJobsDB(job_counts(nr_added=1)),
+        }
+
+    def test_counters_are_corrected(self, projects_db, jobs_dbs):
+        reconciler = CounterReconciler(get_jobs_db=jobs_dbs.get)
+        corrected = reconciler.reconcile(projects_db=projects_db)
+        assert corrected == {'p1': {
+            'nr_finished': 2, 'processing_time': 10.,
+            'job_types': {
+                'a': {'nr_added': -1, 'nr_claimed': -1},
+                'b': {'nr_added': 1}}}}
+        assert projects_db.projects['p1']['nr_finished'] == 1
+        assert projects_db.job_types['p1'] == jobs_dbs['p1'].counts[
+            'job_types']
+        assert reconciler.reconcile(projects_db=projects_db, full=True) == {}
+
+    def test_only_changed_projects_are_recounted(
+            self, projects_db, jobs_dbs):
+        reconciler = CounterReconciler(
+            min_interval=60, get_jobs_db=jobs_dbs.get)
+        now = datetime.utcnow()
+        reconciler.reconcile(now=now, projects_db=projects_db)
+        assert jobs_dbs['p1'].nr_counts == 1
+        assert jobs_dbs['p2'].nr_counts == 1
+
+        # A job is added to p2 and the counter drifts
+        jobs_dbs['p2'].watermark = (now, None, None, None)
+        jobs_dbs['p2'].counts = job_counts(nr_added=2)
+        # Recounted at most every min_interval
+        reconciler.reconcile(
+            now=now + timedelta(seconds=30), projects_db=projects_db)
+        assert jobs_dbs['p2'].nr_counts == 1
+        corrected = reconciler.reconcile(
+            now=now + timedelta(seconds=60), projects_db=projects_db)
+        assert corrected == {'p2': {'nr_added': 1}}
+        # Unchanged projects are not recounted
+        assert jobs_dbs['p1'].nr_counts == 1
+        reconciler.reconcile(
+            now=now + timedelta(seconds=120), projects_db=projects_db)
+        assert jobs_dbs['p2'].nr_counts == 2
+
+    def test_changed_counters_are_recounted(self, projects_db, jobs_dbs):
+        reconciler = CounterReconciler(
+            min_interval=0, get_jobs_db=jobs_dbs.get)
+        reconciler.reconcile(projects_db=projects_db)
+        projects_db.projects['p2']['nr_claimed'] += 1
+        corrected = reconciler.reconcile(projects_db=projects_db)
+        assert corrected == {'p2': {'nr_claimed': -1}}
+        assert jobs_dbs['p1'].nr_counts == 1
+
+    def test_recount_after_full_interval(self, projects_db, jobs_dbs):
+        reconciler = CounterReconciler(
+            full_interval=3600, get_jobs_db=jobs_dbs.get)
+        now = datetime.utcnow()
+        reconciler.reconcile(now=now, projects_db=projects_db)
+        reconciler.reconcile(
+            now=now + timedelta(seconds=3600), projects_db=projects_db)
+        assert jobs_dbs['p1'].nr_counts == 2
+
+    def test_max_projects_per_pass(self, projects_db, jobs_dbs):
+        reconciler = CounterReconciler(
+            max_projects=1, get_jobs_db=jobs_dbs.get)
+        reconciler.reconcile(projects_db=projects_db)
+        assert jobs_dbs['p1'].nr_counts + jobs_dbs['p2'].nr_counts == 1
+        reconciler.reconcile(projects_db=projects_db)
+        assert jobs_dbs['p1'].nr_counts == 1
+        assert jobs_dbs['p2'].nr_counts == 1
+
+    def test_jobs_databases_are_reused(self, projects_db, jobs_dbs):
+        created = []
+
+        def get_jobs_db(project):
+            created.append(project)
+            return jobs_dbs[project]
+
+        reconciler = CounterReconciler(get_jobs_db=get_jobs_db)
+        for _ in range(2):
+            reconciler.reconcile(projects_db=projects_db, full=True)
+        assert sorted(created) == ['p1', 'p2']
+
+    def test_projects_are_locked_before_counting(
+            self, projects_db, jobs_dbs):
+        get_counts = jobs_dbs['p1'].get_counts
+
+        def locked_get_counts():
+            assert projects_db.locked[-1] == 'p1'
+            return get_counts()
+
+        jobs_dbs['p1'].get_counts = locked_get_counts
+        reconciler = CounterReconciler(get_jobs_db=jobs_dbs.get)
+        reconciler.reconcile(projects_db=projects_db)
+        assert jobs_dbs['p1'].nr_counts == 1
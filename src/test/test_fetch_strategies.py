@@ -0,0 +1,148 @@
+import pytest
+
+from test.fakes import FakeProjectsDB
+from uservice.database import fetch_strategies as fs
+
+
+class FakeJobsDB:
+
+    def __init__(self, job_ids, priorities=None):
+        priorities = priorities or {}
+        self.jobs = [{'id': job_id, 'claimed': False, 'type': 't',
+                      'priority': priorities.get(job_id, 0)}
+                     for job_id in sorted(job_ids)]
+
+    def claim(self, job_id):
+        for job in self.jobs:
+            if job['id'] == job_id:
+                job['claimed'] = True
+
+    def _unclaimed(self, priority=None):
+        return [job for job in self.jobs if not job['claimed'] and
+                (priority is None or job['priority'] == priority)]
+
+    def get_top_priority(self, job_types=None):
+        priorities = set(job['priority'] for job in self._unclaimed())
+        return max(priorities) if len(priorities) > 1 else None
+
+    def get_top_priority_jobs(self, fields, job_types=None, limit=None):
+        jobs = self._unclaimed()
+        if not jobs:
+            return []
+        top = max(job['priority'] for job in jobs)
+        return self._unclaimed(top)[:limit]
+
+    def get_unclaimed_jobs(self, fields, job_types=None, after_id=None,
+                           until_id=None, limit=None, priority=None):
+        jobs = [job for job in self._unclaimed(priority)
+                if (after_id is None or job['id'] > after_id) and
+                (until_id is None or job['id'] <= until_id)]
+        return jobs[:limit]
+
+    def get_unclaimed_id_range(self, job_types=None, priority=None):
+        jobs = self._unclaimed(priority)
+        if not jobs:
+            return None, None
+        return jobs[0]['id'], jobs[-1]['id']
+
+
+JOB_IDS = ['job%03d' % i for i in range(200)]
+
+
+class TestInterpolateKey:
+
+    def test_keys_are_between_low_and_high(self):
+        keys = [fs.interpolate_key('job000', 'job199', i / 10.)
+                for i in range(11)]
+        assert keys[0] == 'job000'
+        assert keys[-1] == 'job199'
+        assert keys == sorted(keys)
+        assert len(set(keys)) == 11
+
+    def test_keys_of_different_length(self):
+        key = fs.interpolate_key('a', 'abc', .5)
+        assert 'a' <= key <= 'abc'
+
+    def test_keys_outside_known_alphabets(self):
+        key = fs.interpolate_key('a_1', 'z_9', .5)
+        assert 'a_1' < key < 'z_9'
+
+
+class TestFetchStrategies:
+
+    @pytest.mark.parametrize('strategy', [
+        fs.WindowStrategy, fs.RandomKeysetStrategy, fs.PartitionStrategy,
+        fs.RotatingStrategy])
+    def test_select_unclaimed_job(self, strategy):
+        strategy = strategy()
+        db = FakeJobsDB(JOB_IDS)
+        for job_id in JOB_IDS[:-1]:
+            db.claim(job_id)
+        job = strategy.select('p', db, ['id'], worker='w')
+        assert job['id'] == JOB_IDS[-1]
+        db.claim(JOB_IDS[-1])
+        assert strategy.select('p', db, ['id'], worker='w') is None
+
+    @pytest.mark.parametrize('strategy', [
+        fs.WindowStrategy, fs.RandomKeysetStrategy, fs.PartitionStrategy,
+        fs.RotatingStrategy])
+    def test_select_jobs_with_highest_priority(self, strategy):
+        strategy = strategy()
+        urgent = JOB_IDS[50:53]
+        db = FakeJobsDB(JOB_IDS, {job_id: 5 for job_id in urgent})
+        selected = {strategy.select('p', db, ['id'], worker='w')['id']
+                    for _ in range(30)}
+        assert selected <= set(urgent)
+        for job_id in urgent:
+            db.claim(job_id)
+        assert strategy.select(
+            'p', db, ['id'], worker='w')['id'] not in urgent
+
+    def test_partition_depends_on_worker(self):
+        strategy = fs.PartitionStrategy()
+        db = FakeJobsDB(JOB_IDS)
+        parts = {
+            worker: {strategy.select('p', db, ['id'], worker=worker)['id']
+                     for _ in range(10)}
+            for worker in ['w1', 'w2']}
+        spread = (len(JOB_IDS) // strategy.PARTITIONS +
+                  strategy.CANDIDATES)
+        for ids in parts.values():
+            assert JOB_IDS.index(max(ids)) - JOB_IDS.index(min(ids)) < spread
+
+    def test_rotating_cursor_moves_and_wraps(self):
+        strategy = fs.RotatingStrategy()
+        db = FakeJobsDB(JOB_IDS[:30])
+        first = strategy.select('p', db, ['id'])
+        second = strategy.select('p', db, ['id'])
+        assert first['id'] < JOB_IDS[20] <= second['id']
+        third = strategy.select('p', db, ['id'])
+        assert third['id'] < JOB_IDS[20]
+
+    def test_claim_collisions_are_counted_per_strategy(self):
+        strategies = fs.FetchStrategies(default='window')
+        db = FakeJobsDB(['1'])
+        projects_db = FakeProjectsDB()
+        for _ in range(2):
+            job = strategies.select('p', db, projects_db, ['id'])
+            assert job['id'] == '1'
+        strategies.report_claim('p', '1', True)
+        strategies.report_claim('p', '1', False)
+        # Not handed out by a fetch
+        strategies.report_claim('p', '2', False)
+        assert strategies.get_stats() == {'p': {'window': {
+            'Fetches': 2, 'Claims': 2, 'Collisions': 1,
+            'CollisionRate': .5}}}
+
+    def test_strategy_of_project(self):
+        strategies = fs.FetchStrategies(default='window')
+        projects_db = FakeProjectsDB()
+        projects_db.add_project('q', fetch_strategy='rotating')
+        projects_db.add_project('r', fetch_strategy='unknown')
+        assert strategies.get_strategy('p', projects_db) == 'window'
+        assert strategies.get_strategy('q', projects_db) == 'rotating'
+        assert strategies.get_strategy('r', projects_db) == 'window'
+
+    def test_unknown_default_strategy(self):
+        with pytest.raises(ValueError):
+            fs.FetchStrategies(default='unknown')
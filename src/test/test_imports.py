@@ -0,0 +1,83 @@
+# pylint: disable=no-self-use
+import time
+
+import pytest
+import requests
+
+from uservice.views.import_views import make_chunks
+from test.testbase import ADMINUSER, ADMINPW
+
+
+class TestMakeChunks:
+
+    def test_make_chunks(self):
+        assert list(make_chunks(iter('abcde'), 2)) == [
+            ['a', 'b'], ['c', 'd'], ['e']]
+
+    def test_no_lines(self):
+        assert list(make_chunks(iter([]), 2)) == []
+
+
+@pytest.mark.system
+class TestImports:
+    @pytest.fixture
+    def session(self):
+        requests_session = requests.Session()
+        requests_session.auth = (ADMINUSER, ADMINPW)
+        return requests_session
+
+    @pytest.fixture
+    def project(self, session, microq_service):
+        name = 'testimports'
+        url = "{}/rest_api/v4/{}".format(microq_service, name)
+        session.put(url).raise_for_status()
+        yield url
+        if session.head(url).status_code == 200:
+            session.delete(url).raise_for_status()
+
+    def wait_for_import(self, session, uri, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            data = session.get(uri).json()
+            if data['Status'] in ('DONE', 'FAILED'):
+                return data
+            time.sleep(.2)
+        raise AssertionError('Import was not done in {} s'.format(timeout))
+
+    def test_import_jobs(self, session, project):
+        job = {'id': '42', 'source_url': 'http://example.com/job2'}
+        session.post(project + '/jobs', json=job).raise_for_status()
+        jobs = [
+            {'id': '41', 'source_url': 'http://example.com/job1'},
+            {'id': '42', 'source_url': 'http://example.com/job2'},
+            {'id': '43', 'source_url': 'http://example.com/job3'},
+        ]
+        response = session.post(project + '/imports', json=jobs)
+        assert response.status_code == 202
+        assert response.json()['Jobs'] == 3
+        data = self.wait_for_import(session, response.headers['Location'])
+        assert data['Status'] == 'DONE'
+        assert data['Processed'] == 3
+        assert data['Added'] == 2
+        assert data['Progress'] == 1
+        assert session.get(project).json()['NrJobsAdded'] == 3
+        imports = session.get(project + '/imports').json()['Imports']
+        assert [i['ID'] for i in imports] == [data['ID']]
+
+    def test_import_conflicting_jobs(self, session, project):
+        job = {'id': '42', 'source_url': 'http://example.com/job'}
+        session.post(project + '/jobs', json=job).raise_for_status()
+        jobs = [{'id': '42', 'source_url': 'http://example.com/other'}]
+        response = session.post(project + '/imports', json=jobs)
+        data = self.wait_for_import(session, response.headers['Location'])
+        assert data['Status'] == 'DONE'
+        assert data['Conflicts'] == 1
+        assert data['Errors'] == ['Job#0: A job with id 42 already exists.']
+        assert session.get(project).json()['NrJobsAdded'] == 1
+
+    def test_import_is_not_found_in_other_project(
+            self, session, project, microq_service):
+        response = session.post(project + '/imports', json=[])
+        uri = "{}/rest_api/v4/{}/imports/{}".format(
+            microq_service, 'other', response.json()['ID'])
+        assert session.get(uri).status_code == 404
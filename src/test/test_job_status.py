@@ -0,0 +1,68 @@
+import pytest
+
+from uservice.database.basedb import (
+    InMemoryJobDatabase, DBError, DBConflictError)
+
+
+class FakeProjectsDB:
+
+    def __init__(self):
+        self.finished = 0
+        self.failed = 0
+        self.processing_time = 0
+
+    def job_finished(self, project_id, processing_time):
+        self.finished += 1
+        self.processing_time += processing_time
+
+    def job_failed(self, project_id, processing_time):
+        self.failed += 1
+        self.processing_time += processing_time
+
+
+class TestUpdateStatus:
+
+    @pytest.fixture
+    def db(self):
+        db = InMemoryJobDatabase('test_job_status')
+        db.drop()
+        db.insert_job('1', {'id': '1', 'source_url': 'x'})
+        db.claim_job('1', 'worker')
+        return db
+
+    def test_done_status_is_counted_once(self, db):
+        projects_db = FakeProjectsDB()
+        for expected in [True, False]:
+            assert db.update_status(
+                '1', 'FINISHED', 10, projects_db=projects_db) is expected
+        assert projects_db.finished == 1
+        assert projects_db.processing_time == 10
+        assert db.get_job('1')['current_status'] == 'FINISHED'
+
+    def test_done_job_keeps_its_status(self, db):
+        projects_db = FakeProjectsDB()
+        db.update_status('1', 'FAILED', 10, projects_db=projects_db)
+        for status in ['FINISHED', 'STARTED', '42']:
+            with pytest.raises(DBConflictError):
+                db.update_status('1', status, projects_db=projects_db)
+        assert projects_db.failed == 1
+        assert projects_db.finished == 0
+        assert db.get_job('1')['current_status'] == 'FAILED'
+
+    def test_any_status_before_done(self, db):
+        projects_db = FakeProjectsDB()
+        for status in ['STARTED', '42', '42', 'FINISHED']:
+            assert db.update_status('1', status, projects_db=projects_db)
+        assert projects_db.finished == 1
+
+    def test_job_must_be_claimed(self, db):
+        with pytest.raises(DBConflictError):
+            db.update_status('1', 'FINISHED', worker='other')
+        db.unclaim_job('1')
+        with pytest.raises(DBConflictError):
+            db.update_status('1', 'FINISHED')
+        assert db.get_job('1')['current_status'] == 'CLAIMED'
+
+    def test_missing_job(self, db):
+        with pytest.raises(DBError):
+            db.update_status('2', 'FINISHED')
@@ -0,0 +1,44 @@
+from collections import Counter
+from contextlib import contextmanager
+
+from test.fakes import FakeProjectsDB
+from uservice.core.lease_reaper import LeaseReaper
+
+
+class FakeSqlDB:
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+
+class FakeJobsDB:
+
+    def __init__(self, expired=None):
+        self.db = FakeSqlDB()
+        self.expired = Counter(expired or {})
+        self.nr_reaps = 0
+
+    def requeue_expired_jobs(self, now):
+        self.nr_reaps += 1
+        expired, self.expired = self.expired, Counter()
+        return expired
+
+
+class TestLeaseReaper:
+
+    def test_expired_leases_are_requeued(self):
+        projects_db = FakeProjectsDB()
+        projects_db.add_project(
+            'p1', nr_added=2, nr_claimed=2,
+            job_types={'a': {'nr_added': 2, 'nr_claimed': 2}})
+        projects_db.add_project('p2', nr_added=1)
+        jobs_dbs = {'p1': FakeJobsDB({'a': 1}), 'p2': FakeJobsDB()}
+        reaper = LeaseReaper(get_jobs_db=jobs_dbs.get)
+        assert reaper.reap(projects_db=projects_db) == {'p1': 1}
+        assert projects_db.projects['p1']['nr_claimed'] == 1
+        assert projects_db.job_types['p1']['a']['nr_claimed'] == 1
+        # Projects without claimed jobs are not reaped
+        assert jobs_dbs['p2'].nr_reaps == 0
+        assert reaper.reap(projects_db=projects_db) == {}
+        assert jobs_dbs['p1'].nr_reaps == 2
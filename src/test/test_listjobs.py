@@ -1,9 +1,12 @@
 # pylint: disable=no-self-use
+import json
+
 import pytest
 import requests
 
 from uservice.views.listjobs import (
-    validate_json_job, validate_json_job_list, ValidationError)
+    parse_json_job, validate_json_job, validate_json_job_list,
+    ValidationError)
 from test.testbase import ADMINUSER, ADMINPW
 
 
@@ -79,6 +82,45 @@ class TestJsonJobValidation:
         )
         assert str(excinfo.value) == expected_error
 
+    def test_depends_on(self, job):
+        job['depends_on'] = ['a', 'b']
+        validate_json_job(job)
+
+    @pytest.mark.parametrize('depends_on, expected_error', [
+        ('a', "Expected list of job ids in field 'depends_on'"),
+        ([1], "Expected list of job ids in field 'depends_on'"),
+        (['abcd'], 'A job cannot depend on itself'),
+    ])
+    def test_invalid_depends_on(self, job, depends_on, expected_error):
+        job['depends_on'] = depends_on
+        with pytest.raises(ValidationError) as excinfo:
+            validate_json_job(job)
+        assert str(excinfo.value) == expected_error
+
+    def test_priority(self, job):
+        job['priority'] = -3
+        validate_json_job(job)
+
+    @pytest.mark.parametrize('priority', ['1', 1.5, True, None, 2**31])
+    def test_invalid_priority(self, job, priority):
+        job['priority'] = priority
+        with pytest.raises(ValidationError) as excinfo:
+            validate_json_job(job)
+        assert str(excinfo.value) == "Expected integer in field 'priority'"
+
+    def test_parse_json_job(self, job):
+        assert parse_json_job(json.dumps(job).encode('utf-8')) == job
+
+    @pytest.mark.parametrize('line, expected_error', [
+        (b'{"id": ', 'Invalid JSON'),
+        (b'["abcd"]', 'Expected a JSON object'),
+        (b'{"id": "abcd"}', 'Missing required fields: source_url'),
+    ])
+    def test_parse_invalid_json_job(self, line, expected_error):
+        with pytest.raises(ValidationError) as excinfo:
+            parse_json_job(line)
+        assert str(excinfo.value) == expected_error
+
 
 @pytest.mark.system
 class TestAddJobs:
@@ -199,3 +241,141 @@ class TestAddJobs:
         response = session.post(project + '/jobs', json=jobs)
         assert response.status_code == 201
         assert len(session.get(project + '/jobs').json()['Jobs']) == 2
+
+    def test_add_a_list_of_jobs_with_other_type(self, session, project):
+        job = {'id': '42', 'source_url': 'http://example.com/job',
+               'type': 'a'}
+        session.post(project + '/jobs', json=job).raise_for_status()
+        # Jobs are compared by all fields set by the user
+        jobs = [{'id': '42', 'source_url': 'http://example.com/job'}]
+        response = session.post(project + '/jobs', json=jobs)
+        assert response.status_code == 409
+        expected_error = 'Job#0: A job with id 42 already exists.'
+        assert response.json() == {'error': expected_error}
+
+    def test_add_jobs_as_ndjson(self, session, project):
+        job = {'id': '42', 'source_url': 'http://example.com/job'}
+        session.post(project + '/jobs', json=job).raise_for_status()
+        jobs = [
+            {'id': '41', 'source_url': 'http://example.com/job1'},
+            {'id': '42', 'source_url': 'http://example.com/job'},
+        ]
+        response = session.post(
+            project + '/jobs',
+            data='\n'.join(json.dumps(job) for job in jobs),
+            headers={'Content-Type': 'application/x-ndjson'})
+        assert response.status_code == 201
+        assert response.json()['Added'] == 1
+        assert len(session.get(project + '/jobs').json()['Jobs']) == 2
+        assert session.get(project).json()['NrJobsAdded'] == 2
+
+    def test_add_jobs_as_ndjson_with_conflict(self, session, project):
+        job = {'id': '42', 'source_url': 'http://example.com/job'}
+        session.post(project + '/jobs', json=job).raise_for_status()
+        jobs = [
+            {'id': '41', 'source_url': 'http://example.com/job1'},
+            {'id': '42', 'source_url': 'http://example.com/job2'},
+        ]
+        response = session.post(
+            project + '/jobs',
+            data='\n'.join(json.dumps(job) for job in jobs),
+            headers={'Content-Type': 'application/x-ndjson'})
+        assert response.status_code == 409
+        assert response.json()['Chunks'] == [{
+            'FirstJob': 0, 'Jobs': 2, 'Added': 0, 'Invalid': 0,
+            'Conflicts': 1,
+            'Errors': ['Job#1: A job with id 42 already exists.']}]
+        assert len(session.get(project + '/jobs').json()['Jobs']) == 1
+
+    def test_jobs_wait_for_their_dependencies(self, session, project):
+        jobs = [
+            {'id': '41', 'source_url': 'http://example.com/job1'},
+            {'id': '42', 'source_url': 'http://example.com/job2'},
+            {'id': '43', 'source_url': 'http://example.com/job3',
+             'depends_on': ['41', '42']},
+        ]
+        session.post(project + '/jobs', json=jobs).raise_for_status()
+
+        def get_status(job_id):
+            return session.get(
+                '{}/jobs/{}/status'.format(project, job_id)).json()['Status']
+
+        assert get_status('43') == 'WAITING'
+        response = session.put(
+            project + '/jobs/43/claim', json={'Worker': 'worker'})
+        assert response.status_code == 409
+        for job_id in ['41', '42']:
+            session.put('{}/jobs/{}/claim'.format(project, job_id),
+                        json={'Worker': 'worker'}).raise_for_status()
+        assert session.get(project).json()['NrJobsClaimed'] == 3
+
+        session.put(project + '/jobs/41/status',
+                    json={'Status': 'FINISHED'}).raise_for_status()
+        assert get_status('43') == 'WAITING'
+        session.put(project + '/jobs/42/status',
+                    json={'Status': 'FINISHED'}).raise_for_status()
+        assert get_status('43') == 'AVAILABLE'
+        assert session.get(project).json()['NrJobsClaimed'] == 2
+        session.put(project + '/jobs/43/claim',
+                    json={'Worker': 'worker'}).raise_for_status()
+
+    def test_waiting_jobs_keep_their_status(self, session, project):
+        jobs = [
+            {'id': '41', 'source_url': 'http://example.com/job1'},
+            {'id': '42', 'source_url': 'http://example.com/job2',
+             'depends_on': ['41']},
+        ]
+        session.post(project + '/jobs', json=jobs).raise_for_status()
+        for job_id, status in [('42', 'STARTED'), ('42', 'FINISHED'),
+                               ('41', 'WAITING')]:
+            response = session.put(
+                '{}/jobs/{}/status'.format(project, job_id),
+                json={'Status': status})
+            assert response.status_code == 409
+
+    def test_dependencies_are_counted_down_once(self, session, project):
+        jobs = [
+            {'id': '41', 'source_url': 'http://example.com/job1'},
+            {'id': '42', 'source_url': 'http://example.com/job2'},
+            {'id': '43', 'source_url': 'http://example.com/job3',
+             'depends_on': ['41', '42']},
+        ]
+        session.post(project + '/jobs', json=jobs).raise_for_status()
+        # 41 is finished, unclaimed and finished again
+        for _ in range(2):
+            session.put(project + '/jobs/41/claim',
+                        json={'Worker': 'worker'}).raise_for_status()
+            session.put(project + '/jobs/41/status',
+                        json={'Status': 'FINISHED'}).raise_for_status()
+            session.delete(project + '/jobs/41/claim').raise_for_status()
+        response = session.get(project + '/jobs/43/status')
+        assert response.json()['Status'] == 'WAITING'
+
+    def test_claim_jobs_with_highest_priority(self, session, project):
+        jobs = [{'id': str(job_id), 'source_url': 'http://example.com/job',
+                 'priority': 1 if job_id == 5 else 0}
+                for job_id in range(10)]
+        session.post(project + '/jobs', json=jobs).raise_for_status()
+        response = session.put(
+            project + '/jobs/priority',
+            json={'Priority': 2, 'JobIDs': ['7', '8', 'unknown']})
+        response.raise_for_status()
+        assert response.json()['Updated'] == 2
+
+        claimed = []
+        for _ in range(3):
+            response = session.put(
+                project + '/jobs/claim-next', json={'Worker': 'worker'})
+            response.raise_for_status()
+            claimed.append(response.json()['Job']['JobID'])
+        assert sorted(claimed[:2]) == ['7', '8']
+        assert claimed[2] == '5'
+
+    @pytest.mark.parametrize('data', [
+        {'Priority': '1', 'JobIDs': ['1']},
+        {'Priority': 1, 'JobIDs': '1'},
+        [1],
+    ])
+    def test_set_priority_bad_request(self, session, project, data):
+        response = session.put(project + '/jobs/priority', json=data)
+        assert response.status_code == 400
@@ -0,0 +1,41 @@
+import threading
+import time
+
+from uservice.core.notifier import JobNotifier
+
+
+class TestJobNotifier:
+
+    def test_wait_times_out_without_notification(self):
+        notifier = JobNotifier()
+        version = notifier.get_version('project')
+        t0 = time.monotonic()
+        assert not notifier.wait(version, 'project', timeout=0.05)
+        assert time.monotonic() - t0 >= 0.05
+
+    def test_wait_returns_directly_if_already_notified(self):
+        notifier = JobNotifier()
+        version = notifier.get_version('project')
+        notifier.notify('project')
+        assert notifier.wait(version, 'project', timeout=0)
+
+    def test_notification_wakes_up_waiter(self):
+        notifier = JobNotifier()
+        version = notifier.get_version('project')
+        timer = threading.Timer(0.01, notifier.notify, args=('project',))
+        timer.start()
+        assert notifier.wait(version, 'project', timeout=5)
+        timer.join()
+
+    def test_other_project_does_not_wake_up_waiter(self):
+        notifier = JobNotifier()
+        version = notifier.get_version('project')
+        notifier.notify('other')
+        assert not notifier.wait(version, 'project', timeout=0.01)
+
+    def test_any_project_wakes_up_waiter_on_all_projects(self):
+        notifier = JobNotifier()
+        version = notifier.get_version()
+        notifier.notify('other')
+        assert notifier.wait(version, timeout=0)
+        assert notifier.get_version() > version
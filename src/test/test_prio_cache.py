@@ -0,0 +1,86 @@
+import pytest
+
+from test.fakes import FakeProjectsDB
+from uservice.database.prio_cache import PrioCache
+
+
+class TestPrioCache:
+
+    @pytest.fixture
+    def db(self):
+        db = FakeProjectsDB()
+        db.add_project('p1', 1, job_types={'a': {'nr_added': 1}})
+        db.add_project('p2', 2, 2)
+        return db
+
+    def test_picks_are_cached(self, db):
+        cache = PrioCache(ttl=60)
+        for _ in range(3):
+            assert cache.get_prio_project(db) == 'p1'
+        assert db.queries == 1
+        stats = cache.get_stats()
+        assert stats['Hits'] == 2
+        assert stats['Misses'] == 1
+        assert stats['Projects'] == 1
+
+    def test_refresh_after_ttl(self, db):
+        cache = PrioCache(ttl=0)
+        cache.get_prio_project(db)
+        cache.get_prio_project(db)
+        assert db.queries == 2
+
+    def test_incremental_updates(self, db):
+        cache = PrioCache(ttl=60)
+        assert cache.get_prio_project(db) == 'p1'
+        cache.project_updated('p1', {'nr_claimed': 1})
+        db.projects['p1']['nr_claimed'] = 1
+        assert cache.get_prio_project(db) is None
+        assert db.queries == 1
+        # Jobs released in a project that is not cached
+        cache.project_updated('p2', {'nr_claimed': -1})
+        db.projects['p2']['nr_claimed'] = 1
+        assert cache.get_prio_project(db) == 'p2'
+        assert db.queries == 2
+
+    def test_job_types(self, db):
+        cache = PrioCache(ttl=60)
+        assert cache.get_prio_project(db, ['a']) == 'p1'
+        assert cache.get_prio_project(db, ['b']) is None
+        cache.job_types_updated('p1', 'nr_claimed', {'a': 1})
+        assert cache.get_prio_project(db, ['a']) is None
+
+    def test_drained_project_is_not_picked(self, db):
+        cache = PrioCache(ttl=60)
+        assert cache.get_prio_project(db) == 'p1'
+        cache.project_drained('p1')
+        assert cache.get_prio_project(db) is None
+        assert cache.get_stats()['Drained'] == 1
+
+    def test_drained_until_counters_change(self, db):
+        cache = PrioCache(ttl=0)
+        cache.get_prio_project(db)
+        cache.project_drained('p1')
+        # Still drained after refreshes
+        assert cache.get_prio_project(db) is None
+        assert cache.get_projects(db) == []
+        # Another job is added
+        db.projects['p1']['nr_added'] += 1
+        assert cache.get_prio_project(db) == 'p1'
+        assert cache.get_stats()['Drained'] == 0
+
+    def test_drained_job_types(self, db):
+        db.add_project('p3', 2, job_types={
+            'a': {'nr_added': 1}, 'b': {'nr_added': 1}})
+        cache = PrioCache(ttl=60)
+        cache.project_drained('p3', ['a'])
+        assert cache.get_prio_project(db, ['a']) == 'p1'
+        assert cache.get_prio_project(db, ['b']) == 'p3'
+        cache.job_types_updated('p3', 'nr_added', {'a': 1})
+        assert {cache.get_prio_project(db, ['a'])
+                for _ in range(50)} == {'p1', 'p3'}
+
+    def test_exclude(self, db):
+        db.add_project('p3', 1)
+        cache = PrioCache(ttl=60)
+        assert cache.get_prio_project(db, exclude={'p1'}) == 'p3'
+        assert cache.get_prio_project(db, exclude={'p1', 'p3'}) is None
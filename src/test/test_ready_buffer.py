@@ -0,0 +1,86 @@
+import pytest
+
+from uservice.database.ready_buffer import ReadyBuffer
+
+
+class FakeJobsDB:
+
+    def __init__(self, job_ids):
+        self.jobs = [{'id': job_id, 'priority': 0} for job_id in job_ids]
+        self.queries = 0
+
+    def get_top_priority_jobs(self, fields, job_types=None, limit=None):
+        self.queries += 1
+        if not self.jobs:
+            return []
+        top = max(job['priority'] for job in self.jobs)
+        return [{field: job[field] for field in fields}
+                for job in self.jobs if job['priority'] == top][:limit]
+
+
+class TestReadyBuffer:
+
+    @pytest.fixture
+    def buffer(self):
+        # low_water=0 disables the background refill
+        return ReadyBuffer(size=3, low_water=0, job_fields=['id'])
+
+    def test_pop_refills_empty_buffer_in_bulk(self, buffer):
+        db = FakeJobsDB(['1', '2', '3', '4'])
+        assert [buffer.pop('p', db)['id'] for _ in range(3)] == [
+            '1', '2', '3']
+        assert db.queries == 1
+        stats = buffer.get_stats()['p']
+        assert stats['Hits'] == 2
+        assert stats['Misses'] == 1
+        assert stats['Refills'] == 1
+
+    def test_recently_served_jobs_are_not_buffered_again(self, buffer):
+        db = FakeJobsDB(['1', '2', '3', '4'])
+        for _ in range(3):
+            buffer.pop('p', db)
+        assert buffer.pop('p', db)['id'] == '4'
+
+    def test_served_jobs_are_reused_when_nothing_else_is_left(self, buffer):
+        db = FakeJobsDB(['1'])
+        assert buffer.pop('p', db)['id'] == '1'
+        assert buffer.pop('p', db)['id'] == '1'
+
+    def test_no_jobs(self, buffer):
+        assert buffer.pop('p', FakeJobsDB([])) is None
+        assert buffer.get_stats()['p']['HitRate'] == 0
+
+    def test_stale_candidates(self, buffer):
+        db = FakeJobsDB(['1', '2'])
+        buffer.pop('p', db)
+        buffer.pop('p', db)
+        buffer.report_claim('p', '1', True)
+        buffer.report_claim('p', '2', False)
+        buffer.report_claim('p', 'not_from_buffer', False)
+        stats = buffer.get_stats()['p']
+        assert stats['Claims'] == 2
+        assert stats['StaleRate'] == 0.5
+
+    def test_flush_keeps_stats(self, buffer):
+        db = FakeJobsDB(['1', '2', '3'])
+        buffer.pop('p', db)
+        db.jobs = [{'id': 'urgent', 'priority': 0}]
+        buffer.flush('p')
+        assert buffer.pop('p', db)['id'] == 'urgent'
+        stats = buffer.get_stats()['p']
+        assert stats['Buffered'] == 0
+        assert stats['Refills'] == 2
+
+    def test_refill_drops_jobs_below_the_top_priority(self, buffer):
+        db = FakeJobsDB(['1', '2', '3'])
+        assert buffer.pop('p', db) == {'id': '1'}
+        # Added by another process
+        db.jobs.append({'id': 'urgent', 'priority': 1})
+        buffer._refill('p', buffer._get_buffer('p'), db)
+        assert buffer.pop('p', db) == {'id': 'urgent'}
+        assert buffer.get_stats()['p']['Buffered'] == 0
+
+    def test_clear(self, buffer):
+        buffer.pop('p', FakeJobsDB(['1', '2']))
+        buffer.clear('p')
+        assert buffer.get_stats() == {}
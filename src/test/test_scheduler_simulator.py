@@ -0,0 +1,48 @@
+import pytest
+
+from benchmarks.scheduler_simulator import Simulator, synthesize_trace
+
+
+TRACE = {
+    'Start': '2000-01-01T00:00:00',
+    'Projects': [
+        {'Id': 'early', 'User': 'u1', 'Created': 0, 'Deadline': 150},
+        {'Id': 'late', 'User': 'u2', 'Created': 0, 'Deadline': 1000},
+    ],
+    'Jobs': [
+        {'Project': 'late', 'Id': '1', 'Added': 0, 'ProcessingTime': 100},
+        {'Project': 'early', 'Id': '1', 'Added': 10, 'ProcessingTime': 50},
+        {'Project': 'early', 'Id': '2', 'Added': 10, 'ProcessingTime': 50,
+         'Failed': True},
+    ],
+}
+
+
+class TestSchedulerSimulator:
+
+    def test_deadline_scheduler(self):
+        report = Simulator(TRACE, scheduler='deadline', nr_workers=1).run()
+        assert report['SimulatedTime'] == 200
+        assert report['WorkerIdleTime'] == 0
+        assert report['Utilisation'] == 1
+        early = report['Projects']['early']
+        assert early['Completed'] == 200
+        assert early['CompletionTime'] == 190
+        assert early['MissedDeadline'] is True
+        assert report['Projects']['late']['MissedDeadline'] is False
+        assert report['DeadlineMisses'] == 1
+
+    def test_idle_workers(self):
+        report = Simulator(TRACE, scheduler='prio', nr_workers=3).run()
+        assert report['SimulatedTime'] == 100
+        assert report['WorkerIdleTime'] == pytest.approx(3 * 100 - 200)
+        assert report['DeadlineMisses'] == 0
+
+    @pytest.mark.parametrize('scheduler', ['prio', 'fair-share', 'deadline'])
+    def test_all_jobs_are_processed(self, scheduler):
+        trace = synthesize_trace(
+            nr_projects=5, days=1, jobs_per_project=20, seed=1)
+        report = Simulator(trace, scheduler=scheduler, nr_workers=4,
+                           seed=1).run()
+        assert report['Jobs'] == 100
+        assert sum(p['Jobs'] for p in report['Projects'].values()) == 100
@@ -0,0 +1,124 @@
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytest
+
+from test.fakes import FakeProjectsDB
+from uservice.database import schedulers
+from uservice.database.prio_cache import PrioCache
+
+
+def add_project(db, project, user='u', image=None, **data):
+    db.add_project(project, nr_added=100, created_by_user=user,
+                   processing_image_url=image, **data)
+
+
+def picks(scheduler, db, n):
+    return Counter(scheduler.pick_project(db) for _ in range(n))
+
+
+class TestSchedulers:
+
+    def test_prio(self):
+        db = FakeProjectsDB()
+        add_project(db, 'p1')
+        scheduler = schedulers.PrioScheduler(PrioCache(ttl=60))
+        assert scheduler.pick_project(db) == 'p1'
+        state = scheduler.get_state()
+        assert state['Scheduler'] == 'prio'
+        assert state['Picks'] == {'p1': 1}
+        assert state['Scores'] == {'p1': 1}
+
+    @pytest.mark.parametrize('name', sorted(schedulers.SCHEDULERS))
+    def test_next_candidate_after_drained(self, name):
+        db = FakeProjectsDB()
+        add_project(db, 'p1', deadline=datetime.utcnow())
+        add_project(db, 'p2')
+        scheduler = schedulers.make_scheduler(name, cache=PrioCache(ttl=60))
+        first = scheduler.pick_project(db)
+        scheduler.project_drained(first)
+        second = scheduler.pick_project(db, exclude={first})
+        assert {first, second} == {'p1', 'p2'}
+        scheduler.project_drained(second)
+        assert scheduler.pick_project(db, exclude={first, second}) is None
+
+    def test_fair_share_between_users(self):
+        db = FakeProjectsDB()
+        # u1 has more projects, but both users get the same nr of jobs
+        for i in range(3):
+            add_project(db, 'a%d' % i, user='u1')
+        add_project(db, 'b', user='u2')
+        scheduler = schedulers.FairShareScheduler(
+            PrioCache(ttl=60), quantum=3600)
+        counts = picks(scheduler, db, 100)
+        assert counts['b'] == 50
+        state = scheduler.get_state()
+        assert sorted(state['Queue']) == ['u1', 'u2']
+        assert 'deficit' in state['LastPick']['Reason']
+
+    def test_fair_share_by_processing_time(self):
+        db = FakeProjectsDB()
+        # Jobs of project a take ten times longer than jobs of b
+        add_project(db, 'a', user='u1', processing_time=1000, nr_finished=1)
+        add_project(db, 'b', user='u2', processing_time=100, nr_finished=1)
+        scheduler = schedulers.FairShareScheduler(
+            PrioCache(ttl=60), quantum=1000)
+        counts = picks(scheduler, db, 110)
+        assert counts['a'] == 10
+        assert counts['b'] == 100
+
+    def test_earliest_deadline_first(self):
+        db = FakeProjectsDB()
+        now = datetime.utcnow()
+        add_project(db, 'late', deadline=now + timedelta(days=2))
+        add_project(db, 'early', deadline=now + timedelta(days=1))
+        add_project(db, 'none')
+        scheduler = schedulers.DeadlineScheduler(PrioCache(ttl=60))
+        assert picks(scheduler, db, 10) == {'early': 10}
+        assert 'Earliest deadline' in (
+            scheduler.get_state()['LastPick']['Reason'])
+
+    def test_deadline_starvation_protection(self):
+        db = FakeProjectsDB()
+        add_project(db, 'early', deadline=datetime.utcnow())
+        add_project(db, 'none')
+        times = (datetime(2000, 1, 1) + timedelta(seconds=i)
+                 for i in range(100))
+        scheduler = schedulers.DeadlineScheduler(
+            PrioCache(ttl=60), clock=lambda: next(times), max_wait=1)
+        # Every project waits longer than max_wait, the longest waiting
+        # project is picked.
+        assert picks(scheduler, db, 10) == {'early': 5, 'none': 5}
+        assert 'Not picked for' in (
+            scheduler.get_state()['LastPick']['Reason'])
+
+    @pytest.mark.parametrize('name', sorted(schedulers.SCHEDULERS))
+    def test_image_affinity(self, name):
+        db = FakeProjectsDB()
+        add_project(db, 'p1', deadline=datetime.utcnow(), image='i1')
+        add_project(db, 'p2', image='i2')
+        affinity = schedulers.ImageAffinity(max_boosts=3)
+        scheduler = schedulers.make_scheduler(
+            name, cache=PrioCache(ttl=60), affinity=affinity)
+        picked = [
+            scheduler.pick_project(db, worker='w', images={'i2'})
+            for _ in range(4)]
+        assert picked[:3] == ['p2'] * 3
+        # The fourth pick is without affinity, then affinity is back
+        assert affinity.get_stats()['w']['Boosted'] == 3
+        assert affinity.may_boost('w')
+        # No project with the images
+        assert scheduler.pick_project(
+            db, worker='x', images={'i3'}) in ('p1', 'p2')
+        assert affinity.may_boost('x')
+
+    def test_image_affinity_stats(self):
+        affinity = schedulers.ImageAffinity()
+        affinity.record_fetch('w', {'i1'}, 'i1')
+        affinity.record_fetch('w', {'i1'}, 'i2')
+        assert affinity.get_stats() == {'w': {
+            'Fetches': 2, 'Hits': 1, 'HitRate': 0.5, 'Boosted': 0}}
+
+    def test_unknown_scheduler(self):
+        with pytest.raises(ValueError):
+            schedulers.make_scheduler('unknown')
@@ -3,6 +3,9 @@ import urllib.request
 import urllib.parse
 import urllib.error
 
+import threading
+import time
+
 import pytest
 import requests
 
@@ -108,6 +111,9 @@ class TestAuthentication:
             {'id': '42', 'type': 'test_type', 'source_url': TEST_URL},
         )
         assert status_code == 201, status_code
+        # Only claimed jobs accept status updates
+        r = apiwithworker.claim_next_job()
+        assert r.status_code == 200, r.text
         return apiwithworker
 
     def test_user_password_authentication(self, myapi):
@@ -180,6 +186,318 @@ class TestFetchJob:
         }
 
 
+@pytest.mark.system
+class TestClaimNextJob:
+
+    def _get_nr_claimed(self, api):
+        r = api.get_project()
+        r.raise_for_status()
+        return r.json()['NrJobsClaimed']
+
+    def test_claim_next_job(self, apiwithproject):
+        """Test fetching and claiming a job in one request"""
+        api = apiwithproject
+        r = api.claim_next_job()
+        r.raise_for_status()
+        joburl = "{}/42".format(api.get_jobs_url())
+        assert r.json()["Job"] == {
+            u'JobID': u'42',
+            u'Environment': {},
+            u'URLS': {
+                u'URL-image': None,
+                u'URL-source': TEST_URL,
+                u'URL-target': TEST_URL,
+                u'URL-claim': u'{}/claim'.format(joburl),
+                u'URL-output': u'{}/output'.format(joburl),
+                u'URL-status': u'{}/status'.format(joburl),
+            },
+        }
+        assert self._get_nr_claimed(api) == 1
+
+        r = requests.get("{}/claim".format(joburl))
+        r.raise_for_status()
+        assert r.json()['Claimed'] is True
+        assert r.json()['ClaimedByWorker'] == api.username
+
+        # No more unclaimed jobs
+        r = api.claim_next_job()
+        assert r.status_code == 404
+        assert self._get_nr_claimed(api) == 1
+
+    def test_claim_next_job_of_type(self, apiwithproject):
+        """Test that only jobs of the requested type are claimed"""
+        api = apiwithproject
+        r = api.claim_next_job(options="type=other_type")
+        assert r.status_code == 404
+        r = api.claim_next_job(options="type=test_type")
+        r.raise_for_status()
+        assert r.json()['Job']['JobID'] == '42'
+
+    def test_claim_next_job_bad_request(self, apiwithproject):
+        url = "{}/claim-next".format(apiwithproject.get_jobs_url())
+        r = requests.put(url, json={}, auth=apiwithproject.auth)
+        assert r.status_code == 400
+        r = requests.put(url, json={'Worker': 'w'})
+        assert r.status_code == 401
+
+
+@pytest.mark.system
+class TestClaimJobs:
+
+    def test_claim_jobs(self, apiwithjobs):
+        """Test claiming a batch of jobs"""
+        api = apiwithjobs
+        for job_id in ['5', '6']:
+            status = api.insert_job({'id': job_id, 'source_url': TEST_URL})
+            assert status == 201
+
+        r = api.claim_jobs(2)
+        r.raise_for_status()
+        jobs = r.json()['Jobs']
+        assert len(jobs) == 2
+        assert {job['JobID'] for job in jobs} <= {'4', '5', '6'}
+        r = api.get_project()
+        r.raise_for_status()
+        assert r.json()['NrJobsClaimed'] == 5
+
+        # Only one job left
+        r = api.claim_jobs(2)
+        r.raise_for_status()
+        assert len(r.json()['Jobs']) == 1
+
+        r = api.claim_jobs(2)
+        assert r.status_code == 404
+
+    def test_claim_jobs_bad_count(self, apiwithproject):
+        for count in [0, -1, 'a', 1000]:
+            r = apiwithproject.claim_jobs(count)
+            assert r.status_code == 400
+
+
+@pytest.mark.system
+class TestJobLeases:
+
+    def _claim(self, api, lease_time):
+        url = "{}/42/claim".format(api.get_jobs_url())
+        return requests.put(
+            url, json={'Worker': api.username, 'LeaseTime': lease_time},
+            auth=api.auth,
+        )
+
+    def _get_claim(self, api):
+        r = requests.get("{}/42/claim".format(api.get_jobs_url()))
+        r.raise_for_status()
+        return r.json()
+
+    def test_expired_lease_is_requeued(self, apiwithproject):
+        api = apiwithproject
+        r = self._claim(api, 1)
+        r.raise_for_status()
+        assert self._get_claim(api)['LeaseExpires'] is not None
+        time.sleep(1.5)
+
+        r = api.reap_leases()
+        r.raise_for_status()
+        assert r.json()['Requeued'].get('project') == 1
+        claim = self._get_claim(api)
+        assert claim['Claimed'] is False
+        assert claim['LeaseExpires'] is None
+        r = api.get_project()
+        r.raise_for_status()
+        assert r.json()['NrJobsClaimed'] == 0
+
+        # The lease is lost
+        r = api.heartbeat('42', lease_time=60)
+        assert r.status_code == 409
+        r = api.put_job_status('42', {'Status': 'FINISHED'})
+        assert r.status_code == 409
+
+    def test_heartbeat_extends_lease(self, apiwithproject):
+        api = apiwithproject
+        r = self._claim(api, 1)
+        r.raise_for_status()
+        r = api.heartbeat('42', lease_time=60)
+        r.raise_for_status()
+        assert r.json()['LeaseExpires'] == self._get_claim(api)[
+            'LeaseExpires']
+        time.sleep(1.5)
+
+        r = api.reap_leases()
+        r.raise_for_status()
+        assert 'project' not in r.json()['Requeued']
+        assert self._get_claim(api)['Claimed'] is True
+
+    def test_heartbeat_errors(self, apiwithproject):
+        api = apiwithproject
+        assert api.heartbeat('42', lease_time=60).status_code == 409
+        assert api.heartbeat('none', lease_time=60).status_code == 404
+        r = self._claim(api, 60)
+        r.raise_for_status()
+        assert api.heartbeat(
+            '42', worker='other', lease_time=60).status_code == 409
+        assert api.heartbeat('42', lease_time=-1).status_code == 400
+        # No default lease time
+        assert api.heartbeat('42').status_code == 400
+
+        # Done jobs have no lease
+        r = api.put_job_status('42', {'Status': 'FINISHED'})
+        r.raise_for_status()
+        assert self._get_claim(api)['LeaseExpires'] is None
+        assert api.heartbeat('42', lease_time=60).status_code == 409
+
+    def test_no_lease_by_default(self, apiwithproject):
+        api = apiwithproject
+        r = api.claim_next_job()
+        r.raise_for_status()
+        assert self._get_claim(api)['LeaseExpires'] is None
+
+    def test_bad_lease_time(self, apiwithproject):
+        for lease_time in [0, -1, 'a', 10 ** 9]:
+            r = self._claim(apiwithproject, lease_time)
+            assert r.status_code == 400
+
+
+@pytest.mark.system
+class TestCounterReconciliation:
+
+    def test_counters_match_jobs(self, apiwithproject):
+        api = apiwithproject
+        url = "{}/42/claim".format(api.get_jobs_url())
+        r = requests.put(url, json={'Worker': api.username}, auth=api.auth)
+        r.raise_for_status()
+        # Release of a job that is not done
+        r = requests.delete(url, auth=api.auth)
+        r.raise_for_status()
+        project = api.get_project().json()
+        assert project['NrJobsClaimed'] == 0
+        assert project['NrJobsFinished'] == 0
+
+        r = api.reconcile_counters()
+        r.raise_for_status()
+        assert r.json()['Corrected'] == {}
+
+
+@pytest.mark.system
+class TestTypedFetch:
+
+    @pytest.fixture
+    def apiwithtypes(self, apiwithworker):
+        for job_id, job_type in [('1', 'a'), ('2', 'b'), ('3', 'b')]:
+            job = {'id': job_id, 'source_url': TEST_URL, 'type': job_type}
+            assert apiwithworker.insert_job(job) == 201
+        job = {'id': 'c1', 'source_url': TEST_URL, 'type': 'c'}
+        assert apiwithworker.insert_job(job, project='other') == 201
+        return apiwithworker
+
+    def test_fetch_job_of_type(self, apiwithtypes):
+        api = apiwithtypes
+        r = api.fetch_project_job(options="type=a")
+        r.raise_for_status()
+        assert r.json()['Job']['JobID'] == '1'
+        r = api.fetch_project_job(options="type=x,b")
+        r.raise_for_status()
+        assert r.json()['Job']['JobID'] in ('2', '3')
+        r = api.fetch_project_job(options="type=x&type=a")
+        r.raise_for_status()
+        assert r.json()['Job']['JobID'] == '1'
+        r = api.fetch_project_job(options="type=x")
+        assert r.status_code == 404
+
+    def test_prio_fetch_job_of_type(self, apiwithtypes):
+        api = apiwithtypes
+        for _ in range(5):
+            r = api.fetch_job(options="type=c")
+            r.raise_for_status()
+            assert r.json()['Project'] == 'other'
+            assert r.json()['Job']['JobID'] == 'c1'
+        r = api.fetch_job(options="type=x")
+        assert r.status_code == 404
+
+        # Projects without unclaimed jobs of the types are not selected
+        r = api.claim_next_job(options="type=c", project='other')
+        r.raise_for_status()
+        r = api.fetch_job(options="type=c")
+        assert r.status_code == 404
+        r = api.fetch_job(options="type=a,c")
+        r.raise_for_status()
+        assert r.json()['Job']['JobID'] == '1'
+
+    def test_claim_jobs_of_types(self, apiwithtypes):
+        r = apiwithtypes.claim_jobs(3, options="type=b")
+        r.raise_for_status()
+        assert {job['JobID'] for job in r.json()['Jobs']} == {'2', '3'}
+
+
+@pytest.mark.system
+class TestFetchStrategies:
+
+    @pytest.mark.parametrize('strategy', [
+        'buffer', 'window', 'random-keyset', 'partition', 'rotating'])
+    def test_fetch_with_strategy(self, apiwithjobs, strategy):
+        api = apiwithjobs
+        r = api.put_project(json={'fetch_strategy': strategy})
+        assert r.status_code == 204
+        assert get_project(api)['FetchStrategy'] == strategy
+        r = api.fetch_project_job(options="worker=w1")
+        r.raise_for_status()
+        job = r.json()['Job']
+        assert job['JobID'] == '4'
+        r = requests.put(
+            job['URLS']['URL-claim'], json={'Worker': 'w1'}, auth=api.auth)
+        r.raise_for_status()
+        r = api.fetch_project_job(options="worker=w1")
+        assert r.status_code == 404
+
+        r = requests.get(
+            '{}/fetch-strategies'.format(api._adminroot),
+            auth=api.admin_auth)
+        r.raise_for_status()
+        # The stats are kept per server process
+        assert strategy in r.json()['Strategies']
+
+    def test_unknown_strategy(self, apiwithjobs):
+        r = apiwithjobs.put_project(json={'fetch_strategy': 'unknown'})
+        assert r.status_code == 400
+
+
+@pytest.mark.system
+class TestLongPollFetch:
+
+    def test_fetch_waits_for_timeout(self, apiwithworker):
+        r = apiwithworker.put_project()
+        assert r.status_code == 201
+        t0 = time.monotonic()
+        r = apiwithworker.fetch_project_job(options="wait=1")
+        assert r.status_code == 404
+        assert time.monotonic() - t0 >= 1
+
+    def test_fetch_is_woken_by_new_job(self, apiwithworker):
+        r = apiwithworker.put_project()
+        assert r.status_code == 201
+        timer = threading.Timer(
+            0.5, apiwithworker.insert_job,
+            args=({'id': '42', 'source_url': TEST_URL},))
+        timer.start()
+        r = apiwithworker.fetch_project_job(options="wait=10")
+        timer.join()
+        r.raise_for_status()
+        assert r.json()['Job']['JobID'] == '42'
+
+    def test_prio_fetch_is_woken_by_new_job(self, apiwithworker):
+        timer = threading.Timer(
+            0.5, apiwithworker.insert_job,
+            args=({'id': '42', 'source_url': TEST_URL},))
+        timer.start()
+        r = apiwithworker.fetch_job(options="wait=10")
+        timer.join()
+        r.raise_for_status()
+
+    def test_bad_wait_time(self, apiwithworker):
+        for wait in ['a', '-1', 'nan']:
+            r = apiwithworker.fetch_job(options="wait=" + wait)
+            assert r.status_code == 400
+
+
 @pytest.mark.system
 class TestListJobs:
 
@@ -268,6 +586,7 @@ class TestListJobs:
             'Finished': None,
             'ProcessingTime': None,
             'Worker': None,
+            'Priority': 0,
             'URLS': {
                 'URL-Input': TEST_URL + '/source',
                 'URL-Output': '{}/1/output'.format(myapi.get_jobs_url()),
@@ -486,6 +805,31 @@ class TestProjectsPrio:
         assert project_count['project'] > 0
         assert project_count['myproject'] > project_count['project']
 
+    def test_weight_and_pause(self, apiwithjobs):
+        """Test that the prio score is weighted and that paused projects
+        are not fetched"""
+        api = apiwithjobs
+        r = api.put_project(json={'deadline': None, 'weight': 2.5})
+        assert r.status_code == 204
+        assert get_project(api)['PrioScore'] == 2.5
+
+        r = api.put_project(json={'paused': True})
+        assert r.status_code == 204
+        project = get_project(api)
+        assert project['Paused'] is True
+        assert project['PrioScore'] == 0
+        r = api.fetch_job('fresh=1')
+        assert r.status_code == 404
+
+        r = api.put_project(json={'paused': False})
+        assert r.status_code == 204
+        r = api.fetch_job('fresh=1')
+        r.raise_for_status()
+        assert r.json()['Project'] == 'project'
+
+        for data in [{'weight': 0}, {'weight': 'a'}, {'paused': 'yes'}]:
+            assert api.put_project(json=data).status_code == 400
+
 
 @pytest.mark.system
 class TestUpdateProject:
@@ -512,6 +856,9 @@ class TestUpdateProject:
             u'NrJobsFinished': 0,
             u'NrJobsFailed': 0,
             u'TotalProcessingTime': 0.0,
+            u'FetchStrategy': None,
+            u'Weight': 1.0,
+            u'Paused': False,
             u'PrioScore': 0.0,
             u'URLS': {
                 u'URL-Status': apiwithworker.get_project_url('myproject'),
@@ -545,6 +892,9 @@ class TestUpdateProject:
             u'NrJobsFinished': 0,
             u'NrJobsFailed': 0,
             u'TotalProcessingTime': 0.0,
+            u'FetchStrategy': None,
+            u'Weight': 1.0,
+            u'Paused': False,
             u'PrioScore': 0.0,
             u'URLS': {
                 u'URL-Status': apiwithworker.get_project_url('myproject'),
@@ -581,6 +931,27 @@ class TestJobViews:
             json={"Status": "Testing status update."},
             auth=api.auth,
         )
+        # The job is not claimed
+        assert r.status_code == 409
+
+        r = requests.put(
+            job["Job"]["URLS"]["URL-claim"],
+            json={"Worker": api.username},
+            auth=api.auth,
+        )
+        r.raise_for_status()
+        r = requests.put(
+            job["Job"]["URLS"]["URL-status"],
+            json={"Status": "Testing status update.", "Worker": "other"},
+            auth=api.auth,
+        )
+        assert r.status_code == 409
+        r = requests.put(
+            job["Job"]["URLS"]["URL-status"],
+            json={"Status": "Testing status update.",
+                  "Worker": api.username},
+            auth=api.auth,
+        )
         r.raise_for_status()
 
         # Fetch current status
@@ -588,6 +959,27 @@ class TestJobViews:
         r.raise_for_status()
         assert r.json()['Status'] == "Testing status update."
 
+    def test_repeated_done_status(self, apiwithproject):
+        """Test that a resent done status is only counted once and that
+        done jobs keep their status.
+        """
+        api = apiwithproject
+        r = api.claim_next_job()
+        r.raise_for_status()
+        for _ in range(2):
+            r = api.put_job_status(
+                '42', {'Status': 'FINISHED', 'ProcessingTime': 10})
+            r.raise_for_status()
+        r = api.get_project()
+        r.raise_for_status()
+        assert r.json()['NrJobsFinished'] == 1
+        assert r.json()['TotalProcessingTime'] == 10
+
+        r = api.put_job_status('42', {'Status': 'FAILED'})
+        assert r.status_code == 409
+        r = api.put_job_status('none', {'Status': 'FINISHED'})
+        assert r.status_code == 404
+
     def test_get_nonexisting_job_status(self, apiwithproject):
         # Test fetch for none-existing job
         r = apiwithproject.fetch_specific_job(job='none')
@@ -888,6 +1280,9 @@ class TestProjectViews:
             u'Deadline': None,
             u'PrioScore': None,
             u'TotalProcessingTime': 800.0,
+            u'FetchStrategy': None,
+            u'Weight': 1.0,
+            u'Paused': False,
             u'JobStates': {u'Available': 1, u'Failed': 1, u'Finished': 2},
             u'URLS': {
                 u'URL-DailyCount':
@@ -0,0 +1,71 @@
+import random
+
+from uservice.database.projects import ProjectsDB
+from uservice.utils.weighted_sampler import WeightedSampler
+
+
+def linear_find(scores, value):
+    """The cumulative walk of ProjectsDB.weighted_choice"""
+    upto = 0
+    for project, score in scores:
+        if upto + score >= value:
+            return project
+        upto += score
+
+
+class TestWeightedSampler:
+
+    def test_equivalent_to_linear_walk(self):
+        rng = random.Random(13)
+        for n in [1, 2, 7, 64, 100]:
+            scores = [('p%d' % i, rng.choice([0, rng.randint(1, 100)]))
+                      for i in range(n)]
+            if not any(score for _, score in scores):
+                scores[0] = ('p0', 1)
+            sampler = WeightedSampler(scores)
+            total = sum(score for _, score in scores)
+            assert sampler.total == total
+            for _ in range(200):
+                value = rng.uniform(0, total)
+                assert sampler.find(value) == linear_find(scores, value)
+
+    def test_updates_are_equivalent_to_rebuild(self):
+        rng = random.Random(14)
+        sampler = WeightedSampler()
+        scores = {}
+        for _ in range(500):
+            key = 'p%d' % rng.randint(0, 40)
+            if rng.random() < .2:
+                sampler.remove(key)
+                scores.pop(key, None)
+            else:
+                scores[key] = rng.randint(0, 50)
+                sampler.set(key, scores[key])
+        assert len(sampler) == len(scores)
+        rebuilt = WeightedSampler(scores.items())
+        assert sampler.total == rebuilt.total
+        for key, score in scores.items():
+            assert sampler.get(key) == score
+        for _ in range(200):
+            value = rng.uniform(0, sampler.total)
+            picked = sampler.find(value)
+            assert scores[picked] > 0
+
+    def test_sample_distribution(self):
+        random.seed(15)
+        sampler = WeightedSampler([('a', 1), ('b', 0), ('c', 3)])
+        picks = [sampler.sample() for _ in range(4000)]
+        assert picks.count('b') == 0
+        assert 0.7 < picks.count('c') / float(len(picks)) < 0.8
+        random.seed(15)
+        linear = [ProjectsDB.weighted_choice([('a', 1), ('b', 0), ('c', 3)])
+                  for _ in range(4000)]
+        assert picks == linear
+
+    def test_empty(self):
+        sampler = WeightedSampler()
+        assert sampler.sample() is None
+        sampler.set('a', 0)
+        assert sampler.sample() is None
+        sampler.remove('a')
+        assert len(sampler) == 0
@@ -180,12 +180,48 @@ class ApiSession:
             auth=self.auth,
         )
 
-    def fetch_job(self):
-        return requests.get(
-            "{}/projects/jobs/fetch".format(self._apiroot),
+    def claim_next_job(self, worker=None, options=None, project=None):
+        url = "{}/claim-next".format(self.get_jobs_url(project))
+        if options:
+            url = "{}?{}".format(url, options)
+        return requests.put(
+            url, json={'Worker': worker or self.username}, auth=self.auth,
+        )
+
+    def claim_jobs(self, count, worker=None, options=None, project=None):
+        url = "{}/claim-batch".format(self.get_jobs_url(project))
+        if options:
+            url = "{}?{}".format(url, options)
+        return requests.put(
+            url, json={'Worker': worker or self.username, 'Count': count},
             auth=self.auth,
         )
 
+    def heartbeat(self, job, worker=None, lease_time=None, project=None):
+        url = "{}/{}/heartbeat".format(self.get_jobs_url(project), job)
+        data = {'Worker': worker or self.username}
+        if lease_time is not None:
+            data['LeaseTime'] = lease_time
+        return requests.put(url, json=data, auth=self.auth)
+
+    def reap_leases(self):
+        return requests.post(
+            "{}/reap-leases".format(self._adminroot),
+            auth=(self._adminuser, self._adminpw),
+        )
+
+    def reconcile_counters(self):
+        return requests.post(
+            "{}/reconcile-counters".format(self._adminroot),
+            auth=(self._adminuser, self._adminpw),
+        )
+
+    def fetch_job(self, options=None):
+        url = "{}/projects/jobs/fetch".format(self._apiroot)
+        if options:
+            url = "{}?{}".format(url, options)
+        return requests.get(url, auth=self.auth)
+
     def put_job_status(self, job, status, project=None, auth=None):
         if auth is None:
             auth = self.auth
@@ -3,12 +3,22 @@ from os import environ
 from flask import Flask, g, request, abort, jsonify, url_for, make_response
 from werkzeug.exceptions import HTTPException
 
+from uservice.core.counter_reconciler import counter_reconciler
+from uservice.core.importer import importer
+from uservice.core.lease_reaper import lease_reaper
 from uservice.core.users import User, auth, db
+from uservice.database.fetch_strategies import fetch_strategies
+from uservice.database.prio_cache import prio_cache
+from uservice.database.ready_buffer import ready_buffer
+from uservice.database.schedulers import (
+    image_affinity, scheduler, SCHEDULERS)
 from uservice.views.basic_views import (
     ListProjects, CountJobs, FetchNextJob, BasicView, FetchJobPrio,
-    AnalyzeFailedJobs)
-from uservice.views.listjobs import ListJobs
-from uservice.views.job_views import JobClaim, JobStatus, JobOutput
+    AnalyzeFailedJobs, ClaimNextJob, ClaimJobs)
+from uservice.views.import_views import ListImports, ImportStatus
+from uservice.views.listjobs import ListJobs, JobPriorities
+from uservice.views.job_views import (
+    JobClaim, JobStatus, JobOutput, JobHeartbeat)
 from uservice.views.project_views import ProjectStatus
 from uservice.views.site_views import (
     JobStatusHumanReadable,
@@ -92,6 +102,18 @@ class JobServer(Flask):
             view_func=ListJobs.as_view('listjobs'),
             methods=["GET", "POST"]
             )
+        self.add_url_rule(
+            # GET list of imports, POST to add jobs in the background.
+            '/rest_api/<version>/<project>/imports',
+            view_func=ListImports.as_view('listimports'),
+            methods=["GET", "POST"]
+            )
+        self.add_url_rule(
+            # GET progress of an import
+            '/rest_api/<version>/<project>/imports/<import_id>',
+            view_func=ImportStatus.as_view('importstatus'),
+            methods=["GET"]
+            )
         self.add_url_rule(
             # GET processing output analyzation for failed jobs.
             '/rest_api/<version>/<project>/failures',
@@ -104,12 +126,30 @@ class JobServer(Flask):
             view_func=CountJobs.as_view('countjobs'),
             methods=["GET"]
             )
+        self.add_url_rule(
+            # PUT to set the priority of many jobs
+            '/rest_api/<version>/<project>/jobs/priority',
+            view_func=JobPriorities.as_view('jobpriorities'),
+            methods=["PUT"]
+            )
         self.add_url_rule(
             # GET next job URI etc.
             '/rest_api/<version>/<project>/jobs/fetch',
             view_func=FetchNextJob.as_view('fetchnextjob'),
             methods=["GET"]
             )
+        self.add_url_rule(
+            # PUT to claim the next job and get its URIs etc.
+            '/rest_api/<version>/<project>/jobs/claim-next',
+            view_func=ClaimNextJob.as_view('claimnextjob'),
+            methods=["PUT"]
+            )
+        self.add_url_rule(
+            # PUT to claim a batch of jobs and get their URIs etc.
+            '/rest_api/<version>/<project>/jobs/claim-batch',
+            view_func=ClaimJobs.as_view('claimjobs'),
+            methods=["PUT"]
+            )
         self.add_url_rule(
             # GET and PUT job status
             '/rest_api/<version>/<project>/jobs/<job_id>/status',
@@ -122,6 +162,12 @@ class JobServer(Flask):
             view_func=JobClaim.as_view('jobclaim'),
             methods=["GET", "PUT", "DELETE"]
             )
+        self.add_url_rule(
+            # PUT to extend the lease of a claimed job
+            '/rest_api/<version>/<project>/jobs/<job_id>/heartbeat',
+            view_func=JobHeartbeat.as_view('jobheartbeat'),
+            methods=["PUT"]
+            )
         self.add_url_rule(
             # GET and PUT job stdout/stderr output
             '/rest_api/<version>/<project>/jobs/<job_id>/output',
@@ -136,10 +182,11 @@ app.config['SECRET_KEY'] = 'verklig nytta av min hermodskurs i mord'
 app.config['SQLALCHEMY_DATABASE_URI'] = environ['USERVICE_DATABASE_URI']
 app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_POOL_SIZE'] = 30
-app.config['SQLALCHEMY_MAX_OVERFLOW'] = 0
-app.config['SQLALCHEMY_POOL_TIMEOUT'] = 180
-app.config['SQLALCHEMY_POOL_RECYCLE'] = 600
+if not environ['USERVICE_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_POOL_SIZE'] = 30
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = 0
+    app.config['SQLALCHEMY_POOL_TIMEOUT'] = 180
+    app.config['SQLALCHEMY_POOL_RECYCLE'] = 600
 
 
 # extensions
@@ -181,6 +228,9 @@ class LazyInitDB:
 
 
 app.before_request(LazyInitDB())
+app.before_request(lease_reaper.start)
+app.before_request(counter_reconciler.start)
+app.before_request(importer.start)
 
 
 @app.teardown_appcontext
@@ -250,6 +300,69 @@ def delete_user(uid):
     return '', 204
 
 
+@app.route('/rest_api/admin/ready-buffer')
+@auth.login_required
+def get_ready_buffer_stats():
+    if g.user.username != environ['USERVICE_ADMIN_USER']:
+        abort(403)
+    return jsonify({'Projects': ready_buffer.get_stats()})
+
+
+@app.route('/rest_api/admin/fetch-strategies')
+@auth.login_required
+def get_fetch_strategy_stats():
+    if g.user.username != environ['USERVICE_ADMIN_USER']:
+        abort(403)
+    return jsonify({
+        'Default': fetch_strategies.default,
+        'Strategies': sorted(fetch_strategies.strategies),
+        'Projects': fetch_strategies.get_stats()})
+
+
+@app.route('/rest_api/admin/prio-cache')
+@auth.login_required
+def get_prio_cache_stats():
+    if g.user.username != environ['USERVICE_ADMIN_USER']:
+        abort(403)
+    return jsonify(prio_cache.get_stats())
+
+
+@app.route('/rest_api/admin/scheduler')
+@auth.login_required
+def get_scheduler_state():
+    if g.user.username != environ['USERVICE_ADMIN_USER']:
+        abort(403)
+    return jsonify({
+        'Schedulers': sorted(SCHEDULERS),
+        'State': scheduler.get_state()})
+
+
+@app.route('/rest_api/admin/image-affinity')
+@auth.login_required
+def get_image_affinity_stats():
+    if g.user.username != environ['USERVICE_ADMIN_USER']:
+        abort(403)
+    return jsonify({
+        'MaxBoosts': image_affinity.max_boosts,
+        'Workers': image_affinity.get_stats()})
+
+
+@app.route('/rest_api/admin/reap-leases', methods=['POST'])
+@auth.login_required
+def reap_leases():
+    if g.user.username != environ['USERVICE_ADMIN_USER']:
+        abort(403)
+    return jsonify({'Requeued': lease_reaper.reap()})
+
+
+@app.route('/rest_api/admin/reconcile-counters', methods=['POST'])
+@auth.login_required
+def reconcile_counters():
+    if g.user.username != environ['USERVICE_ADMIN_USER']:
+        abort(403)
+    return jsonify({'Corrected': counter_reconciler.reconcile(full=True)})
+
+
 @app.route('/rest_api/token')
 @auth.login_required
 def get_auth_token():
@@ -0,0 +1,176 @@
+"""Correct drifted job counters of the projects from the jobs tables"""
+import threading
+import time
+from datetime import datetime, timedelta
+from os import environ
+
+from ..database.projects import ProjectsDB
+from ..database.sqldb import SqlJobDatabase
+from ..utils.logs import get_logger
+from .notifier import notifier
+
+
+class CounterReconciler:
+    """Periodically recount the jobs of the projects and correct the
+    counters of the projects and their job types.
+
+    Recounting all projects in every pass would scan all jobs tables, so
+    a pass only recounts the projects that have changed since they were
+    last verified. A project has changed when its watermark has moved: the
+    latest timestamps of its jobs, which are read from their indexes, and
+    its counters. A changed project is recounted at most every
+    min_interval seconds, and at most max_projects projects, those that
+    have waited longest, are recounted per pass. Drift that does not move
+    the watermark is found by recounting every project at least every
+    full_interval seconds. Waiting jobs whose parents have finished
+    without releasing them are released before a project is recounted, see
+    SqlJobDatabase.release_stranded_jobs.
+
+    The watermark only decides when a project is recounted, a recount
+    always counts all jobs of the project, see SqlJobDatabase.get_counts.
+    Counting only the jobs past the watermark into running counts would
+    miss the claims, releases, status changes and deletions of older jobs,
+    which are exactly where the counters drift. A project whose jobs are
+    claimed or done continuously is thus recounted every min_interval
+    seconds, from the indexes of its jobs table, so raise min_interval to
+    bound the load of large busy projects.
+
+    Every process runs its own reconciler thread, see LeaseReaper.
+    """
+
+    def __init__(self, interval=60, min_interval=300, full_interval=86400,
+                 max_projects=20, get_jobs_db=SqlJobDatabase):
+        """
+        Args:
+           interval (float): Seconds between passes.
+           min_interval (float): Min seconds between recounts of a project.
+           full_interval (float): Max seconds between recounts of a
+             project.
+           max_projects (int): Max nr of projects to recount per pass.
+           get_jobs_db (callable): Returns the jobs database of a project.
+        """
+        self.interval = interval
+        self.min_interval = timedelta(seconds=min_interval)
+        self.full_interval = timedelta(seconds=full_interval)
+        self.max_projects = max_projects
+        self.get_jobs_db = get_jobs_db
+        self._lock = threading.Lock()
+        self._thread = None
+        # Project -> (watermark, time) of the last recount
+        self._verified = {}
+        # Project -> jobs database, see LeaseReaper
+        self._jobs_dbs = {}
+
+    def start(self):
+        """Start the reconciler thread if it is not already running"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            projects_db = ProjectsDB()
+            try:
+                self.reconcile(projects_db=projects_db)
+            except Exception:
+                get_logger('UService', to_stdout=True).exception(
+                    "Reconciliation of job counters failed")
+            finally:
+                projects_db.db.session.remove()
+
+    def reconcile(self, now=None, projects_db=None, full=False):
+        """Recount the changed projects and correct their counters.
+
+        Args:
+           now (datetime): Default is datetime.utcnow().
+           projects_db (ProjectsDB): The projects database.
+           full (bool): Recount all projects.
+        Returns:
+           dict: Project -> corrections, see
+             ProjectsDB.reconcile_counters. Projects without drift are
+             left out.
+        """
+        now = now or datetime.utcnow()
+        projects_db = projects_db or ProjectsDB()
+        projects = {
+            project['id']: project for project in projects_db.get_projects(
+                fields=['id'] + ProjectsDB.COUNTERS)}
+        with self._lock:
+            for project in set(self._verified) - set(projects):
+                del self._verified[project]
+        self._jobs_dbs = {
+            project: jobs_db for project, jobs_db in self._jobs_dbs.items()
+            if project in projects}
+
+        due = []
+        for project_id, project in projects.items():
+            jobs_db = self._get_jobs_db(project_id)
+            watermark = self._get_watermark(jobs_db, project)
+            verified = self._verified.get(project_id)
+            if full or verified is None:
+                due.append((datetime.min, project_id, watermark))
+                continue
+            last_watermark, last_time = verified
+            if now - last_time >= self.full_interval or (
+                    watermark != last_watermark and
+                    now - last_time >= self.min_interval):
+                due.append((last_time, project_id, watermark))
+        due.sort()
+        if not full:
+            due = due[:self.max_projects]
+
+        corrected = {}
+        for _, project_id, watermark in due:
+            jobs_db = self._get_jobs_db(project_id)
+            with jobs_db.db.transaction():
+                # Reconcilers of other processes wait here until the
+                # corrected counters are committed
+                if not projects_db.lock_project(project_id):
+                    continue
+                released = jobs_db.release_stranded_jobs(projects_db)
+                counts = jobs_db.get_counts()
+                corrections = projects_db.reconcile_counters(
+                    project_id, counts)
+            with self._lock:
+                # The counters are now the counts, unless they were
+                # updated by someone else, which moves the watermark.
+                self._verified[project_id] = (
+                    (watermark[0], self._counters(counts)), now)
+            if released:
+                get_logger('UService', to_stdout=True).warning(
+                    "Released {0} stranded dependencies in project "
+                    "{1}".format(released, project_id))
+            if corrections:
+                corrected[project_id] = corrections
+                notifier.notify(project_id)
+                get_logger('UService', to_stdout=True).warning(
+                    "Corrected job counters of project {0}: {1}".format(
+                        project_id, corrections))
+        return corrected
+
+    def _get_jobs_db(self, project):
+        if project not in self._jobs_dbs:
+            self._jobs_dbs[project] = self.get_jobs_db(project)
+        return self._jobs_dbs[project]
+
+    def _get_watermark(self, jobs_db, project):
+        return (jobs_db.get_watermark(), self._counters(project))
+
+    @staticmethod
+    def _counters(counts):
+        # Rounded, the processing time is a sum of floats
+        return tuple(
+            round(counts[field] or 0, 3) for field in ProjectsDB.COUNTERS)
+
+
+counter_reconciler = CounterReconciler(
+    interval=float(environ.get('USERVICE_RECONCILER_INTERVAL', 60)),
+    min_interval=float(environ.get('USERVICE_RECONCILER_MIN_INTERVAL', 300)),
+    full_interval=float(
+        environ.get('USERVICE_RECONCILER_FULL_INTERVAL', 86400)))
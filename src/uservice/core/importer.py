@@ -0,0 +1,157 @@
+"""Insert the jobs of imports in the background"""
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+from os import environ
+
+from ..database.basedb import DBError, DBConflictError
+from ..database.imports import ImportsDB
+from ..database.projects import ProjectsDB
+from ..database.ready_buffer import ready_buffer
+from ..database.sqldb import SqlJobDatabase
+from ..utils.defs import IMPORT_STATES
+from ..utils.logs import get_logger
+from ..views.listjobs import count_added_jobs, parse_json_jobs
+from .notifier import notifier
+
+
+class Importer:
+    """Insert the jobs of queued imports, one chunk per transaction.
+
+    Every process runs its own importer thread (a greenlet under the
+    gevent workers) and an import is run by one process at a time. The
+    importer updates the heartbeat of the import after every chunk, an
+    import without heartbeat for stale_after seconds is taken over by
+    another process, e.g. after a restart. A chunk is deleted in the same
+    transaction as its jobs are inserted, so it is inserted only once.
+    """
+
+    def __init__(self, interval=10, stale_after=300,
+                 get_jobs_db=SqlJobDatabase, clock=datetime.utcnow):
+        """
+        Args:
+           interval (float): Seconds between looks for imports to run.
+           stale_after (float): Seconds without heartbeat before a running
+             import is taken over.
+           get_jobs_db (callable): Return the jobs database of a project.
+           clock (callable): Return the current time.
+        """
+        self.interval = interval
+        self.stale_after = stale_after
+        self.get_jobs_db = get_jobs_db
+        self.clock = clock
+        self.owner = '{}-{}'.format(os.getpid(), uuid.uuid4().hex[:16])
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Start the importer thread if it is not already running"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def wake(self):
+        """Look for imports now instead of after the interval"""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            imports_db = ImportsDB()
+            projects_db = ProjectsDB()
+            try:
+                while self.run_next(
+                        imports_db=imports_db, projects_db=projects_db):
+                    pass
+            except Exception:
+                get_logger('UService', to_stdout=True).exception(
+                    "Import of jobs failed")
+            finally:
+                imports_db.db.session.remove()
+
+    def run_next(self, imports_db=None, projects_db=None):
+        """Take an import and insert all its jobs.
+
+        Returns:
+           str: Id of the import, None if there was nothing to import.
+        """
+        imports_db = imports_db or ImportsDB()
+        projects_db = projects_db or ProjectsDB()
+        now = self.clock()
+        import_data = imports_db.take_import(
+            self.owner, now, now - timedelta(seconds=self.stale_after))
+        if not import_data:
+            return None
+        error = None
+        try:
+            self._insert_chunks(import_data, imports_db, projects_db)
+            status = IMPORT_STATES.done
+        except Exception as exc:
+            get_logger('UService', to_stdout=True).exception(
+                "Import {} failed".format(import_data['id']))
+            status = IMPORT_STATES.failed
+            error = 'Import failed: {}'.format(exc)
+        imports_db.finish_import(
+            import_data['id'], self.owner, self.clock(), status, error=error)
+        return import_data['id']
+
+    def _insert_chunks(self, import_data, imports_db, projects_db):
+        project = import_data['project_id']
+        if not projects_db.project_exists(project):
+            raise DBError('Project {} does not exist'.format(project))
+        jobs_db = self.get_jobs_db(project)
+        while True:
+            chunk = imports_db.get_next_chunk(import_data['id'])
+            if chunk is None:
+                return
+            lines = chunk['data'].split('\n')
+            jobs, errors = parse_json_jobs(lines, chunk['first_job'])
+            if import_data['added_timestamp']:
+                for job in jobs:
+                    job['added_timestamp'] = import_data['added_timestamp']
+            result = {'invalid': len(errors)}
+            if not errors:
+                try:
+                    with jobs_db.db.transaction():
+                        added = jobs_db.insert_jobs_if_not_duplicate(
+                            jobs, chunk['first_job'])
+                        self._job_added(projects_db, project, added)
+                        imports_db.chunk_done(
+                            import_data['id'], self.owner, chunk['position'],
+                            self.clock(), len(lines), added=len(added))
+                    if any(job.get('priority') for job in added):
+                        ready_buffer.flush(project)
+                    if added:
+                        notifier.notify(project)
+                    continue
+                except DBConflictError as exc:
+                    errors = str(exc).split('\n')
+                    result = {'conflicts': len(errors)}
+            # The whole chunk is rejected, like a posted list of jobs
+            with imports_db.db.transaction():
+                imports_db.chunk_done(
+                    import_data['id'], self.owner, chunk['position'],
+                    self.clock(), len(lines), errors=errors, **result)
+
+    @staticmethod
+    def _job_added(projects_db, project, added):
+        if not added:
+            return
+        job_types, waiting = count_added_jobs(added)
+        if not projects_db.job_added(
+                project, added=len(added), job_types=job_types,
+                waiting=waiting):
+            raise DBError('Project {} does not exist'.format(project))
+
+
+importer = Importer(
+    interval=float(environ.get('USERVICE_IMPORTER_INTERVAL', 10)),
+    stale_after=float(environ.get('USERVICE_IMPORTER_STALE_AFTER', 300)))
@@ -0,0 +1,102 @@
+"""Requeue claimed jobs whose lease has expired"""
+import threading
+import time
+from datetime import datetime
+from os import environ
+
+from ..database.projects import ProjectsDB
+from ..database.sqldb import SqlJobDatabase
+from ..utils.logs import get_logger
+from .notifier import notifier
+
+
+class LeaseReaper:
+    """Periodically requeue jobs that were claimed by workers that have
+    stopped sending heartbeats.
+
+    Every process runs its own reaper thread (a greenlet under the gevent
+    workers). Reaping is one update per project, so it does not matter if
+    several processes reap at the same time. Only projects with claimed
+    jobs are reaped.
+    """
+
+    def __init__(self, interval=60, get_jobs_db=SqlJobDatabase):
+        """
+        Args:
+           interval (float): Seconds between reaps.
+           get_jobs_db (callable): Returns the jobs database of a project.
+        """
+        self.interval = interval
+        self.get_jobs_db = get_jobs_db
+        self._lock = threading.Lock()
+        self._thread = None
+        # Project -> jobs database, creating one checks that the tables
+        # exist
+        self._jobs_dbs = {}
+
+    def start(self):
+        """Start the reaper thread if it is not already running"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            projects_db = ProjectsDB()
+            try:
+                self.reap(projects_db=projects_db)
+            except Exception:
+                get_logger('UService', to_stdout=True).exception(
+                    "Requeue of jobs with expired leases failed")
+            finally:
+                projects_db.db.session.remove()
+
+    def reap(self, now=None, projects_db=None):
+        """Requeue the jobs with expired leases in all projects.
+
+        The claimed counter of the project is decreased in the same
+        transaction as the jobs are requeued.
+
+        Returns:
+           dict: Nr of requeued jobs per project, projects without expired
+             leases are left out.
+        """
+        now = now or datetime.utcnow()
+        projects_db = projects_db or ProjectsDB()
+        projects = list(projects_db.get_projects(fields=['id', 'nr_claimed']))
+        self._jobs_dbs = {
+            project['id']: self._jobs_dbs[project['id']]
+            for project in projects if project['id'] in self._jobs_dbs}
+        with_claimed_jobs = [
+            project['id'] for project in projects
+            if (project['nr_claimed'] or 0) > 0]
+        requeued = {}
+        for project in with_claimed_jobs:
+            jobs_db = self._get_jobs_db(project)
+            with jobs_db.db.transaction():
+                job_types = jobs_db.requeue_expired_jobs(now)
+                if job_types:
+                    projects_db.jobs_requeued(project, job_types)
+            nr_jobs = sum(job_types.values())
+            if nr_jobs:
+                requeued[project] = nr_jobs
+                notifier.notify(project)
+                get_logger('UService', to_stdout=True).info(
+                    "Requeued {0} jobs with expired leases in project "
+                    "{1}".format(nr_jobs, project))
+        return requeued
+
+    def _get_jobs_db(self, project):
+        if project not in self._jobs_dbs:
+            self._jobs_dbs[project] = self.get_jobs_db(project)
+        return self._jobs_dbs[project]
+
+
+lease_reaper = LeaseReaper(
+    interval=float(environ.get('USERVICE_LEASE_REAPER_INTERVAL', 60)))
@@ -0,0 +1,62 @@
+"""Notification of jobs that become available for claiming"""
+import threading
+import time
+
+
+class JobNotifier:
+    """Let requests sleep until jobs may have become available.
+
+    Every notification bumps a version counter for the project and a
+    global counter for all projects. A waiter reads the version, checks for
+    jobs and then waits for the version to change.
+
+    Uses a threading.Condition, so it works with threads and with the
+    gevent workers (gunicorn monkey patches threading). Only waiters in the
+    same process are woken, so waiters should also wake up regularly to
+    see changes made by other processes.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._version = 0
+        self._versions = {}
+
+    def _get_version(self, project):
+        if project is None:
+            return self._version
+        return self._versions.get(project, 0)
+
+    def get_version(self, project=None):
+        """Return the current version for a project, or for all projects
+        if project is None.
+        """
+        with self._condition:
+            return self._get_version(project)
+
+    def notify(self, project):
+        """Report that jobs may have become available in a project"""
+        with self._condition:
+            self._version += 1
+            self._versions[project] = self._version
+            self._condition.notify_all()
+
+    def wait(self, version, project=None, timeout=None):
+        """Wait until the version of the project (or of all projects if
+        project is None) is newer than version.
+
+        Return True if there was a notification and False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._get_version(project) <= version:
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+
+notifier = JobNotifier()
@@ -1,5 +1,6 @@
 from collections import OrderedDict
-from datetime import datetime
+from datetime import datetime, timedelta
+from os import environ
 
 from flask import g
 
@@ -11,6 +12,9 @@ STATE_TO_TIMESTAMP = {
     JOB_STATES.finished: 'finished_timestamp',
     JOB_STATES.failed: 'failed_timestamp'}
 
+# Jobs in these states can not change state, unless they are claimed again
+DONE_STATES = (JOB_STATES.finished, JOB_STATES.failed)
+
 
 def get_db(project, cls, **dbsettings):
     if not hasattr(g, 'job_databases'):
@@ -37,6 +41,11 @@ class BaseJobDatabaseAPI:
     * close
     * get_jobs
     * job_exists
+    * claim_next_job
+    * extend_lease
+    * requeue_expired_jobs
+    * get_counts
+    * get_watermark
     * _update_job
     * _insert_job
     * drop
@@ -45,15 +54,24 @@ class BaseJobDatabaseAPI:
     CLAIMED = 'claimed'
     CLAIMED_TIMESTAMP = 'claimed_timestamp'
     WORKER = 'worker'
+    LEASE_EXPIRES = 'lease_expires'
+    # Claimed jobs are requeued if the worker has not sent a heartbeat
+    # before the lease expires. Jobs claimed without a lease time get this
+    # lease, none unless configured, so that workers that do not send
+    # heartbeats keep their jobs.
+    DEFAULT_LEASE_TIME = (
+        timedelta(seconds=int(environ['USERVICE_LEASE_TIME']))
+        if environ.get('USERVICE_LEASE_TIME') else None)
     PUBLIC_FIELDS = [
         'id', 'type', 'source_url', 'view_result_url', 'claimed',
         'current_status', 'worker', 'added_timestamp', 'claimed_timestamp',
         'failed_timestamp', 'finished_timestamp', 'processing_time',
-        'worker_output']
+        'priority', 'worker_output']
     PUBLIC_LISTING_FIELDS = PUBLIC_FIELDS[:-1]
 
     SET_BY_USER = set(
-        ['id', 'type', 'source_url', 'view_result_url', 'target_url'])
+        ['id', 'type', 'source_url', 'view_result_url', 'target_url',
+         'depends_on', 'priority'])
     REQUIRED_FIELDS = set(['id', 'source_url'])
 
     def __init__(self, project):
@@ -80,6 +98,33 @@ class BaseJobDatabaseAPI:
             return 1
         return 0
 
+    def insert_jobs_if_not_duplicate(self, jobs, start=0):
+        """Insert the jobs that do not already exist, see
+        insert_job_if_not_duplicate. Run it in a transaction, nothing
+        should be inserted if a job conflicts.
+
+        Args:
+           jobs (list): The jobs as dicts, with the job id in 'id'.
+           start (int): Index of the first job in the errors.
+        Returns:
+           list: The inserted jobs.
+        Raises:
+           DBConflictError: If there is a job with the same id but other
+             data, in the database or earlier in jobs. The message has one
+             line per conflicting job: "Job#<index in jobs>: <error>".
+        """
+        errors = []
+        inserted = []
+        for job_number, job in enumerate(jobs, start):
+            try:
+                if self.insert_job_if_not_duplicate(job['id'], job):
+                    inserted.append(job)
+            except DBConflictError as error:
+                errors.append("Job#{}: {}".format(job_number, error))
+        if errors:
+            raise DBConflictError("\n".join(errors))
+        return inserted
+
     def _get_job(self, job_id, fields):
         raise NotImplementedError
 
@@ -117,6 +162,47 @@ class BaseJobDatabaseAPI:
                   time_field=None, limit=None):
         raise NotImplementedError
 
+    def get_unclaimed_jobs(self, fields, job_types=None, after_id=None,
+                           until_id=None, limit=None, priority=None):
+        """Return unclaimed jobs sorted by id.
+
+        Args:
+           fields (list): Return these fields for each job, id is always
+             returned.
+           job_types (list): Only return jobs of these types.
+           after_id (str): Only return jobs with id after this id.
+           until_id (str): Only return jobs with id up to this id.
+           limit (int): Return at most this many jobs.
+           priority (int): Only return jobs with this priority.
+        Returns:
+           jobs ([dict]): The jobs as dicts.
+        """
+        raise NotImplementedError
+
+    def get_unclaimed_id_range(self, job_types=None, priority=None):
+        """Return the lowest and highest id of the unclaimed jobs, of the
+        job types and priority if given, or (None, None) if there are no
+        such jobs.
+        """
+        raise NotImplementedError
+
+    def get_top_priority(self, job_types=None):
+        """Return the highest priority of the unclaimed jobs, of the job
+        types if given, or None if all of them have the same priority and
+        fetches do not have to filter on priority.
+        """
+        raise NotImplementedError
+
+    def get_top_priority_jobs(self, fields, job_types=None, limit=None):
+        """Return the first unclaimed jobs of the highest priority, oldest
+        first. The arguments are as for get_unclaimed_jobs.
+        """
+        raise NotImplementedError
+
+    def set_priority(self, job_ids, priority):
+        """Set the priority of the jobs, return the nr of updated jobs"""
+        raise NotImplementedError
+
     def get_claimed_jobs(self, start_time, end_time, match=None, limit=None,
                          fields=None):
         """Return jobs claimed in a certain time period"""
@@ -173,16 +259,216 @@ class BaseJobDatabaseAPI:
     def job_exists(self, job_id):
         raise NotImplementedError
 
-    def claim_job(self, job_id):
-        """Claim a job, return True if the job was claimed"""
-        return self._update_job(job_id, {self.CLAIMED: True})
+    def claim_job(self, job_id, worker, now=None, lease_time=None,
+                  fields=None):
+        """Claim a job for a worker if it is not claimed.
+
+        Args:
+           job_id (str): The job id.
+           worker (str): The worker that claims the job.
+           now (datetime): Claim time, default is utcnow.
+           lease_time (timedelta): Requeue the job if the lease is not
+             extended within this time, default is DEFAULT_LEASE_TIME.
+             Without both the job has no lease.
+           fields (list): Also return these fields of the claimed job.
+        Returns:
+           dict: The claim data and fields of the job, or None if the job
+             does not exist or is already claimed, use job_exists to tell
+             them apart.
+        """
+        job = self.get_job(job_id)
+        if not job or job[self.CLAIMED]:
+            return
+        claim_data = self.get_claim_data(worker, now, lease_time)
+        self._update_job(job_id, claim_data)
+        claimed = {k: job[k] for k in fields or [] if k in job}
+        claimed.update(claim_data)
+        return claimed
+
+    def claim_next_job(self, worker, job_types=None, now=None, fields=None,
+                       lease_time=None, projects_db=None):
+        """Select and claim one unclaimed job.
+
+        Args:
+           worker (str): The worker that claims the job.
+           job_types (list): Only claim a job of one of these types.
+           now (datetime): Claim time, default is utcnow.
+           fields (list): Return these fields of the claimed job.
+           lease_time (timedelta): Requeue the job if the lease is not
+             extended within this time, default is DEFAULT_LEASE_TIME.
+             Without both the job has no lease.
+           projects_db (ProjectsDB): If given, the claimed counters of the
+             project are updated together with the claim.
+        Returns:
+           dict: The claimed job or None if no unclaimed job was found.
+        """
+        raise NotImplementedError
+
+    def claim_jobs(self, worker, n, job_types=None, now=None, fields=None,
+                   lease_time=None, projects_db=None):
+        """Claim up to n unclaimed jobs.
+
+        Takes the same arguments as claim_next_job and returns a list of
+        the claimed jobs, which is empty if no unclaimed job was found.
+        """
+        jobs = []
+        for _ in range(n):
+            job = self.claim_next_job(
+                worker, job_types=job_types, now=now, fields=fields,
+                lease_time=lease_time, projects_db=projects_db)
+            if not job:
+                break
+            jobs.append(job)
+        return jobs
+
+    def get_claim_data(self, worker, now=None, lease_time=None):
+        """Return the job data that marks a job as claimed by a worker.
+
+        The lease starts at the current time, also when now is given.
+        """
+        lease_time = lease_time or self.DEFAULT_LEASE_TIME
+        lease_expires = datetime.utcnow() + lease_time if lease_time else None
+        return {
+            self.CLAIMED: True,
+            'current_status': JOB_STATES.claimed,
+            self.WORKER: worker,
+            self.CLAIMED_TIMESTAMP: now or datetime.utcnow(),
+            self.LEASE_EXPIRES: lease_expires}
+
+    def extend_lease(self, job_id, worker, now=None, lease_time=None):
+        """Extend the lease of a job claimed by worker.
+
+        Args:
+           job_id (str): The job id.
+           worker (str): The worker that claimed the job.
+           now (datetime): Heartbeat time, default is utcnow.
+           lease_time (timedelta): The new lease ends this long after now,
+             default is DEFAULT_LEASE_TIME.
+        Returns:
+           datetime: The new lease expiry time, or None if the job does not
+             exist, is not claimed by the worker, has no lease or is done,
+             or if there is no lease time.
+        """
+        raise NotImplementedError
+
+    def requeue_expired_jobs(self, now=None):
+        """Unclaim all jobs with a lease that expired before now.
+
+        Return a dict with the nr of requeued jobs per job type.
+        """
+        raise NotImplementedError
+
+    def get_counts(self):
+        """Count the jobs the way the counters of the project count them.
+
+        Return a dict with nr_added (all jobs), nr_claimed (claimed jobs),
+        nr_finished and nr_failed (claimed jobs in these states),
+        processing_time (sum over the claimed done jobs) and job_types
+        (job type -> dict with nr_added and nr_claimed).
+        """
+        raise NotImplementedError
+
+    def get_watermark(self):
+        """Return the latest added, claimed, finished and failed timestamps
+        of the jobs. The tuple changes when jobs are added, claimed or
+        done.
+        """
+        raise NotImplementedError
+
+    def update_status(self, job_id, new_state, processing_time=0, now=None,
+                      projects_db=None, worker=None):
+        """Set the status of a job.
+
+        Done jobs (see DONE_STATES) keep their state, but setting the same
+        state again is accepted and changes nothing, so that workers can
+        resend it. Other states can be set freely while the job is claimed,
+        by the worker if given, so that a worker that lost its lease cannot
+        finish a requeued job. WAITING is only set and left by the service,
+        see SqlJobDatabase._release_children.
+
+        Args:
+           job_id (str): The job id.
+           new_state (str): The new status, a JOB_STATES value or any
+             status a worker wants to report.
+           processing_time (float): Processing time of the job in seconds.
+           now (datetime): Status time, default is utcnow.
+           projects_db (ProjectsDB): If given, the finished and failed
+             counters of the project are updated together with the job.
+           worker (str): If given, the job must be claimed by this worker.
+        Returns:
+           bool: True if the status was set, False if the job already was
+             done with this state.
+        Raises:
+           DBError: If the job does not exist.
+           DBConflictError: If the job is done with another state, is
+             waiting or not claimed by the worker, or new_state is WAITING.
+        """
+        job = self.get_job(
+            job_id, fields=['current_status', self.CLAIMED, self.WORKER])
+        if not job:
+            raise DBError('Job does not exist')
+        if job['current_status'] not in DONE_STATES:
+            self._check_claimed(job, worker)
+        if not self._check_status_change(
+                job['current_status'], new_state):
+            return False
+        self._update_job(
+            job_id, self.get_status_data(new_state, processing_time, now))
+        self._count_status(projects_db, new_state, processing_time)
+        return True
+
+    def get_status_data(self, new_state, processing_time=0, now=None):
+        """Return the job data that sets the status of a job"""
+        data = {'current_status': new_state,
+                'processing_time': processing_time or 0}
+        if new_state in STATE_TO_TIMESTAMP:
+            data[STATE_TO_TIMESTAMP[new_state]] = now or datetime.utcnow()
+        if new_state in DONE_STATES:
+            # Done jobs must not be requeued by the lease reaper
+            data[self.LEASE_EXPIRES] = None
+        return data
+
+    def _check_claimed(self, job, worker=None):
+        """Raise DBConflictError if the job is not claimed, by the worker if
+        given.
+        """
+        if not job[self.CLAIMED]:
+            raise DBConflictError('The job is not claimed')
+        if worker is not None and job[self.WORKER] != worker:
+            raise DBConflictError('The job is claimed by another worker')
+
+    @staticmethod
+    def _check_status_change(current_state, new_state):
+        """Return True if a job in current_state may change to new_state,
+        False if it already is in this done state.
+        """
+        if new_state == JOB_STATES.waiting:
+            raise DBConflictError('The status {} cannot be set'.format(
+                JOB_STATES.waiting))
+        if current_state == JOB_STATES.waiting:
+            raise DBConflictError(
+                'The job waits for the jobs it depends on')
+        if current_state not in DONE_STATES:
+            return True
+        if current_state == new_state:
+            return False
+        raise DBConflictError('The job is already {}'.format(current_state))
+
+    def _count_status(self, projects_db, new_state, processing_time):
+        if projects_db is None:
+            return
+        if new_state == JOB_STATES.finished:
+            projects_db.job_finished(self.project, processing_time or 0)
+        elif new_state == JOB_STATES.failed:
+            projects_db.job_failed(self.project, processing_time or 0)
 
     def unclaim_job(self, job_id):
         """Unclaim a job"""
         unclaim_data = {
             self.CLAIMED: False,
             self.WORKER: None,
-            self.CLAIMED_TIMESTAMP: None}
+            self.CLAIMED_TIMESTAMP: None,
+            self.LEASE_EXPIRES: None}
         return self._update_job(job_id, unclaim_data)
 
     def update_job(self, job_id, **data):
@@ -246,6 +532,10 @@ class InMemoryJobDatabase(BaseJobDatabaseAPI):
                 job = {k: v for k, v in job.items() if k in fields}
             yield job
 
+    def _get_job(self, job_id, fields):
+        for job in self.get_jobs(job_id=job_id, fields=fields):
+            return job
+
     def _update_job(self, job_id, data):
         if not self.job_exists(job_id):
             raise DBError('Job does not exist')
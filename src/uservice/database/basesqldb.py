@@ -1,10 +1,26 @@
+from contextlib import contextmanager
 from os import environ
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 _engine = _db_session = None
 
+# Key in Session.info of the callbacks to call after the commit
+_AFTER_COMMIT = 'after_commit'
+
+
+def _run_after_commit(session):
+    for callback in session.info.pop(_AFTER_COMMIT, ()):
+        callback()
+
+
+def _drop_after_commit(session):
+    # Rolling back to a savepoint keeps the transaction
+    if session.transaction is not None and session.transaction.nested:
+        return
+    session.info.pop(_AFTER_COMMIT, None)
+
 
 class SqlDB:
 
@@ -12,20 +28,54 @@ class SqlDB:
         global _engine, _db_session
         if not _engine:
             dburl = environ['USERVICE_DATABASE_URI']
+            pool_settings = {}
+            if not dburl.startswith('sqlite'):
+                # SQLite (used for local tests and benchmarks) does not
+                # pool connections.
+                pool_settings = dict(
+                    pool_size=30,
+                    max_overflow=0,
+                    pool_timeout=180,
+                    pool_recycle=600)
             _engine = create_engine(
                 dburl,
                 convert_unicode=True,
-                pool_size=30,
-                max_overflow=0,
-                pool_timeout=180,
-                pool_recycle=600
+                **pool_settings
             )
-            _db_session = scoped_session(
-                sessionmaker(autocommit=True,
-                             autoflush=True,
-                             bind=_engine))
+            session_factory = sessionmaker(
+                autocommit=True, autoflush=True, bind=_engine)
+            event.listen(session_factory, 'after_commit', _run_after_commit)
+            event.listen(
+                session_factory, 'after_rollback', _drop_after_commit)
+            _db_session = scoped_session(session_factory)
         self.engine = _engine
         self.session = _db_session
         self.model = model
         self.model.query = _db_session.query_property()
         self.model.__table__.create(_db_session.bind, checkfirst=True)
+
+    @contextmanager
+    def transaction(self):
+        """Run the statements in the block in one transaction.
+
+        The session is in autocommit mode, so without this every statement
+        is committed on its own. Nested blocks join the outer transaction.
+        """
+        self.session.begin(subtransactions=True)
+        try:
+            yield self.session
+        except Exception:
+            self.session.rollback()
+            raise
+        self.session.commit()
+
+    def after_commit(self, callback):
+        """Call callback when the current transaction is committed, or now
+        if there is no transaction. The callback is dropped if the
+        transaction is rolled back.
+        """
+        session = self.session()
+        if session.transaction is None:
+            callback()
+        else:
+            session.info.setdefault(_AFTER_COMMIT, []).append(callback)
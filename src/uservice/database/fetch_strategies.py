@@ -0,0 +1,345 @@
+"""Strategies for selecting the unclaimed job a fetch hands out.
+
+Concurrent workers that are handed the same job collide when they try to
+claim it, all but one get 409 CONFLICT and have to fetch again. The
+strategies spread the workers over the unclaimed jobs in different ways.
+All of them only select among the jobs with the highest priority.
+Claim collisions are counted per strategy so that they can be compared.
+"""
+import os
+import random
+import string
+import threading
+import time
+import zlib
+from os import environ
+
+from .ready_buffer import ready_buffer
+
+
+class FetchStrategy:
+    """Select an unclaimed job candidate.
+
+    Inherit and implement select.
+    """
+
+    name = None
+    # Nr of candidates to choose from
+    CANDIDATES = 20
+
+    def select(self, project, jobs_db, fields, worker=None,
+               job_types=None):
+        """Return an unclaimed job or None.
+
+        Args:
+           project (str): The project.
+           jobs_db (SqlJobDatabase): Jobs database of the project.
+           fields (list): The job fields to return.
+           worker (str): The worker that will claim the job.
+           job_types (list): Only select jobs of these types.
+        """
+        raise NotImplementedError
+
+    def _choice(self, jobs_db, fields, job_types, after_id=None,
+                until_id=None, priority=None):
+        jobs = jobs_db.get_unclaimed_jobs(
+            fields, job_types=job_types, after_id=after_id,
+            until_id=until_id, limit=self.CANDIDATES, priority=priority)
+        return random.choice(jobs) if jobs else None
+
+    def _random_keyset(self, jobs_db, fields, job_types, low, high,
+                       priority=None):
+        """Choose among the unclaimed jobs after a random key between low
+        and high, wrap around if there are none.
+        """
+        start = interpolate_key(low, high, random.random())
+        return (
+            self._choice(jobs_db, fields, job_types, after_id=start,
+                         priority=priority) or
+            self._choice(jobs_db, fields, job_types, until_id=start,
+                         priority=priority))
+
+
+class BufferStrategy(FetchStrategy):
+    """Pop jobs from the in-process ready buffer"""
+
+    name = 'buffer'
+
+    def select(self, project, jobs_db, fields, worker=None,
+               job_types=None):
+        if job_types:
+            # The buffer does not know the job types
+            return WindowStrategy().select(
+                project, jobs_db, fields, worker, job_types)
+        return ready_buffer.pop(project, jobs_db)
+
+
+class WindowStrategy(FetchStrategy):
+    """Random choice among the oldest unclaimed jobs with the highest
+    priority.
+    """
+
+    name = 'window'
+    CANDIDATES = 500
+
+    def select(self, project, jobs_db, fields, worker=None,
+               job_types=None):
+        jobs = jobs_db.get_top_priority_jobs(
+            fields, job_types=job_types, limit=self.CANDIDATES)
+        return random.choice(jobs) if jobs else None
+
+
+class RandomKeysetStrategy(FetchStrategy):
+    """Random choice among the unclaimed jobs after a random job id"""
+
+    name = 'random-keyset'
+
+    def select(self, project, jobs_db, fields, worker=None,
+               job_types=None):
+        priority = jobs_db.get_top_priority(job_types)
+        low, high = jobs_db.get_unclaimed_id_range(job_types, priority)
+        if low is None:
+            return
+        return self._random_keyset(
+            jobs_db, fields, job_types, low, high, priority)
+
+
+class PartitionStrategy(FetchStrategy):
+    """Split the unclaimed job ids into partitions and let every worker
+    select jobs from the partition given by the hash of its name.
+
+    Falls back to a random keyset when the partition of the worker is
+    empty.
+    """
+
+    name = 'partition'
+    PARTITIONS = 16
+
+    def select(self, project, jobs_db, fields, worker=None,
+               job_types=None):
+        priority = jobs_db.get_top_priority(job_types)
+        low, high = jobs_db.get_unclaimed_id_range(job_types, priority)
+        if low is None:
+            return
+        part = zlib.crc32((worker or '').encode('utf-8')) % self.PARTITIONS
+        start = None
+        if part:
+            start = interpolate_key(low, high, part / float(self.PARTITIONS))
+        end = interpolate_key(low, high, (part + 1.) / self.PARTITIONS)
+        return (
+            self._choice(
+                jobs_db, fields, job_types, after_id=start, until_id=end,
+                priority=priority) or
+            self._random_keyset(
+                jobs_db, fields, job_types, low, high, priority))
+
+
+class RotatingStrategy(FetchStrategy):
+    """Move a cursor through the unclaimed job ids, every fetch chooses
+    among the jobs after the cursor and moves it past them.
+
+    The cursor is kept per project in this process, and only moves
+    through the jobs with the highest priority.
+    """
+
+    name = 'rotating'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cursors = {}
+
+    def select(self, project, jobs_db, fields, worker=None,
+               job_types=None):
+        key = (project, tuple(job_types or ()))
+        priority = jobs_db.get_top_priority(job_types)
+        with self._lock:
+            cursor = self._cursors.get(key)
+        jobs = jobs_db.get_unclaimed_jobs(
+            fields, job_types=job_types, after_id=cursor,
+            limit=self.CANDIDATES, priority=priority)
+        if not jobs and cursor is not None:
+            jobs = jobs_db.get_unclaimed_jobs(
+                fields, job_types=job_types, limit=self.CANDIDATES,
+                priority=priority)
+        with self._lock:
+            self._cursors[key] = jobs[-1]['id'] if jobs else None
+        return random.choice(jobs) if jobs else None
+
+
+# Alphabets of common job ids, sorted like the database sorts them
+_ALPHABETS = [
+    string.digits,
+    '-' + string.digits + 'abcdef',
+    string.ascii_lowercase,
+    string.digits + string.ascii_uppercase + string.ascii_lowercase,
+]
+
+
+def interpolate_key(low, high, fraction):
+    """Return a string key at about fraction of the way from low to high.
+
+    The part after the common prefix is read as a number in the smallest
+    alphabet of _ALPHABETS that covers it, or else as utf-8 bytes. That is
+    close enough to the collation of the database to split the key space.
+    """
+    prefix = os.path.commonprefix([low, high])
+    low, high = low[len(prefix):], high[len(prefix):]
+    length = max(len(low), len(high))
+    for alphabet in _ALPHABETS:
+        if set(low + high) <= set(alphabet):
+            break
+    else:
+        return prefix + _interpolate_bytes(low, high, fraction)
+    base = len(alphabet)
+
+    def to_int(key):
+        value = 0
+        for char in key.ljust(length, alphabet[0]):
+            value = value * base + alphabet.index(char)
+        return value
+
+    low_int, high_int = to_int(low), to_int(high)
+    value = low_int + int((high_int - low_int) * fraction)
+    chars = []
+    for _ in range(length):
+        value, digit = divmod(value, base)
+        chars.append(alphabet[digit])
+    return prefix + ''.join(reversed(chars))
+
+
+def _interpolate_bytes(low, high, fraction):
+    low_bytes, high_bytes = low.encode('utf-8'), high.encode('utf-8')
+    length = max(len(low_bytes), len(high_bytes))
+    low_int = int.from_bytes(low_bytes.ljust(length, b'\0'), 'big')
+    high_int = int.from_bytes(high_bytes.ljust(length, b'\0'), 'big')
+    key = low_int + int((high_int - low_int) * fraction)
+    key_bytes = key.to_bytes(length, 'big').rstrip(b'\0')
+    return key_bytes.decode('utf-8', errors='ignore')
+
+
+class _Stats:
+
+    def __init__(self):
+        self.fetches = 0
+        self.claims = 0
+        self.collisions = 0
+
+
+class FetchStrategies:
+    """Select the strategy of a project and count claim collisions per
+    strategy.
+
+    Collisions are only counted for claims handled by the same process as
+    the fetch.
+    """
+
+    # Prune handed out jobs older than served_ttl when there are more
+    MAX_SERVED = 10000
+
+    def __init__(self, default='buffer', project_ttl=10, served_ttl=300):
+        """
+        Args:
+           default (str): Strategy of projects without a strategy.
+           project_ttl (float): Seconds to cache the strategy of a project.
+           served_ttl (float): Seconds to remember which strategy handed
+             out a job.
+        """
+        self.strategies = {
+            strategy.name: strategy for strategy in [
+                BufferStrategy(), WindowStrategy(), RandomKeysetStrategy(),
+                PartitionStrategy(), RotatingStrategy()]}
+        if default not in self.strategies:
+            raise ValueError('Unknown fetch strategy: %r' % default)
+        self.default = default
+        self.project_ttl = project_ttl
+        self.served_ttl = served_ttl
+        self._lock = threading.Lock()
+        # Project -> (strategy name, time when it was read)
+        self._project_strategies = {}
+        # (project, job id) -> (strategy name, time when it was last handed
+        # out, nr of times it was handed out and not claimed)
+        self._served = {}
+        self._stats = {}
+
+    def get_strategy(self, project, projects_db):
+        """Return the name of the strategy of the project"""
+        now = time.monotonic()
+        with self._lock:
+            name, t = self._project_strategies.get(project, (None, None))
+        if t is None or now - t > self.project_ttl:
+            project_data = projects_db.get_project(
+                project, fields=['fetch_strategy']) or {}
+            name = project_data.get('fetch_strategy')
+            with self._lock:
+                self._project_strategies[project] = (name, now)
+        return name if name in self.strategies else self.default
+
+    def strategy_changed(self, project):
+        """Report that the strategy of the project was updated"""
+        with self._lock:
+            self._project_strategies.pop(project, None)
+
+    def select(self, project, jobs_db, projects_db, fields, worker=None,
+               job_types=None):
+        """Select an unclaimed job with the strategy of the project"""
+        name = self.get_strategy(project, projects_db)
+        job = self.strategies[name].select(
+            project, jobs_db, fields, worker=worker, job_types=job_types)
+        now = time.monotonic()
+        with self._lock:
+            self._get_stats(project, name).fetches += 1
+            if job:
+                key = (project, job['id'])
+                _, _, count = self._served.get(key, (None, None, 0))
+                self._served[key] = (name, now, count + 1)
+            if len(self._served) > self.MAX_SERVED:
+                self._served = {
+                    key: value for key, value in self._served.items()
+                    if now - value[1] < self.served_ttl}
+        return job
+
+    def _get_stats(self, project, name):
+        if (project, name) not in self._stats:
+            self._stats[(project, name)] = _Stats()
+        return self._stats[(project, name)]
+
+    def report_claim(self, project, job_id, claimed):
+        """Report the result of a claim of a job"""
+        key = (project, job_id)
+        with self._lock:
+            if key not in self._served:
+                return
+            name, t, count = self._served.pop(key)
+            if count > 1:
+                self._served[key] = (name, t, count - 1)
+            stats = self._get_stats(project, name)
+            stats.claims += 1
+            if not claimed:
+                stats.collisions += 1
+
+    def clear(self, project):
+        """Forget the strategy and stats of a project"""
+        with self._lock:
+            self._project_strategies.pop(project, None)
+            for key in [key for key in self._stats if key[0] == project]:
+                del self._stats[key]
+
+    def get_stats(self):
+        """Return fetch and claim collision counts per project and
+        strategy.
+        """
+        stats = {}
+        with self._lock:
+            for (project, name), s in self._stats.items():
+                stats.setdefault(project, {})[name] = {
+                    'Fetches': s.fetches,
+                    'Claims': s.claims,
+                    'Collisions': s.collisions,
+                    'CollisionRate': (
+                        s.collisions / float(s.claims) if s.claims else None),
+                }
+        return stats
+
+
+fetch_strategies = FetchStrategies(
+    default=environ.get('USERVICE_FETCH_STRATEGY', 'buffer'))
@@ -0,0 +1,223 @@
+"""Jobs that are imported in the background, see core.importer"""
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, TIMESTAMP as DateTime, String, Text, Integer
+
+from flask import g
+
+from uservice.database.basedb import DBError
+from uservice.database.basesqldb import SqlDB
+from uservice.utils.defs import IMPORT_STATES
+
+Base = declarative_base()
+
+
+def get_db():
+    if not hasattr(g, 'imports_database'):
+        g.imports_database = ImportsDB()
+    return g.imports_database
+
+
+class JobImport(Base):
+
+    __tablename__ = 'job_imports'
+
+    id = Column(String(32), primary_key=True)
+    project_id = Column(String(64), index=True)
+    created_by_user = Column(String(32))
+    created_timestamp = Column(DateTime(), default=datetime.utcnow)
+    # Added to the jobs with ?now=
+    added_timestamp = Column(DateTime())
+
+    status = Column(String(16), default=IMPORT_STATES.queued, index=True)
+    # The process that runs the import and when it last made progress
+    owner = Column(String(64))
+    heartbeat = Column(DateTime())
+    started_timestamp = Column(DateTime())
+    finished_timestamp = Column(DateTime())
+
+    nr_jobs = Column(Integer, default=0)
+    nr_processed = Column(Integer, default=0)
+    nr_added = Column(Integer, default=0)
+    nr_conflicts = Column(Integer, default=0)
+    nr_invalid = Column(Integer, default=0)
+    # JSON list of the first error messages
+    errors = Column(Text)
+
+
+class JobImportChunk(Base):
+    """Jobs of an import that are not yet processed, one JSON job per line.
+
+    The chunk is deleted in the same transaction as its jobs are inserted.
+    """
+
+    __tablename__ = 'job_import_chunks'
+
+    import_id = Column(String(32), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    # Index of the first job of the chunk in the import
+    first_job = Column(Integer)
+    # MEDIUMTEXT in MySQL
+    data = Column(Text(2 ** 24 - 1))
+
+
+class ImportsDB:
+
+    # Max nr of error messages to keep per import
+    MAX_ERRORS = 100
+
+    FIELDS = [
+        'id', 'project_id', 'created_by_user', 'created_timestamp',
+        'added_timestamp', 'status', 'owner', 'heartbeat',
+        'started_timestamp', 'finished_timestamp', 'nr_jobs',
+        'nr_processed', 'nr_added', 'nr_conflicts', 'nr_invalid', 'errors']
+
+    def __init__(self):
+        self.db = SqlDB(JobImport)
+        self.chunks_db = SqlDB(JobImportChunk)
+
+    def insert_import(self, import_id, project_id, user_name, chunks,
+                      added_timestamp=None):
+        """Store a new queued import in one transaction.
+
+        Args:
+           chunks (iterable): Lists of JSON jobs, one string per job.
+        Returns:
+           int: The nr of jobs.
+        """
+        nr_jobs = 0
+        with self.db.transaction() as session:
+            session.execute(self.db.model.__table__.insert().values(
+                id=import_id, project_id=project_id,
+                created_by_user=user_name, created_timestamp=datetime.utcnow(),
+                added_timestamp=added_timestamp,
+                status=IMPORT_STATES.queued, errors='[]'))
+            for position, lines in enumerate(chunks):
+                session.execute(self.chunks_db.model.__table__.insert().values(
+                    import_id=import_id, position=position,
+                    first_job=nr_jobs, data='\n'.join(lines)))
+                nr_jobs += len(lines)
+            self._update(session, import_id, nr_jobs=nr_jobs)
+        return nr_jobs
+
+    def get_import(self, import_id):
+        table = self.db.model.__table__
+        row = self.db.session.execute(select(
+            [table.c[field] for field in self.FIELDS],
+            table.c.id == import_id)).first()
+        return self._decode(row) if row else None
+
+    def get_imports(self, project_id):
+        table = self.db.model.__table__
+        rows = self.db.session.execute(select(
+            [table.c[field] for field in self.FIELDS],
+            table.c.project_id == project_id,
+            order_by=table.c.created_timestamp))
+        return [self._decode(row) for row in rows]
+
+    def take_import(self, owner, now, stale_before):
+        """Take a queued import, or a running import that has made no
+        progress since stale_before, e.g. because its process was
+        restarted.
+
+        Returns:
+           dict: The import, None if there is nothing to take.
+        """
+        table = self.db.model.__table__
+        takeable = or_(
+            table.c.status == IMPORT_STATES.queued,
+            and_(table.c.status == IMPORT_STATES.running,
+                 table.c.heartbeat < stale_before))
+        for row in self.db.session.execute(select(
+                [table.c.id, table.c.started_timestamp], takeable,
+                order_by=table.c.created_timestamp, limit=10)):
+            # Another process can take it first
+            if self._update(
+                    self.db.session, row['id'], takeable,
+                    status=IMPORT_STATES.running, owner=owner,
+                    heartbeat=now,
+                    started_timestamp=row['started_timestamp'] or now):
+                return self.get_import(row['id'])
+        return None
+
+    def get_next_chunk(self, import_id):
+        """Return the first unprocessed chunk of the import or None"""
+        table = self.chunks_db.model.__table__
+        row = self.db.session.execute(select(
+            [table.c.position, table.c.first_job, table.c.data],
+            table.c.import_id == import_id,
+            order_by=table.c.position, limit=1)).first()
+        return dict(row) if row else None
+
+    def chunk_done(self, import_id, owner, position, now, nr_jobs,
+                   added=0, conflicts=0, invalid=0, errors=()):
+        """Delete the chunk and add its results to the import.
+
+        Run it in the same transaction as the jobs of the chunk are
+        inserted.
+
+        Raises:
+           DBError: If the import has been taken by another owner.
+        """
+        import_data = self.get_import(import_id)
+        if not import_data or import_data['owner'] != owner:
+            raise DBError('Import {} was taken over'.format(import_id))
+        session = self.db.session
+        table = self.chunks_db.model.__table__
+        session.execute(table.delete().where(and_(
+            table.c.import_id == import_id, table.c.position == position)))
+        all_errors = import_data['errors'] + list(errors)
+        self._update(
+            session, import_id, self.db.model.owner == owner,
+            heartbeat=now,
+            nr_processed=import_data['nr_processed'] + nr_jobs,
+            nr_added=import_data['nr_added'] + added,
+            nr_conflicts=import_data['nr_conflicts'] + conflicts,
+            nr_invalid=import_data['nr_invalid'] + invalid,
+            errors=json.dumps(all_errors[:self.MAX_ERRORS]))
+
+    def finish_import(self, import_id, owner, now, status, error=None):
+        """Set the final status of the import and delete what is left of
+        its chunks.
+        """
+        with self.db.transaction() as session:
+            import_data = self.get_import(import_id)
+            data = {}
+            if error:
+                data['errors'] = json.dumps(
+                    (import_data['errors'] + [error])[:self.MAX_ERRORS])
+            if not self._update(
+                    session, import_id, self.db.model.owner == owner,
+                    status=status, heartbeat=now, finished_timestamp=now,
+                    **data):
+                return False
+            table = self.chunks_db.model.__table__
+            session.execute(
+                table.delete().where(table.c.import_id == import_id))
+        return True
+
+    def remove_imports(self, project_id):
+        """Delete the imports of a project"""
+        table = self.db.model.__table__
+        chunks_table = self.chunks_db.model.__table__
+        with self.db.transaction() as session:
+            session.execute(chunks_table.delete().where(
+                chunks_table.c.import_id.in_(select(
+                    [table.c.id], table.c.project_id == project_id))))
+            session.execute(
+                table.delete().where(table.c.project_id == project_id))
+
+    def _update(self, session, import_id, *expressions, **data):
+        table = self.db.model.__table__
+        result = session.execute(table.update().where(
+            and_(table.c.id == import_id, *expressions)).values(**data))
+        return bool(result.rowcount)
+
+    @staticmethod
+    def _decode(row):
+        import_data = dict(row)
+        import_data['errors'] = json.loads(import_data['errors'] or '[]')
+        return import_data
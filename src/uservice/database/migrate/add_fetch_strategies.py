@@ -0,0 +1,34 @@
+from sqlalchemy import Table, Column, String, Index, MetaData
+import migrate.changeset
+
+# Import of changeset adds drop and alter methods to Column etc.
+# Suppress unused import warning:
+migrate.changeset
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine, reflect=True)
+    projects = Table('projects', meta, autoload=True)
+
+    print("Upgrade 'projects'")
+    Column('fetch_strategy', String(32)).create(projects)
+
+    for table_name in meta.tables.keys():
+        if table_name.startswith('jobs_'):
+            print("Upgrade %r" % table_name)
+            jobs = Table(table_name, meta, autoload=True)
+            Index('claimed_id_idx', jobs.c.claimed, jobs.c.id).create()
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine, reflect=True)
+    projects = Table('projects', meta, autoload=True)
+
+    print("Downgrade 'projects'")
+    projects.c.fetch_strategy.drop()
+
+    for table_name in meta.tables.keys():
+        if table_name.startswith('jobs_'):
+            print("Downgrade %r" % table_name)
+            jobs = Table(table_name, meta, autoload=True)
+            Index('claimed_id_idx', jobs.c.claimed, jobs.c.id).drop()
@@ -0,0 +1,27 @@
+from sqlalchemy import Table, Column, String, MetaData
+import migrate.changeset
+
+# Import of changeset adds drop and alter methods to Column etc.
+# Suppress unused import warning:
+migrate.changeset
+
+
+def upgrade(migrate_engine):
+    # Existing jobs are hashed when they are compared with posted jobs
+    meta = MetaData(bind=migrate_engine, reflect=True)
+
+    for table_name in meta.tables.keys():
+        if table_name.startswith('jobs_'):
+            print("Upgrade %r" % table_name)
+            jobs = Table(table_name, meta, autoload=True)
+            Column('content_hash', String(64)).create(jobs)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine, reflect=True)
+
+    for table_name in meta.tables.keys():
+        if table_name.startswith('jobs_'):
+            print("Downgrade %r" % table_name)
+            jobs = Table(table_name, meta, autoload=True)
+            jobs.c.content_hash.drop()
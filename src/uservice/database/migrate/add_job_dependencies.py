@@ -0,0 +1,31 @@
+from sqlalchemy import Table, Column, Integer, MetaData
+import migrate.changeset
+
+# Import of changeset adds drop and alter methods to Column etc.
+# Suppress unused import warning:
+migrate.changeset
+
+# The dependency tables, deps_<project>, are created by the service.
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine, reflect=True)
+
+    for table_name in meta.tables.keys():
+        if table_name.startswith('jobs_'):
+            print("Upgrade %r" % table_name)
+            jobs = Table(table_name, meta, autoload=True)
+            Column('pending_parents', Integer, default=0).create(jobs)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine, reflect=True)
+
+    for table_name in meta.tables.keys():
+        if table_name.startswith('jobs_'):
+            print("Downgrade %r" % table_name)
+            jobs = Table(table_name, meta, autoload=True)
+            jobs.c.pending_parents.drop()
+        elif table_name.startswith('deps_'):
+            print("Drop %r" % table_name)
+            Table(table_name, meta, autoload=True).drop()
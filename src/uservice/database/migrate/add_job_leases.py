@@ -0,0 +1,30 @@
+from sqlalchemy import Table, Column, TIMESTAMP as DateTime, Index, MetaData
+import migrate.changeset
+
+# Import of changeset adds drop and alter methods to Column etc.
+# Suppress unused import warning:
+migrate.changeset
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine, reflect=True)
+
+    for table_name in meta.tables.keys():
+        if table_name.startswith('jobs_'):
+            print("Upgrade %r" % table_name)
+            jobs = Table(table_name, meta, autoload=True)
+            Column('lease_expires', DateTime()).create(jobs)
+            Index('ix_%s_lease_expires' % table_name,
+                  jobs.c.lease_expires).create()
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine, reflect=True)
+
+    for table_name in meta.tables.keys():
+        if table_name.startswith('jobs_'):
+            print("Downgrade %r" % table_name)
+            jobs = Table(table_name, meta, autoload=True)
+            Index('ix_%s_lease_expires' % table_name,
+                  jobs.c.lease_expires).drop()
+            jobs.c.lease_expires.drop()
@@ -0,0 +1,32 @@
+from sqlalchemy import Table, Column, Integer, Index, MetaData, desc
+import migrate.changeset
+
+# Import of changeset adds drop and alter methods to Column etc.
+# Suppress unused import warning:
+migrate.changeset
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine, reflect=True)
+
+    for table_name in meta.tables.keys():
+        if table_name.startswith('jobs_'):
+            print("Upgrade %r" % table_name)
+            jobs = Table(table_name, meta, autoload=True)
+            # The server default sets the priority of the existing jobs
+            Column('priority', Integer, default=0,
+                   server_default='0').create(jobs)
+            Index('claimed_priority_idx', jobs.c.claimed,
+                  desc(jobs.c.priority), jobs.c.added_timestamp).create()
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine, reflect=True)
+
+    for table_name in meta.tables.keys():
+        if table_name.startswith('jobs_'):
+            print("Downgrade %r" % table_name)
+            jobs = Table(table_name, meta, autoload=True)
+            Index('claimed_priority_idx', jobs.c.claimed,
+                  desc(jobs.c.priority), jobs.c.added_timestamp).drop()
+            jobs.c.priority.drop()
@@ -0,0 +1,41 @@
+from sqlalchemy import (
+    Table, Column, Integer, String, MetaData, select, func, cast)
+
+# Run before the new version of the service is started. The service keeps
+# the counters up to date, this counts the jobs that already exist.
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine, reflect=True)
+
+    print("Create 'project_job_types'")
+    job_types = Table(
+        'project_job_types', meta,
+        Column('project_id', String(64), primary_key=True),
+        Column('type', String(64), primary_key=True),
+        Column('nr_added', Integer, default=0),
+        Column('nr_claimed', Integer, default=0))
+    job_types.create(checkfirst=True)
+
+    for table_name in list(meta.tables.keys()):
+        if table_name.startswith('jobs_'):
+            print("Count job types in %r" % table_name)
+            jobs = Table(table_name, meta, autoload=True)
+            query = select(
+                [jobs.c.type, func.count(),
+                 func.sum(cast(jobs.c.claimed, Integer))],
+                whereclause=jobs.c.type.isnot(None),
+                group_by=jobs.c.type)
+            rows = [
+                {'project_id': table_name[len('jobs_'):], 'type': row[0],
+                 'nr_added': row[1], 'nr_claimed': row[2] or 0}
+                for row in migrate_engine.execute(query)]
+            if rows:
+                migrate_engine.execute(job_types.insert(), rows)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine, reflect=True)
+
+    print("Drop 'project_job_types'")
+    Table('project_job_types', meta, autoload=True).drop()
@@ -0,0 +1,26 @@
+from sqlalchemy import Table, Column, Float, Boolean, MetaData
+import migrate.changeset
+
+# Import of changeset adds drop and alter methods to Column etc.
+# Suppress unused import warning:
+migrate.changeset
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine, reflect=True)
+    projects = Table('projects', meta, autoload=True)
+
+    print("Upgrade 'projects'")
+    Column('weight', Float, default=1).create(
+        projects, populate_default=True)
+    Column('paused', Boolean, default=False).create(
+        projects, populate_default=True)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine, reflect=True)
+    projects = Table('projects', meta, autoload=True)
+
+    print("Downgrade 'projects'")
+    projects.c.paused.drop()
+    projects.c.weight.drop()
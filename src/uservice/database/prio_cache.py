@@ -0,0 +1,281 @@
+"""Per process cache of the data that prio scores are computed from"""
+import threading
+import time
+from datetime import datetime
+from os import environ
+
+from ..utils.weighted_sampler import WeightedSampler
+
+
+class PrioCache:
+    """Cache of the counters and deadlines of the active projects.
+
+    Prio scores depend on the time to the deadline, so the inputs of the
+    score are cached and the scores are computed when a project is picked.
+    ProjectsDB reports its counter updates to the cache, so that it follows
+    the changes made by this process. Changes made by other processes are
+    seen when the cache is refreshed from the database, which is done when
+    it is older than ttl seconds.
+
+    Picks without job types draw from a WeightedSampler of the scores,
+    which are computed when the cache is refreshed or the project is
+    updated, so that a pick is O(log n) in the nr of projects. Picks with
+    job types compute the scores of the matching projects.
+
+    Projects that turn out to have no unclaimed jobs, of some job types,
+    are reported as drained and are not picked, also after a refresh,
+    until their counters change.
+    """
+
+    FIELDS = [
+        'id', 'nr_added', 'nr_claimed', 'nr_finished', 'nr_failed',
+        'processing_time', 'deadline', 'created_by_user',
+        'created_timestamp', 'processing_image_url', 'weight', 'paused']
+    INCREMENTAL_FIELDS = set(FIELDS[1:6])
+    # Updates of these fields refresh the cache
+    EXPIRING_FIELDS = set(['deadline', 'weight', 'paused'])
+
+    def __init__(self, ttl=5):
+        """
+        Args:
+           ttl (float): Max age in seconds of the cache.
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        # Project -> dict with FIELDS
+        self._projects = {}
+        # Project -> job type -> [nr added, nr claimed]
+        self._job_types = {}
+        self._sampler = WeightedSampler()
+        # (project, job type or None) -> nr added and claimed when drained
+        self._drained = {}
+        self._calc_prio_score = None
+        self._refreshed_at = float('-inf')
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get_prio_project(self, projects_db, job_types=None, exclude=None,
+                         images=None):
+        """Randomly select a project based on their prio score.
+
+        Same as ProjectsDB.get_prio_project, but the scores are computed
+        from the cache.
+
+        Args:
+           projects_db (ProjectsDB): Used to refresh the cache.
+           job_types (list): Only select among projects with unclaimed
+             jobs of these types.
+           exclude (set): Do not select these projects.
+           images (set): Only select among projects with one of these
+             processing images.
+        """
+        self._refresh_if_old(projects_db)
+        if not job_types and not exclude and not images:
+            with self._lock:
+                return self._sampler.sample()
+        now = datetime.utcnow()
+        with self._lock:
+            scores = []
+            for project, data in self._projects.items():
+                if project in (exclude or ()):
+                    continue
+                if images and data['processing_image_url'] not in images:
+                    continue
+                if not self._is_active(project, job_types):
+                    continue
+                scores.append(
+                    (project, projects_db.calc_prio_score(data, now)))
+        return projects_db.weighted_choice(scores)
+
+    def get_projects(self, projects_db, job_types=None):
+        """Return copies of the cached active projects.
+
+        Args:
+           projects_db (ProjectsDB): Used to refresh the cache.
+           job_types (list): Only return projects with unclaimed jobs of
+             these types.
+        """
+        self._refresh_if_old(projects_db)
+        with self._lock:
+            return [
+                dict(data) for project, data in self._projects.items()
+                if self._is_active(project, job_types)]
+
+    def get_scores(self):
+        """Return the prio scores that untyped picks are drawn with"""
+        with self._lock:
+            return {project: self._sampler.get(project)
+                    for project in self._projects}
+
+    def _is_active(self, project, job_types=None):
+        data = self._projects[project]
+        if data['nr_added'] <= data['nr_claimed']:
+            return False
+        if self._is_drained(project):
+            return False
+        if not job_types:
+            return True
+        counts = self._job_types.get(project, {})
+        return any(
+            counts[job_type][0] > counts[job_type][1] and
+            not self._is_drained(project, job_type)
+            for job_type in job_types if job_type in counts)
+
+    def _get_counters(self, project, job_type=None):
+        if job_type is None:
+            data = self._projects.get(project)
+            return data and (data['nr_added'], data['nr_claimed'])
+        counts = self._job_types.get(project, {}).get(job_type)
+        return counts and tuple(counts)
+
+    def _is_drained(self, project, job_type=None):
+        """Return True if the project, or the job type of the project, was
+        drained and its counters have not changed since. Called with the
+        lock held.
+        """
+        key = (project, job_type)
+        if key not in self._drained:
+            return False
+        counters = self._get_counters(project, job_type)
+        if self._drained[key] is None:
+            # Drained before the counters were cached, compare with the
+            # counters from when they are first seen
+            self._drained[key] = counters
+            return True
+        if self._drained[key] == counters:
+            return True
+        del self._drained[key]
+        return False
+
+    def _refresh_if_old(self, projects_db):
+        if time.monotonic() - self._refreshed_at < self.ttl:
+            with self._lock:
+                self.hits += 1
+            return
+        with self._refresh_lock:
+            if time.monotonic() - self._refreshed_at < self.ttl:
+                # Refreshed by someone else while we waited
+                with self._lock:
+                    self.hits += 1
+                return
+            t0 = time.monotonic()
+            projects = {
+                project['id']: project for project in
+                projects_db.get_projects(
+                    fields=self.FIELDS, only_active=True)}
+            job_types = projects_db.get_unclaimed_job_type_counts()
+            now = datetime.utcnow()
+            sampler = WeightedSampler(
+                (project, projects_db.calc_prio_score(data, now))
+                for project, data in projects.items())
+            with self._lock:
+                self._projects = projects
+                self._sampler = sampler
+                self._calc_prio_score = projects_db.calc_prio_score
+                self._job_types = {
+                    project: {
+                        job_type: [c['nr_added'], c['nr_claimed']]
+                        for job_type, c in counts.items()}
+                    for project, counts in job_types.items()}
+                # Also forgets the drained projects whose counters changed
+                for project, job_type in list(self._drained):
+                    if self._is_drained(project, job_type) and (
+                            job_type is None):
+                        self._sampler.remove(project)
+                self._refreshed_at = t0
+                self.misses += 1
+                self.refreshes += 1
+
+    def expire(self):
+        """Refresh the cache at the next pick"""
+        with self._lock:
+            self._refreshed_at = float('-inf')
+
+    def project_updated(self, project, data):
+        """Report an update of a project.
+
+        The counters in data are increments. A new deadline, weight or
+        pause, or added or released jobs in a project that is not cached,
+        expire the cache.
+        """
+        with self._lock:
+            cached = self._projects.get(project)
+            if self.EXPIRING_FIELDS & set(data) or cached is None and (
+                    (data.get('nr_added') or 0) > 0 or
+                    (data.get('nr_claimed') or 0) < 0):
+                self._refreshed_at = float('-inf')
+            if cached is None:
+                return
+            for field, value in data.items():
+                if field in self.INCREMENTAL_FIELDS:
+                    cached[field] = (cached[field] or 0) + value
+                elif field == 'processing_image_url':
+                    cached[field] = value
+            if self._is_drained(project):
+                return
+            self._sampler.set(
+                project, self._calc_prio_score(cached, datetime.utcnow()))
+
+    def job_types_updated(self, project, field, job_types):
+        """Report that the nr_added or nr_claimed counter of job types was
+        incremented, see ProjectsDB._update_job_type_counts.
+        """
+        index = 0 if field == 'nr_added' else 1
+        with self._lock:
+            counts = self._job_types.get(project, {})
+            for job_type, value in (job_types or {}).items():
+                if job_type is None or not value:
+                    continue
+                if job_type in counts:
+                    counts[job_type][index] += value
+                elif (index == 0) == (value > 0):
+                    # Not cached since it had no unclaimed jobs, but now it
+                    # may have.
+                    self._refreshed_at = float('-inf')
+
+    def project_drained(self, project, job_types=None):
+        """Report that a project has no unclaimed jobs, of the job types if
+        given. The project is not picked, for these job types, until its
+        counters change.
+        """
+        with self._lock:
+            if job_types:
+                for job_type in job_types:
+                    self._drained[(project, job_type)] = self._get_counters(
+                        project, job_type)
+                return
+            self._drained[(project, None)] = self._get_counters(project)
+            self._sampler.remove(project)
+
+    def clear(self, project):
+        """Forget a project"""
+        with self._lock:
+            self._projects.pop(project, None)
+            self._job_types.pop(project, None)
+            self._sampler.remove(project)
+            for key in list(self._drained):
+                if key[0] == project:
+                    del self._drained[key]
+
+    def get_stats(self):
+        """Return hit and miss counters"""
+        with self._lock:
+            picks = self.hits + self.misses
+            return {
+                'Hits': self.hits,
+                'Misses': self.misses,
+                'HitRate': self.hits / float(picks) if picks else None,
+                'Refreshes': self.refreshes,
+                'Projects': len(self._projects),
+                'Drained': len(self._drained),
+                'Age': (
+                    time.monotonic() - self._refreshed_at
+                    if self._refreshed_at > float('-inf') else None),
+                'TTL': self.ttl,
+            }
+
+
+prio_cache = PrioCache(
+    ttl=float(environ.get('USERVICE_PRIO_CACHE_TTL', 5)))
@@ -2,14 +2,21 @@ import json
 import random
 from datetime import datetime
 
-from sqlalchemy import select, and_, inspect
+from sqlalchemy import (
+    select, and_, or_, case, extract, func, inspect, literal,
+    literal_column)
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import (
-    Column, TIMESTAMP as DateTime, String, Text, Integer, Float)
+    Column, TIMESTAMP as DateTime, String, Text, Integer, Float, Boolean,
+    true)
 
 from flask import g
 
 from uservice.database.basesqldb import SqlDB
+from uservice.database.prio_cache import prio_cache
+from uservice.utils.defs import JOB_STATES
 
 Base = declarative_base()
 
@@ -37,6 +44,12 @@ class Project(Base):
     processing_image_url = Column(String(512))
     environment = Column(Text)
     deadline = Column(DateTime(), index=True)
+    # How fetches select jobs, see fetch_strategies
+    fetch_strategy = Column(String(32))
+    # The prio score is multiplied by the weight
+    weight = Column(Float, default=1)
+    # Paused projects are not selected by prio fetches
+    paused = Column(Boolean, default=False)
 
     # Internal
     last_added_timestamp = Column(DateTime(), index=True)
@@ -48,17 +61,31 @@ class Project(Base):
     processing_time = Column(Float, default=0)
 
 
+class ProjectJobType(Base):
+    """Nr of added and claimed jobs per job type in a project"""
+
+    __tablename__ = 'project_job_types'
+
+    project_id = Column(String(64), primary_key=True)
+    job_type = Column('type', String(64), primary_key=True)
+    nr_added = Column(Integer, default=0)
+    nr_claimed = Column(Integer, default=0)
+
+
 class ProjectsDB:
 
     # These fields are stored as json strings in the database:
     JSON_FIELDS = ['environment']
 
     UPDATED_BY_USER = set([
-        'environment', 'deadline', 'name', 'processing_image_url'])
+        'environment', 'deadline', 'name', 'processing_image_url',
+        'fetch_strategy', 'weight', 'paused'])
 
-    INCREMENTAL_FIELDS = set([
+    # The job counters, see reconcile_counters
+    COUNTERS = [
         'nr_added', 'nr_claimed', 'nr_finished', 'nr_failed',
-        'processing_time'])
+        'processing_time']
+    INCREMENTAL_FIELDS = set(COUNTERS)
 
     # Use this when calculting project prio when no jobs have been processed.
     # Use a relativly high value so that we get at least one job processed,
@@ -67,43 +94,135 @@ class ProjectsDB:
 
     def __init__(self):
         self.db = SqlDB(Project)
+        self.job_types_db = SqlDB(ProjectJobType)
 
-    def get_prio_project(self):
-        """Randomly select a project based on their prio score"""
-        projects = self.get_prio_scores()
-        if not projects:
-            return
+    def get_prio_project(self, job_types=None, exclude=None, images=None):
+        """Randomly select a project based on their prio score.
+
+        If job_types is given, only select among projects with unclaimed
+        jobs of these types, and if images is given among projects with
+        one of these processing images. Projects in exclude are not
+        selected.
+
+        The scores and the weighted random choice are computed in one
+        query: the project with the largest ln(u)/score, u uniform in
+        (0, 1], is selected with probability score/total.
+        """
+        table = self.db.model.__table__
+        score = self._prio_score_expression(datetime.utcnow())
+        expressions = [self._active_expression()]
+        if job_types:
+            types_table = self.job_types_db.model.__table__
+            expressions.append(table.c.id.in_(select(
+                [types_table.c.project_id],
+                whereclause=and_(
+                    types_table.c.type.in_(job_types),
+                    types_table.c.nr_added > types_table.c.nr_claimed))))
+        if exclude:
+            expressions.append(table.c.id.notin_(list(exclude)))
+        if images:
+            expressions.append(
+                table.c.processing_image_url.in_(list(images)))
+        whereclause = and_(*expressions)
+        uniform = self._random_expression()
+        if uniform is None:
+            # No random numbers in this database, choose here
+            query = select([table.c.id, score], whereclause=whereclause)
+            return self.weighted_choice(
+                list(self.db.session.execute(query)))
+        query = select(
+            [table.c.id], whereclause=whereclause,
+            order_by=(func.ln(uniform) / score).desc(), limit=1)
+        row = self.db.session.execute(query).first()
+        return row[0] if row else None
 
+    @staticmethod
+    def weighted_choice(projects):
+        """Choose a project id from (project id, score) pairs"""
         total = sum((score for _, score in projects))
+        if not total:
+            return
         rand = random.uniform(0, total)
         upto = 0
         for project, score in projects:
             if upto + score >= rand:
                 return project
             upto += score
-        assert False, "Shouldn't get here"
+        return projects[-1][0]
 
     def get_prio_scores(self):
-        """Return project id and prio score for all projects.
+        """Return project id and prio score for all active projects.
 
-        prio = "nr jobs left to do" * "mean time for each job" /
+        prio = "nr jobs left to do" * "mean time for each job" * "weight" /
                   "time to deadline"
-        """
-        # TODO: Do the prio calc as an sql query?
-        projects = self.get_projects(fields=[
-            'id', 'nr_added', 'nr_claimed', 'nr_finished', 'nr_failed',
-            'processing_time', 'deadline'], only_active=True)
 
-        now = datetime.utcnow()
-        return [(p['id'], self.calc_prio_score(p, now)) for p in projects]
+        Paused projects are not active.
+        """
+        table = self.db.model.__table__
+        query = select(
+            [table.c.id, self._prio_score_expression(datetime.utcnow())],
+            whereclause=self._active_expression(),
+            order_by=table.c.last_claimed_timestamp)
+        return [(row[0], row[1]) for row in self.db.session.execute(query)]
+
+    def _active_expression(self):
+        """Return an SQL expression that is true for projects with
+        unclaimed jobs that are not paused.
+        """
+        table = self.db.model.__table__
+        return and_(
+            table.c.nr_added > table.c.nr_claimed,
+            or_(table.c.paused.is_(None), table.c.paused != true()))
+
+    def _prio_score_expression(self, now):
+        """Return calc_prio_score as an SQL expression"""
+        table = self.db.model.__table__
+        nr_done = table.c.nr_finished + table.c.nr_failed
+        mean_processing_time = case(
+            [(or_(table.c.processing_time.is_(None),
+                  table.c.processing_time == 0,
+                  nr_done == 0),
+              float(self.DEFAULT_MEAN_PROCESSING_TIME))],
+            else_=table.c.processing_time / nr_done)
+        weight = func.coalesce(table.c.weight, 1.)
+        numerator = (
+            (table.c.nr_added - table.c.nr_claimed) * mean_processing_time *
+            weight)
+        now = literal(now, DateTime())
+        return case([
+            (table.c.nr_added <= table.c.nr_claimed, 0),
+            (table.c.paused == true(), 0),
+            (table.c.deadline.is_(None), weight),
+            (table.c.deadline <= now, numerator)],
+            else_=numerator / self._seconds_between(now, table.c.deadline))
+
+    def _seconds_between(self, start, end):
+        dialect = self.db.engine.dialect.name
+        if dialect == 'mysql':
+            return func.timestampdiff(
+                literal_column('MICROSECOND'), start, end) / 1e6
+        if dialect == 'postgresql':
+            return extract('epoch', end - start)
+        return (func.julianday(end) - func.julianday(start)) * 86400.
+
+    def _random_expression(self):
+        """Return an SQL expression for a random number in (0, 1], or None
+        if the database has no such function.
+        """
+        dialect = self.db.engine.dialect.name
+        if dialect == 'mysql':
+            return 1 - func.rand()
+        if dialect == 'postgresql':
+            return 1 - func.random()
 
     @staticmethod
     def calc_prio_score(project_data, now):
         p = project_data
-        if p['nr_added'] <= p['nr_claimed']:
+        if p['nr_added'] <= p['nr_claimed'] or p.get('paused'):
             return 0
+        weight = p.get('weight') or 1
         if not p['deadline']:
-            return 1
+            return weight
         if not p['processing_time'] or not (
                 p['nr_finished'] or p['nr_failed']):
             mean_processing_time = ProjectsDB.DEFAULT_MEAN_PROCESSING_TIME
@@ -111,22 +230,23 @@ class ProjectsDB:
             mean_processing_time = (
                 p['processing_time'] / (p['nr_finished'] + p['nr_failed'])
             )
-        numerator = (p['nr_added'] - p['nr_claimed']) * mean_processing_time
+        numerator = (
+            (p['nr_added'] - p['nr_claimed']) * mean_processing_time * weight)
         if p['deadline'] < now:
             return numerator
         return numerator / (p['deadline'] - now).total_seconds()
 
     def get_projects(self, match=None, limit=None, fields=None,
                      only_active=False):
-        """Yield projects as dicts"""
+        """Yield projects as dicts, only the projects with unclaimed jobs
+        that are not paused if only_active.
+        """
         expressions = []
         if match:
             for k, v in match.items():
                 expressions.append(self.db.model.__table__.c[k] == v)
         if only_active:
-            expressions.append(
-                self.db.model.__table__.c['nr_added'] >
-                self.db.model.__table__.c['nr_claimed'])
+            expressions.append(self._active_expression())
         whereclause = and_(*expressions) if expressions else None
         if fields:
             fields = [self.db.model.__table__.c[field] for field in fields]
@@ -142,6 +262,102 @@ class ProjectsDB:
             project_dict = dict(zip(row.keys(), row))
             yield self.decode_json(project_dict)
 
+    def get_jobs_version(self, project_id=None):
+        """Return a cheap fingerprint of the job counters of a project, or
+        of all projects if project_id is None. It changes when jobs are
+        added, claimed or released.
+        """
+        table = self.db.model.__table__
+        if project_id is None:
+            query = select([
+                func.count(), func.sum(table.c.nr_added),
+                func.sum(table.c.nr_claimed)])
+        else:
+            query = select(
+                [table.c.nr_added, table.c.nr_claimed],
+                whereclause=table.c.id == project_id)
+        return tuple(self.db.session.execute(query).first() or ())
+
+    def get_projects_with_job_types(self, job_types):
+        """Return the ids of the projects that have unclaimed jobs of any
+        of the job types.
+        """
+        table = self.job_types_db.model.__table__
+        query = select(
+            [table.c.project_id],
+            whereclause=and_(
+                table.c.type.in_(job_types),
+                table.c.nr_added > table.c.nr_claimed),
+            distinct=True)
+        return {row[0] for row in self.db.session.execute(query)}
+
+    def get_unclaimed_job_type_counts(self):
+        """Return nr of added and claimed jobs per project and job type,
+        for the job types with unclaimed jobs.
+        """
+        table = self.job_types_db.model.__table__
+        query = select(
+            [table.c.project_id, table.c.type, table.c.nr_added,
+             table.c.nr_claimed],
+            whereclause=table.c.nr_added > table.c.nr_claimed)
+        counts = {}
+        for row in self.db.session.execute(query):
+            counts.setdefault(row[0], {})[row[1]] = {
+                'nr_added': row[2], 'nr_claimed': row[3]}
+        return counts
+
+    def get_job_type_counts(self, project_id):
+        """Return nr of added and claimed jobs per job type"""
+        table = self.job_types_db.model.__table__
+        query = select(
+            [table.c.type, table.c.nr_added, table.c.nr_claimed],
+            whereclause=table.c.project_id == project_id)
+        return {
+            row[0]: {'nr_added': row[1], 'nr_claimed': row[2]}
+            for row in self.db.session.execute(query)}
+
+    def _update_job_type_counts(self, project_id, field, job_types):
+        """Increment the counter field of the job types.
+
+        Args:
+           project_id (str): The project.
+           field (str): 'nr_added' or 'nr_claimed'.
+           job_types (dict): Job type -> increment. Jobs without type are
+             not counted.
+        """
+        table = self.job_types_db.model.__table__
+        for job_type, value in (job_types or {}).items():
+            if job_type is None or not value:
+                continue
+            statement = table.update().where(and_(
+                table.c.project_id == project_id,
+                table.c.type == job_type
+            )).values({table.c[field]: table.c[field] + value})
+            if self.db.session.execute(statement).rowcount:
+                continue
+            row = {'project_id': project_id, 'type': job_type,
+                   'nr_added': 0, 'nr_claimed': 0, field: value}
+            # Inserted by someone else after the update, increment it. A
+            # failed INSERT would abort the transaction on PostgreSQL.
+            dialect = self.db.engine.dialect.name
+            if dialect == 'postgresql':
+                self.db.session.execute(
+                    postgresql.insert(table).values(row).on_conflict_do_update(
+                        index_elements=[table.c.project_id, table.c.type],
+                        set_={field: table.c[field] + value}))
+            elif dialect == 'mysql':
+                self.db.session.execute(
+                    mysql.insert(table).values(row).on_duplicate_key_update(
+                        {field: table.c[field] + value}))
+            else:
+                try:
+                    self.db.session.execute(table.insert().values(row))
+                except IntegrityError:
+                    self.db.session.execute(statement)
+        self.db.session.flush()
+        self.db.after_commit(lambda: prio_cache.job_types_updated(
+            project_id, field, job_types))
+
     @staticmethod
     def _getattr_from_column_name(job, column_name):
         """Return the value of a column in a job instance by column name"""
@@ -176,6 +392,10 @@ class ProjectsDB:
             self.db.model.id == project_id).values(values)
         result = self.db.session.execute(statement)
         self.db.session.flush()
+        if result.rowcount:
+            # A rolled back update must not move the cache
+            self.db.after_commit(
+                lambda: prio_cache.project_updated(project_id, data))
         return bool(result.rowcount)
 
     def insert_project(self, project_id, user_name, **kwargs):
@@ -193,33 +413,150 @@ class ProjectsDB:
         if project:
             self.db.session.delete(project)
             self.db.session.flush()
+        table = self.job_types_db.model.__table__
+        self.db.session.execute(
+            table.delete().where(table.c.project_id == project_id))
+        self.db.session.flush()
+        self.db.after_commit(lambda: prio_cache.clear(project_id))
 
     def project_exists(self, project_id):
         if self.db.model.query.filter_by(id=project_id).first():
             return True
         return False
 
-    def job_added(self, project_id, added=1):
+    def job_added(self, project_id, added=1, job_types=None, waiting=None):
         """Report that a job was added to this project.
 
+        job_types is a dict with nr of added jobs per job type, and waiting
+        with nr of added jobs per job type that wait for the jobs they
+        depend on. Waiting jobs are counted as claimed until they are
+        released, see jobs_released.
+
         Return False if the project does not exist.
         """
-        return self.update_project(
-            project_id, last_added_timestamp=datetime.utcnow(), nr_added=added)
+        waiting = waiting or {}
+        if not self.update_project(
+                project_id, last_added_timestamp=datetime.utcnow(),
+                nr_added=added, nr_claimed=sum(waiting.values())):
+            return False
+        self._update_job_type_counts(project_id, 'nr_added', job_types)
+        self._update_job_type_counts(project_id, 'nr_claimed', waiting)
+        return True
+
+    def job_claimed(self, project_id, claimed=1, job_types=None):
+        """Report that jobs in this project were claimed.
+
+        job_types is a dict with nr of claimed jobs per job type.
+        """
+        if not self.update_project(
+                project_id, last_claimed_timestamp=datetime.utcnow(),
+                nr_claimed=claimed):
+            return False
+        self._update_job_type_counts(project_id, 'nr_claimed', job_types)
+        return True
+
+    def job_unclaimed(self, project_id, current_status, job_type=None,
+                      processing_time=0):
+        """Report that a job in this project was released.
+
+        The finished or failed counter, and the processing time, are only
+        decreased if the job was done.
+        """
+        data = {'nr_claimed': -1}
+        if current_status == JOB_STATES.finished:
+            data['nr_finished'] = -1
+        elif current_status == JOB_STATES.failed:
+            data['nr_failed'] = -1
+        if len(data) > 1 and processing_time:
+            data['processing_time'] = -processing_time
+        if not self.update_project(project_id, **data):
+            return False
+        self._update_job_type_counts(project_id, 'nr_claimed', {job_type: -1})
+        return True
+
+    def jobs_requeued(self, project_id, job_types):
+        """Report that claimed jobs were requeued because their lease
+        expired.
+
+        job_types is a dict with nr of requeued jobs per job type.
+        """
+        if not self.update_project(
+                project_id, nr_claimed=-sum(job_types.values())):
+            return False
+        self._update_job_type_counts(
+            project_id, 'nr_claimed',
+            {job_type: -n for job_type, n in job_types.items()})
+        return True
+
+    def jobs_released(self, project_id, job_types):
+        """Report that waiting jobs were released because the jobs they
+        depend on have finished.
+
+        job_types is a dict with nr of released jobs per job type.
+        """
+        return self.jobs_requeued(project_id, job_types)
 
-    def job_claimed(self, project_id):
-        """Report that a job in this project was claimed."""
-        return self.update_project(
-            project_id, last_claimed_timestamp=datetime.utcnow(), nr_claimed=1)
+    def lock_project(self, project_id):
+        """Lock the project until the end of the transaction.
 
-    def job_unclaimed(self, project_id, failed):
-        """Report that a job in this project was released"""
-        if failed:
-            return self.update_project(
-                project_id, nr_claimed=-1, nr_failed=-1)
-        else:
-            return self.update_project(
-                project_id, nr_claimed=-1, nr_finished=-1)
+        The counters of the job types are only updated after those of the
+        project, see job_added, so they are locked as well.
+
+        Return False if the project does not exist.
+        """
+        table = self.db.model.__table__
+        query = select(
+            [table.c.id], whereclause=table.c.id == project_id
+        ).with_for_update()
+        return self.db.session.execute(query).first() is not None
+
+    def reconcile_counters(self, project_id, counts):
+        """Correct the counters of a project, and of its job types, to match
+        the counts of its jobs, see BaseJobDatabaseAPI.get_counts.
+
+        The corrections are added to the counters, so that increments made
+        by others since the jobs were counted are kept. Lock the project
+        with lock_project before counting the jobs, in the same
+        transaction, so that the counts and counters are from the same
+        snapshot and concurrent reconcilers do not apply the same
+        correction twice.
+
+        Returns:
+           dict: Counter -> correction, only the corrected counters. The
+             corrections of the job type counters are under 'job_types'.
+        """
+        project = self.get_project(project_id, fields=self.COUNTERS)
+        if not project:
+            return {}
+        corrections = {}
+        for field in self.COUNTERS:
+            delta = counts[field] - (project[field] or 0)
+            if field == 'processing_time':
+                # Sums of floats in a different order
+                if abs(delta) <= 1e-6 * max(1, abs(counts[field])):
+                    continue
+            elif not delta:
+                continue
+            corrections[field] = delta
+        if corrections:
+            self.update_project(project_id, **corrections)
+
+        job_type_counters = self.get_job_type_counts(project_id)
+        job_types = set(job_type_counters) | set(counts['job_types'])
+        for field in ['nr_added', 'nr_claimed']:
+            deltas = {}
+            for job_type in job_types:
+                delta = (
+                    counts['job_types'].get(job_type, {}).get(field, 0) -
+                    job_type_counters.get(job_type, {}).get(field, 0))
+                if delta:
+                    deltas[job_type] = delta
+            if deltas:
+                self._update_job_type_counts(project_id, field, deltas)
+                for job_type, delta in deltas.items():
+                    corrections.setdefault('job_types', {}).setdefault(
+                        job_type, {})[field] = delta
+        return corrections
 
     def job_finished(self, project_id, processing_time):
         """Report that a job in this project was finished"""
@@ -0,0 +1,242 @@
+"""Per process buffer of unclaimed jobs that are ready to be fetched"""
+import threading
+import time
+from collections import deque
+from os import environ
+
+from ..utils.logs import get_logger
+from .sqldb import SqlJobDatabase
+
+
+class _ProjectBuffer:
+
+    def __init__(self):
+        # (priority, job) in the order of the fetches
+        self.jobs = deque()
+        self.queued = set()
+        # Job id -> time when the job was handed out by a fetch
+        self.served = {}
+        self.refill_lock = threading.Lock()
+        self.refilling = False
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_time = 0.
+        self.last_refill_time = None
+        self.last_refill_at = float('-inf')
+        self.claims = 0
+        self.stale = 0
+
+
+class ReadyBuffer:
+    """Buffer of candidate unclaimed jobs per project.
+
+    Fetches pop a candidate from the buffer instead of scanning the jobs
+    table. When a project buffer gets shorter than low_water, a background
+    thread (a greenlet under the gevent workers) refills it with up to size
+    unclaimed jobs from one query. A fetch that finds the buffer empty
+    refills it in the request. Only the oldest jobs with the highest
+    priority are buffered, flush the buffer when jobs with a higher
+    priority may have been added. Jobs with a higher priority added by
+    other processes are found by the refills, which drop the buffered jobs
+    with a lower priority. A buffer is refilled at least every
+    refresh_interval seconds while jobs are fetched from it.
+
+    The buffer does not claim jobs, so a candidate may have been claimed
+    by another process when a worker tries to claim it. Such stale
+    candidates are counted when the claim is reported.
+    """
+
+    def __init__(self, size=500, low_water=100, served_ttl=60,
+                 min_refill_interval=1, refresh_interval=10,
+                 job_fields=None):
+        """
+        Args:
+           size (int): Max nr of jobs to buffer per project.
+           low_water (int): Refill when fewer jobs than this are buffered.
+           served_ttl (float): Do not buffer a job again until this many
+             seconds after it was handed out, unless there are no other
+             unclaimed jobs.
+           min_refill_interval (float): Min seconds between background
+             refills, limits the load when a project has few jobs.
+           refresh_interval (float): Max seconds between background
+             refills of a buffer that jobs are fetched from.
+           job_fields (list): The job fields to buffer.
+        """
+        self.size = size
+        self.low_water = low_water
+        self.served_ttl = served_ttl
+        self.min_refill_interval = min_refill_interval
+        self.refresh_interval = refresh_interval
+        self.job_fields = job_fields or ['id', 'source_url', 'target_url']
+        self._lock = threading.Lock()
+        self._buffers = {}
+
+    def _get_buffer(self, project):
+        with self._lock:
+            if project not in self._buffers:
+                self._buffers[project] = _ProjectBuffer()
+            return self._buffers[project]
+
+    def pop(self, project, jobs_db):
+        """Return an unclaimed job candidate or None.
+
+        Args:
+           project (str): The project.
+           jobs_db (BaseJobDatabaseAPI): Used if the buffer must be
+             refilled in this request.
+        """
+        buf = self._get_buffer(project)
+        job = self._pop(buf)
+        hit = job is not None
+        if not hit:
+            with buf.refill_lock:
+                job = self._pop(buf)
+                if job is None:
+                    self._refill(project, buf, jobs_db)
+                    job = self._pop(buf)
+        with self._lock:
+            if hit:
+                buf.hits += 1
+            else:
+                buf.misses += 1
+            start_refill = (
+                self._needs_refill(buf) and not buf.refilling and
+                time.monotonic() - buf.last_refill_at >
+                self.min_refill_interval)
+            if start_refill:
+                buf.refilling = True
+        if start_refill:
+            thread = threading.Thread(
+                target=self._background_refill, args=(project, buf))
+            thread.daemon = True
+            thread.start()
+        return job
+
+    def _needs_refill(self, buf):
+        return (len(buf.jobs) < self.low_water or
+                time.monotonic() - buf.last_refill_at > self.refresh_interval)
+
+    def _pop(self, buf):
+        with self._lock:
+            if not buf.jobs:
+                return
+            _, job = buf.jobs.popleft()
+            buf.queued.discard(job['id'])
+            buf.served[job['id']] = time.monotonic()
+            return job
+
+    def _background_refill(self, project, buf):
+        jobs_db = None
+        try:
+            with buf.refill_lock:
+                if not self._needs_refill(buf):
+                    return
+                jobs_db = SqlJobDatabase(project)
+                self._refill(project, buf, jobs_db)
+        except Exception:
+            get_logger('UService', to_stdout=True).exception(
+                "Refill of ready buffer for project {} failed".format(
+                    project))
+        finally:
+            if jobs_db:
+                jobs_db.close()
+            with self._lock:
+                buf.refilling = False
+
+    def _refill(self, project, buf, jobs_db):
+        t0 = time.monotonic()
+        with self._lock:
+            buf.served = {
+                job_id: t for job_id, t in buf.served.items()
+                if t0 - t < self.served_ttl}
+            # Look past the jobs that were handed out recently, they are
+            # probably claimed soon.
+            limit = min(self.size + len(buf.served), 4 * self.size)
+        fields = list(self.job_fields)
+        if 'priority' not in fields:
+            fields.append('priority')
+        jobs = []
+        for job in jobs_db.get_top_priority_jobs(fields, limit=limit):
+            priority = job['priority']
+            if 'priority' not in self.job_fields:
+                del job['priority']
+            jobs.append((priority, job))
+        with self._lock:
+            # The jobs of lower priorities wait until these are claimed
+            top = jobs[0][0] if jobs else None
+            buf.jobs = deque(
+                (priority, job) for priority, job in buf.jobs
+                if top is not None and priority >= top)
+            buf.queued = set(job['id'] for _, job in buf.jobs)
+            fresh = [(priority, job) for priority, job in jobs
+                     if job['id'] not in buf.served and
+                     job['id'] not in buf.queued]
+            if not fresh and not buf.jobs:
+                # All unclaimed jobs have been handed out recently, but
+                # that is better than no job at all.
+                fresh = jobs
+            for priority, job in fresh[:self.size - len(buf.jobs)]:
+                buf.jobs.append((priority, job))
+                buf.queued.add(job['id'])
+            buf.last_refill_at = time.monotonic()
+            elapsed = buf.last_refill_at - t0
+            buf.refills += 1
+            buf.refill_time += elapsed
+            buf.last_refill_time = elapsed
+
+    def report_claim(self, project, job_id, claimed):
+        """Report the result of a claim of a job.
+
+        Only claims of jobs handed out by this buffer are counted.
+        """
+        with self._lock:
+            buf = self._buffers.get(project)
+            if buf is None or job_id not in buf.served:
+                return
+            buf.claims += 1
+            if not claimed:
+                buf.stale += 1
+
+    def flush(self, project):
+        """Forget the buffered jobs of a project, but keep its stats"""
+        with self._lock:
+            buf = self._buffers.get(project)
+            if buf is not None:
+                buf.jobs.clear()
+                buf.queued.clear()
+
+    def clear(self, project):
+        """Forget all buffered jobs and stats of a project"""
+        with self._lock:
+            self._buffers.pop(project, None)
+
+    def get_stats(self):
+        """Return buffer stats per project"""
+        with self._lock:
+            return {
+                project: {
+                    'Buffered': len(buf.jobs),
+                    'Hits': buf.hits,
+                    'Misses': buf.misses,
+                    'HitRate': _ratio(buf.hits, buf.hits + buf.misses),
+                    'Refills': buf.refills,
+                    'MeanRefillTime': _ratio(buf.refill_time, buf.refills),
+                    'LastRefillTime': buf.last_refill_time,
+                    'Claims': buf.claims,
+                    'StaleCandidates': buf.stale,
+                    'StaleRate': _ratio(buf.stale, buf.claims),
+                }
+                for project, buf in self._buffers.items()
+            }
+
+
+def _ratio(numerator, denominator):
+    if not denominator:
+        return
+    return numerator / float(denominator)
+
+
+ready_buffer = ReadyBuffer(
+    size=int(environ.get('USERVICE_READY_BUFFER_SIZE', 500)),
+    low_water=int(environ.get('USERVICE_READY_BUFFER_LOW_WATER', 100)))
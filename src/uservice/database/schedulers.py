@@ -0,0 +1,402 @@
+"""Schedulers that select the project of a prio fetch.
+
+The scheduler is chosen per deployment with USERVICE_SCHEDULER. All
+schedulers select among the active projects of the prio cache and keep
+their state per process. The state, and the reason for the last pick, is
+served by the admin endpoint /rest_api/admin/scheduler.
+
+Workers can report the processing images they have cached, all
+schedulers then prefer projects with these images, see ImageAffinity.
+"""
+import threading
+from collections import Counter, deque
+from datetime import datetime
+from os import environ
+
+from .prio_cache import prio_cache
+from .projects import ProjectsDB
+
+
+class ImageAffinity:
+    """Prefer projects with processing images that the worker has cached.
+
+    A pick with affinity only selects among the projects with a cached
+    image, if there are any. To bound how far affinity can move the
+    workers away from the choices of the scheduler, a worker gets at most
+    max_boosts picks with affinity in a row, then one pick without it.
+
+    The hit rate, how often the worker got a job that uses one of its
+    cached images, is kept per worker and served by the admin endpoint
+    /rest_api/admin/image-affinity.
+    """
+
+    def __init__(self, max_boosts=10):
+        """
+        Args:
+           max_boosts (int): Max nr of picks with affinity in a row per
+             worker, 0 turns affinity off.
+        """
+        self.max_boosts = max_boosts
+        self._lock = threading.Lock()
+        # Worker -> nr of picks with affinity in a row
+        self._boosts = {}
+        # Worker -> Counter of fetches, hits and boosted picks
+        self._stats = {}
+
+    def may_boost(self, worker):
+        """Return True if the next pick of the worker may use affinity"""
+        with self._lock:
+            return self._boosts.get(worker, 0) < self.max_boosts
+
+    def record_pick(self, worker, boosted):
+        """Report a pick for the worker, with or without affinity"""
+        with self._lock:
+            if boosted:
+                self._boosts[worker] = self._boosts.get(worker, 0) + 1
+                self._stats.setdefault(worker, Counter())['Boosted'] += 1
+            else:
+                self._boosts.pop(worker, None)
+
+    def record_fetch(self, worker, images, image):
+        """Report that the worker, with images cached, got a job that uses
+        image.
+        """
+        with self._lock:
+            stats = self._stats.setdefault(worker, Counter())
+            stats['Fetches'] += 1
+            if image in images:
+                stats['Hits'] += 1
+
+    def get_stats(self):
+        """Return the hit rate and counters per worker"""
+        with self._lock:
+            return {
+                worker: {
+                    'Fetches': stats['Fetches'],
+                    'Hits': stats['Hits'],
+                    'HitRate': (stats['Hits'] / float(stats['Fetches'])
+                                if stats['Fetches'] else None),
+                    'Boosted': stats['Boosted'],
+                }
+                for worker, stats in self._stats.items()}
+
+
+class Scheduler:
+    """Select a project with unclaimed jobs.
+
+    Inherit and implement _pick and _get_state, or _select.
+    """
+
+    name = None
+
+    def __init__(self, cache=None, clock=None, affinity=None):
+        """
+        Args:
+           cache (PrioCache): The cache of active projects, default is the
+             prio_cache of the process.
+           clock (callable): Returns the current time as a datetime,
+             default is datetime.utcnow.
+           affinity (ImageAffinity): Default is the image_affinity of the
+             process.
+        """
+        self.cache = cache or prio_cache
+        self.clock = clock or datetime.utcnow
+        self.affinity = affinity or image_affinity
+        self._lock = threading.Lock()
+        self._picks = Counter()
+        self._last_pick = None
+
+    def pick_project(self, projects_db, job_types=None, fresh=False,
+                     exclude=None, worker=None, images=None):
+        """Return the id of the selected project, or None if no project
+        has unclaimed jobs.
+
+        Args:
+           projects_db (ProjectsDB): The projects database.
+           job_types (list): Only select among projects with unclaimed
+             jobs of these types.
+           fresh (bool): Refresh the prio cache before the pick.
+           exclude (set): Do not select these projects, e.g. the projects
+             that were already tried.
+           worker (str): The worker that the pick is for.
+           images (set): The processing images that the worker has
+             cached, see ImageAffinity.
+        """
+        project = None
+        boosted = bool(images) and self.affinity.may_boost(worker)
+        if boosted:
+            project = self._select(
+                projects_db, job_types, fresh, exclude, images)
+            boosted = project is not None
+        if project is None:
+            project = self._select(projects_db, job_types, fresh, exclude)
+        if project is not None and images:
+            self.affinity.record_pick(worker, boosted)
+        return project
+
+    def _select(self, projects_db, job_types, fresh, exclude, images=None):
+        """Return the selected project among the active projects, with
+        one of the images if given.
+        """
+        if fresh:
+            self.cache.expire()
+        projects = [
+            project
+            for project in self.cache.get_projects(projects_db, job_types)
+            if project['id'] not in (exclude or ()) and (
+                not images or project['processing_image_url'] in images)]
+        if not projects:
+            return
+        with self._lock:
+            project, reason = self._pick(projects_db, projects, job_types)
+            if images:
+                reason += ', with a cached image'
+            self._record_pick(project, reason)
+        return project
+
+    def _record_pick(self, project, reason):
+        if project:
+            self._picks[project] += 1
+        self._last_pick = {
+            'Project': project, 'Reason': reason,
+            'Time': self.clock().isoformat()}
+
+    def _pick(self, projects_db, projects, job_types):
+        """Return the selected project id and the reason for the pick.
+
+        Called with the lock held and a non empty list of active projects.
+        """
+        raise NotImplementedError
+
+    def project_drained(self, project, job_types=None):
+        """Report that the selected project had no unclaimed jobs, of the
+        job types if given, see PrioCache.project_drained.
+        """
+        self.cache.project_drained(project, job_types)
+
+    def get_state(self):
+        """Return the internal state of the scheduler"""
+        with self._lock:
+            state = self._get_state()
+            state.update({
+                'Scheduler': self.name,
+                'Picks': dict(self._picks),
+                'LastPick': self._last_pick,
+            })
+        return state
+
+    def _get_state(self):
+        raise NotImplementedError
+
+
+class PrioScheduler(Scheduler):
+    """Weighted random choice by prio score, see ProjectsDB.calc_prio_score
+    """
+
+    name = 'prio'
+    # Nr of top scores to show in the state
+    TOP_SCORES = 20
+
+    def _select(self, projects_db, job_types, fresh, exclude, images=None):
+        """See parent docstring.
+
+        Draws from the scores of the prio cache, without listing the
+        projects, or computes the scores in the database if fresh.
+        """
+        if fresh:
+            project = projects_db.get_prio_project(
+                job_types, exclude, images)
+            reason = 'Weighted random choice by prio score in the database'
+        else:
+            project = self.cache.get_prio_project(
+                projects_db, job_types, exclude, images)
+            reason = 'Weighted random choice by prio score'
+        if images:
+            reason += ', with a cached image'
+        if project:
+            with self._lock:
+                self._record_pick(project, reason)
+        return project
+
+    def _get_state(self):
+        scores = sorted(
+            self.cache.get_scores().items(), key=lambda item: -item[1])
+        return {'Scores': dict(scores[:self.TOP_SCORES])}
+
+
+class FairShareScheduler(Scheduler):
+    """Deficit round robin over the users that created the projects.
+
+    Every user in turn gets quantum seconds of processing time added to
+    its deficit, and is served while the deficit covers the mean
+    processing time of a job in the selected project of the user. Users
+    with long jobs get fewer jobs, but all users get about the same
+    processing time. Among the projects of a user the prio score decides.
+    """
+
+    name = 'fair-share'
+
+    def __init__(self, cache=None, clock=None, affinity=None,
+                 quantum=3600):
+        """
+        Args:
+           cache (PrioCache): See Scheduler.
+           clock (callable): See Scheduler.
+           affinity (ImageAffinity): See Scheduler.
+           quantum (float): Seconds of processing time a user gets per
+             round.
+        """
+        super(FairShareScheduler, self).__init__(cache, clock, affinity)
+        self.quantum = quantum
+        self._queue = deque()
+        self._deficits = {}
+        # True if the user first in the queue got its quantum this round
+        self._credited = False
+
+    def _pick(self, projects_db, projects, job_types):
+        by_user = {}
+        for project in projects:
+            by_user.setdefault(project['created_by_user'], []).append(
+                project)
+        # Users without active projects leave the round and lose their
+        # deficit, new users join at the end. With job types the other
+        # users may still have active projects.
+        gone = [] if job_types else [
+            user for user in self._queue if user not in by_user]
+        for user in gone:
+            if self._queue[0] == user:
+                self._credited = False
+            self._queue.remove(user)
+            del self._deficits[user]
+        for user in sorted(by_user):
+            if user not in self._deficits:
+                self._queue.append(user)
+                self._deficits[user] = 0.
+
+        now = self.clock()
+        while True:
+            user = self._queue[0]
+            if user not in by_user:
+                self._queue.rotate(-1)
+                self._credited = False
+                continue
+            if not self._credited:
+                self._deficits[user] += self.quantum
+                self._credited = True
+            scores = [(p['id'], projects_db.calc_prio_score(p, now))
+                      for p in by_user[user]]
+            project_id = (
+                projects_db.weighted_choice(scores) or scores[0][0])
+            project = next(p for p in by_user[user] if p['id'] == project_id)
+            cost = mean_processing_time(project)
+            if self._deficits[user] >= cost:
+                self._deficits[user] -= cost
+                return project_id, (
+                    'User {} has deficit {:.0f} s, a job is {:.0f} s'.format(
+                        user, self._deficits[user] + cost, cost))
+            self._queue.rotate(-1)
+            self._credited = False
+
+    def _get_state(self):
+        return {
+            'Quantum': self.quantum,
+            'Queue': list(self._queue),
+            'Deficits': dict(self._deficits),
+        }
+
+
+class DeadlineScheduler(Scheduler):
+    """Earliest deadline first.
+
+    Projects without deadline come after the ones with a deadline, oldest
+    project first. A project that has not been picked by this process for
+    max_wait seconds is picked first, so that projects with late or no
+    deadlines are not starved.
+    """
+
+    name = 'deadline'
+
+    def __init__(self, cache=None, clock=None, affinity=None,
+                 max_wait=600):
+        """
+        Args:
+           cache (PrioCache): See Scheduler.
+           clock (callable): See Scheduler.
+           affinity (ImageAffinity): See Scheduler.
+           max_wait (float): Max seconds between picks of a project.
+        """
+        super(DeadlineScheduler, self).__init__(cache, clock, affinity)
+        self.max_wait = max_wait
+        # Project -> time of last pick, or of when the project was first
+        # seen
+        self._last_picked = {}
+
+    def _pick(self, projects_db, projects, job_types):
+        now = self.clock()
+        active = {project['id'] for project in projects}
+        for project in list(self._last_picked):
+            if project not in active and not job_types:
+                del self._last_picked[project]
+        for project in active:
+            self._last_picked.setdefault(project, now)
+
+        waited, starved = max(
+            ((now - self._last_picked[project['id']]).total_seconds(),
+             project['id'])
+            for project in projects)
+        if waited > self.max_wait:
+            self._last_picked[starved] = now
+            return starved, 'Not picked for {:.0f} s'.format(waited)
+
+        project = min(projects, key=_deadline_order)
+        self._last_picked[project['id']] = now
+        if project['deadline']:
+            reason = 'Earliest deadline {}'.format(
+                project['deadline'].isoformat())
+        else:
+            reason = 'No project with deadline, oldest project'
+        return project['id'], reason
+
+    def _get_state(self):
+        now = self.clock()
+        return {
+            'MaxWait': self.max_wait,
+            'Waiting': {project: (now - t).total_seconds()
+                        for project, t in self._last_picked.items()},
+        }
+
+
+def _deadline_order(project):
+    return (project['deadline'] is None,
+            project['deadline'] or datetime.max,
+            project['created_timestamp'] or datetime.min,
+            project['id'])
+
+
+def mean_processing_time(project):
+    """Return the mean processing time of the jobs of a project, or
+    ProjectsDB.DEFAULT_MEAN_PROCESSING_TIME if no job is done yet.
+    """
+    nr_done = (project['nr_finished'] or 0) + (project['nr_failed'] or 0)
+    if not project['processing_time'] or not nr_done:
+        return ProjectsDB.DEFAULT_MEAN_PROCESSING_TIME
+    return project['processing_time'] / nr_done
+
+
+image_affinity = ImageAffinity(
+    max_boosts=int(environ.get('USERVICE_IMAGE_AFFINITY_MAX_BOOSTS', 10)))
+
+SCHEDULERS = {
+    scheduler.name: scheduler for scheduler in [
+        PrioScheduler, FairShareScheduler, DeadlineScheduler]}
+
+
+def make_scheduler(name, **kwargs):
+    """Return a new scheduler by name, kwargs are passed to the scheduler
+    """
+    if name not in SCHEDULERS:
+        raise ValueError('Unknown scheduler: %r' % name)
+    return SCHEDULERS[name](**kwargs)
+
+
+scheduler = make_scheduler(environ.get('USERVICE_SCHEDULER', 'prio'))
@@ -1,15 +1,24 @@
+import hashlib
+import json
+import random
+from collections import Counter, OrderedDict
 from datetime import datetime
 from operator import itemgetter
 
 from sqlalchemy import (
-    and_, false, func, select, distinct as sqldistinct, inspect)
+    and_, or_, false, true, func, select, distinct as sqldistinct, inspect,
+    desc)
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.ext.declarative.base import _declarative_constructor
 from sqlalchemy import (
-    Column, TIMESTAMP as DateTime, String, Text, Boolean, Float, Index)
+    Column, TIMESTAMP as DateTime, String, Text, Boolean, Float, Integer,
+    Index)
 
 from ..utils.defs import JOB_STATES, TIME_PERIODS, TIME_PERIOD_TO_DELTA
-from .basedb import BaseJobDatabaseAPI, STATE_TO_TIMESTAMP
+from .basedb import (
+    BaseJobDatabaseAPI, STATE_TO_TIMESTAMP, DONE_STATES, DBError,
+    DBConflictError)
 from .basesqldb import SqlDB
 
 MODELS = {}
@@ -32,6 +41,8 @@ class JobBase:
     source_url = Column(String(512))
     target_url = Column(String(512))
     view_result_url = Column(String(512))
+    # Hash of the fields set by the user, see SqlJobDatabase.content_hash
+    content_hash = Column(String(64))
 
     # Job status data
     added_timestamp = Column(DateTime(), default=datetime.utcnow, index=True)
@@ -44,10 +55,21 @@ class JobBase:
     finished_timestamp = Column(DateTime(), index=True)
     failed_timestamp = Column(DateTime(), index=True)
     processing_time = Column(Float)
+    # Claimed jobs are requeued when their lease has expired
+    lease_expires = Column(DateTime(), index=True)
+    # Nr of jobs in depends_on that are not finished. Waiting jobs are
+    # stored as claimed, so that they are not claimable and are counted
+    # as claimed by the project counters until they are released.
+    pending_parents = Column(Integer, default=0)
+    # Fetches and claims take the unclaimed jobs with the highest priority
+    priority = Column(Integer, default=0)
 
     @declared_attr
     def __table_args__(cls):
-        return (Index('claimed_idx', "claimed", "type"), )
+        return (Index('claimed_idx', "claimed", "type"),
+                Index('claimed_id_idx', "claimed", "id"),
+                Index('claimed_priority_idx', "claimed", desc("priority"),
+                      "added_timestamp"))
 
 
 def _job_constructor(self, **kwargs):
@@ -66,10 +88,43 @@ def get_job_model(project):
     return Job
 
 
+class DependencyBase:
+    """A job (child_id) that depends on another job (parent_id)"""
+
+    @declared_attr
+    def __tablename__(cls):
+        return 'deps_%s' % cls.__name__[len('Dependency'):]
+
+    parent_id = Column(String(64), primary_key=True)
+    child_id = Column(String(64), primary_key=True)
+
+DependencyModelBase = declarative_base(cls=DependencyBase)
+DEPENDENCY_MODELS = {}
+
+
+def get_dependency_model(project):
+    if project in DEPENDENCY_MODELS:
+        return DEPENDENCY_MODELS[project]
+    Dependency = type(
+        'Dependency{}'.format(project), (DependencyModelBase,), {})
+    DEPENDENCY_MODELS[project] = Dependency
+    return Dependency
+
+
 class SqlJobDatabase(BaseJobDatabaseAPI):
 
+    # Used by claim_next_job when the database does not support
+    # SKIP LOCKED: nr of candidate jobs to select per round and max nr of
+    # rounds before giving up.
+    CLAIM_CANDIDATES = 50
+    CLAIM_ROUNDS = 3
+    # Nr of ids per IN query and of rows per INSERT when jobs are inserted
+    # in bulk
+    BULK_CHUNK = 1000
+
     def __init__(self, project):
         self.db = SqlDB(get_job_model(project))
+        self.deps_db = SqlDB(get_dependency_model(project))
         super(SqlJobDatabase, self).__init__(project)
 
     @staticmethod
@@ -95,7 +150,11 @@ class SqlJobDatabase(BaseJobDatabaseAPI):
         expressions = []
         if match:
             for k, v in match.items():
-                expressions.append(self.db.model.__table__.c[k] == v)
+                column = self.db.model.__table__.c[k]
+                if isinstance(v, (list, tuple, set)):
+                    expressions.append(column.in_(v))
+                else:
+                    expressions.append(column == v)
         timestamp_col = None
         if time_field:
             timestamp_col = getattr(self.db.model, time_field)
@@ -112,6 +171,102 @@ class SqlJobDatabase(BaseJobDatabaseAPI):
             job_dict = dict(zip(row.keys(), row))
             yield job_dict
 
+    def get_unclaimed_jobs(self, fields, job_types=None, after_id=None,
+                           until_id=None, limit=None, priority=None):
+        """See parent docstring.
+
+        Without job types the (claimed, id) index serves the query.
+        """
+        table = self.db.model.__table__
+        fields = list(fields)
+        if 'id' not in fields:
+            fields.insert(0, 'id')
+        expressions = [table.c.claimed == false()]
+        if job_types:
+            expressions.append(table.c.type.in_(job_types))
+        if after_id is not None:
+            expressions.append(table.c.id > after_id)
+        if until_id is not None:
+            expressions.append(table.c.id <= until_id)
+        if priority is not None:
+            expressions.append(table.c.priority == priority)
+        query = select(
+            [table.c[field] for field in fields],
+            whereclause=and_(*expressions), order_by=table.c.id, limit=limit)
+        return [dict(zip(row.keys(), row))
+                for row in self.db.session.execute(query)]
+
+    def get_unclaimed_id_range(self, job_types=None, priority=None):
+        """See parent docstring"""
+        table = self.db.model.__table__
+        expressions = [table.c.claimed == false()]
+        if job_types:
+            expressions.append(table.c.type.in_(job_types))
+        if priority is not None:
+            expressions.append(table.c.priority == priority)
+        query = select(
+            [func.min(table.c.id), func.max(table.c.id)],
+            whereclause=and_(*expressions))
+        return tuple(self.db.session.execute(query).first())
+
+    def get_top_priority(self, job_types=None):
+        """See parent docstring"""
+        lowest, highest = self._get_priority_range(job_types)
+        if lowest == highest:
+            return None
+        return highest
+
+    def _get_priority_range(self, job_types=None):
+        """Return the lowest and highest priority of the unclaimed jobs, of
+        the job types if given, or (None, None) if there are none.
+
+        Without job types the (claimed, priority, added_timestamp) index
+        serves the query.
+        """
+        table = self.db.model.__table__
+        expressions = [table.c.claimed == false()]
+        if job_types:
+            expressions.append(table.c.type.in_(job_types))
+        return tuple(self.db.session.execute(select(
+            [func.min(table.c.priority), func.max(table.c.priority)],
+            whereclause=and_(*expressions))).first())
+
+    def get_top_priority_jobs(self, fields, job_types=None, limit=None):
+        """See parent docstring.
+
+        The jobs are selected by the highest priority and read in the
+        order of the (claimed, priority, added_timestamp) index, also with
+        job types and by databases that ignore DESC in indexes.
+        """
+        highest = self._get_priority_range(job_types)[1]
+        if highest is None:
+            return []
+        table = self.db.model.__table__
+        fields = list(fields)
+        if 'id' not in fields:
+            fields.insert(0, 'id')
+        expressions = [table.c.claimed == false(),
+                       table.c.priority == highest]
+        if job_types:
+            expressions.append(table.c.type.in_(job_types))
+        query = select(
+            [table.c[field] for field in fields],
+            whereclause=and_(*expressions),
+            order_by=table.c.added_timestamp, limit=limit)
+        return [dict(zip(row.keys(), row))
+                for row in self.db.session.execute(query)]
+
+    def set_priority(self, job_ids, priority):
+        """See parent docstring"""
+        table = self.db.model.__table__
+        updated = 0
+        with self.db.transaction() as session:
+            for offset in range(0, len(job_ids), self.BULK_CHUNK):
+                updated += session.execute(table.update().where(
+                    table.c.id.in_(job_ids[offset:offset + self.BULK_CHUNK])
+                ).values(priority=priority)).rowcount
+        return updated
+
     def count_jobs(self, group_by='current_status'):
         group_by = getattr(self.db.model, group_by)
         query = select([func.count('*'), group_by], group_by=group_by)
@@ -172,16 +327,379 @@ class SqlJobDatabase(BaseJobDatabaseAPI):
             return True
         return False
 
-    def claim_job(self, job_id):
-        """Claim a job, return True if the job was claimed"""
+    def claim_job(self, job_id, worker, now=None, lease_time=None,
+                  fields=None):
+        """See parent docstring.
+
+        The job is claimed with one conditional update, the fields are read
+        in the same transaction.
+        """
+        claim_data = self.get_claim_data(worker, now, lease_time)
+        with self.db.transaction() as session:
+            if not self._claim_if_unclaimed(job_id, claim_data):
+                return
+            claimed = {}
+            if fields:
+                table = self.db.model.__table__
+                row = session.execute(select(
+                    [table.c[field] for field in fields],
+                    whereclause=table.c.id == job_id)).first()
+                claimed.update(zip(row.keys(), row))
+        claimed.update(claim_data)
+        return claimed
+
+    def _claim_if_unclaimed(self, job_id, data):
+        """Update the job with data if it is not claimed, return True if
+        the job was updated.
+        """
         statement = self.db.model.__table__.update().where(
             and_(self.db.model.id == job_id,
-                 self.db.model.claimed == false())).values(
-                     claimed=True)
+                 self.db.model.claimed == false())).values(**data)
         result = self.db.session.execute(statement)
         self.db.session.flush()
         return bool(result.rowcount)
 
+    def _supports_skip_locked(self):
+        """Return True if the database supports
+        SELECT ... FOR UPDATE SKIP LOCKED.
+        """
+        dialect = self.db.engine.dialect
+        version = dialect.server_version_info or ()
+        if dialect.name == 'postgresql':
+            return version >= (9, 5)
+        if dialect.name == 'mysql':
+            if getattr(dialect, '_is_mariadb', False):
+                return version >= (10, 6)
+            return version >= (8, 0, 1)
+        return False
+
+    def claim_next_job(self, worker, job_types=None, now=None, fields=None,
+                       lease_time=None, projects_db=None):
+        """See parent docstring"""
+        jobs = self.claim_jobs(
+            worker, 1, job_types=job_types, now=now, fields=fields,
+            lease_time=lease_time, projects_db=projects_db)
+        return jobs[0] if jobs else None
+
+    def claim_jobs(self, worker, n, job_types=None, now=None, fields=None,
+                   lease_time=None, projects_db=None):
+        """See parent docstring.
+
+        The jobs are claimed from the highest priority, and from the next
+        one if it runs out, oldest first. Uses SELECT ... FOR UPDATE SKIP
+        LOCKED when supported, so that concurrent claims never wait for or
+        collide on the same rows and the jobs of a priority are claimed
+        with one update. Otherwise candidates are claimed optimistically
+        with conditional updates.
+
+        Every round of claims is a transaction of its own, and the
+        candidates are read outside of it, so that the next round sees the
+        claims that others have committed, also under REPEATABLE READ.
+        Do not call this in a transaction.
+        """
+        fields = list(fields or self.PUBLIC_FIELDS)
+        if 'id' not in fields:
+            fields.insert(0, 'id')
+        table = self.db.model.__table__
+        columns = [table.c[field] for field in fields]
+        if projects_db is not None and 'type' not in fields:
+            # Needed to count the claimed jobs per job type
+            columns.append(table.c.type)
+        claim_data = self.get_claim_data(worker, now, lease_time)
+
+        jobs = []
+        while len(jobs) < n:
+            highest = self._get_priority_range(job_types)[1]
+            if highest is None:
+                break
+            # Served by the (claimed, priority, added_timestamp) index
+            expressions = [table.c.claimed == false(),
+                           table.c.priority == highest]
+            if job_types:
+                expressions.append(table.c.type.in_(job_types))
+            if self._supports_skip_locked():
+                claimed = self._claim_skip_locked(
+                    n - len(jobs), columns, expressions, claim_data,
+                    projects_db)
+            else:
+                claimed = self._claim_optimistic(
+                    n - len(jobs), columns, expressions, claim_data,
+                    projects_db)
+            if not claimed:
+                break
+            jobs.extend(claimed)
+        for job in jobs:
+            if 'type' not in fields:
+                job.pop('type', None)
+            job.update(
+                (k, v) for k, v in claim_data.items() if k in job)
+        return jobs
+
+    def _claim_skip_locked(self, n, columns, expressions, claim_data,
+                           projects_db=None):
+        with self.db.transaction() as session:
+            query = select(
+                columns, whereclause=and_(*expressions),
+                order_by=self.db.model.__table__.c.added_timestamp, limit=n
+            ).with_for_update(skip_locked=True)
+            jobs = [dict(zip(row.keys(), row))
+                    for row in session.execute(query)]
+            if jobs:
+                statement = self.db.model.__table__.update().where(
+                    self.db.model.id.in_([job['id'] for job in jobs])
+                ).values(**claim_data)
+                session.execute(statement)
+                self._count_claimed(projects_db, jobs)
+        return jobs
+
+    def _claim_optimistic(self, n, columns, expressions, claim_data,
+                          projects_db=None):
+        query = select(
+            columns, whereclause=and_(*expressions),
+            order_by=self.db.model.__table__.c.added_timestamp,
+            limit=max(n, self.CLAIM_CANDIDATES))
+        jobs = []
+        for _ in range(self.CLAIM_ROUNDS):
+            candidates = [dict(zip(row.keys(), row))
+                          for row in self.db.session.execute(query)]
+            if not candidates:
+                break
+            random.shuffle(candidates)
+            claimed = []
+            with self.db.transaction():
+                for job in candidates:
+                    if self._claim_if_unclaimed(job['id'], claim_data):
+                        claimed.append(job)
+                        if len(jobs) + len(claimed) == n:
+                            break
+                self._count_claimed(projects_db, claimed)
+            jobs.extend(claimed)
+            if len(jobs) == n:
+                break
+        return jobs
+
+    def _count_claimed(self, projects_db, jobs):
+        if projects_db is None or not jobs:
+            return
+        projects_db.job_claimed(
+            self.project, claimed=len(jobs),
+            job_types=Counter(job['type'] for job in jobs))
+
+    def update_status(self, job_id, new_state, processing_time=0, now=None,
+                      projects_db=None, worker=None):
+        """See parent docstring.
+
+        The job is updated with one UPDATE conditional on that it is
+        claimed and neither done nor waiting, in the same transaction as
+        the project counters. The job is only read when nothing was
+        updated.
+        """
+        if new_state == JOB_STATES.waiting:
+            self._check_status_change(None, new_state)
+        table = self.db.model.__table__
+        expressions = [
+            table.c.id == job_id,
+            table.c.claimed == true(),
+            or_(table.c.current_status.is_(None),
+                table.c.current_status.notin_(
+                    DONE_STATES + (JOB_STATES.waiting,)))]
+        if worker is not None:
+            expressions.append(table.c.worker == worker)
+        statement = table.update().where(and_(*expressions)).values(
+            **self.get_status_data(new_state, processing_time, now))
+        with self.db.transaction() as session:
+            if session.execute(statement).rowcount:
+                self._count_status(projects_db, new_state, processing_time)
+                if new_state == JOB_STATES.finished:
+                    self._release_children(job_id, projects_db)
+                return True
+        job = self.get_job(
+            job_id, fields=['current_status', self.CLAIMED, self.WORKER])
+        if not job:
+            raise DBError('Job does not exist')
+        if job['current_status'] not in DONE_STATES:
+            self._check_claimed(job, worker)
+        if self._check_status_change(job['current_status'], new_state):
+            raise DBConflictError('The job was changed by someone else')
+        return False
+
+    def _release_children(self, job_id, projects_db=None):
+        """Count down the pending parents of the jobs that wait for this
+        finished job, and make those without pending parents available.
+
+        The dependencies on the job are locked and deleted, so that each is
+        counted down once, also when the job is unclaimed and finished
+        again.
+        """
+        deps = self.deps_db.model.__table__
+        session = self.db.session
+        child_ids = [row[0] for row in session.execute(select(
+            [deps.c.child_id], deps.c.parent_id == job_id
+        ).with_for_update())]
+        if not child_ids:
+            return
+        session.execute(deps.delete().where(deps.c.parent_id == job_id))
+        self._count_down_parents(Counter(child_ids), projects_db)
+
+    def release_stranded_jobs(self, projects_db=None):
+        """Count down the dependencies of waiting jobs on finished parents
+        that did not find them, and release the jobs without pending
+        parents. A parent that is added and finished while its children
+        are added can miss them, see _get_pending_dependencies.
+
+        Returns:
+           int: Nr of dependencies that were counted down.
+        """
+        table = self.db.model.__table__
+        deps = self.deps_db.model.__table__
+        session = self.db.session
+        query = select([deps.c.parent_id, deps.c.child_id], and_(
+            deps.c.parent_id.in_(select(
+                [table.c.id], table.c.current_status == JOB_STATES.finished)),
+            deps.c.child_id.in_(select(
+                [table.c.id], table.c.current_status == JOB_STATES.waiting))))
+        counts = Counter()
+        for parent_id, child_id in session.execute(query).fetchall():
+            # Only the dependencies that are not counted down concurrently
+            if session.execute(deps.delete().where(and_(
+                    deps.c.parent_id == parent_id,
+                    deps.c.child_id == child_id))).rowcount:
+                counts[child_id] += 1
+        if counts:
+            self._count_down_parents(counts, projects_db)
+        return sum(counts.values())
+
+    def _count_down_parents(self, counts, projects_db=None):
+        """Count down the pending parents of waiting jobs and make those
+        without pending parents available.
+
+        Args:
+           counts (Counter): Job id -> nr of finished parents.
+           projects_db (ProjectsDB): If given, the released jobs are
+             counted as unclaimed.
+        """
+        table = self.db.model.__table__
+        session = self.db.session
+        by_count = {}
+        for child_id, count in counts.items():
+            by_count.setdefault(count, []).append(child_id)
+        for count, child_ids in sorted(by_count.items()):
+            for offset in range(0, len(child_ids), self.BULK_CHUNK):
+                session.execute(table.update().where(and_(
+                    table.c.id.in_(child_ids[offset:offset + self.BULK_CHUNK]),
+                    table.c.current_status == JOB_STATES.waiting)).values(
+                        pending_parents=table.c.pending_parents - count))
+        # The released jobs are counted and locked first, so that the
+        # counts match the updated jobs
+        child_ids = sorted(counts)
+        job_types = Counter()
+        for offset in range(0, len(child_ids), self.BULK_CHUNK):
+            released = and_(
+                table.c.id.in_(child_ids[offset:offset + self.BULK_CHUNK]),
+                table.c.current_status == JOB_STATES.waiting,
+                table.c.pending_parents <= 0)
+            chunk_types = Counter(row[0] for row in session.execute(
+                select([table.c.type], whereclause=released
+                       ).with_for_update()))
+            if not chunk_types:
+                continue
+            session.execute(table.update().where(released).values(
+                claimed=False, current_status=JOB_STATES.available))
+            job_types.update(chunk_types)
+        if job_types and projects_db is not None:
+            projects_db.jobs_released(self.project, job_types)
+
+    def extend_lease(self, job_id, worker, now=None, lease_time=None):
+        """See parent docstring"""
+        lease_time = lease_time or self.DEFAULT_LEASE_TIME
+        if not lease_time:
+            return
+        lease_expires = (now or datetime.utcnow()) + lease_time
+        table = self.db.model.__table__
+        statement = table.update().where(
+            and_(table.c.id == job_id,
+                 table.c.claimed == true(),
+                 table.c.worker == worker,
+                 table.c.lease_expires.isnot(None))
+        ).values(lease_expires=lease_expires)
+        result = self.db.session.execute(statement)
+        self.db.session.flush()
+        return lease_expires if result.rowcount else None
+
+    def requeue_expired_jobs(self, now=None):
+        """See parent docstring.
+
+        Done with one update that only touches the expired jobs through the
+        index on lease_expires, finished and failed jobs have no lease. The
+        expired jobs are counted and locked first, so that the counts match
+        the updated jobs.
+        """
+        table = self.db.model.__table__
+        expired = table.c.lease_expires < (now or datetime.utcnow())
+        with self.db.transaction() as session:
+            query = select(
+                [table.c.type], whereclause=expired).with_for_update()
+            counts = Counter(row[0] for row in session.execute(query))
+            if counts:
+                session.execute(table.update().where(expired).values(
+                    claimed=False, current_status=JOB_STATES.available,
+                    worker=None, claimed_timestamp=None, lease_expires=None))
+        return counts
+
+    def get_counts(self):
+        """See parent docstring.
+
+        The jobs are counted per (claimed, type) from claimed_idx and the
+        done jobs per state from the index on current_status, the rows are
+        only read to sum the processing time of the done jobs. All jobs are
+        counted, not only those past the watermark, since claims and status
+        changes update older jobs.
+        """
+        table = self.db.model.__table__
+        counts = {
+            'nr_added': 0, 'nr_claimed': 0, 'nr_finished': 0,
+            'nr_failed': 0, 'processing_time': 0., 'job_types': {}}
+        query = select(
+            [table.c.claimed, table.c.type, func.count()],
+            group_by=[table.c.claimed, table.c.type])
+        for claimed, job_type, nr_jobs in self.db.session.execute(query):
+            claimed = nr_jobs if claimed else 0
+            counts['nr_added'] += nr_jobs
+            counts['nr_claimed'] += claimed
+            if job_type is None:
+                continue
+            type_counts = counts['job_types'].setdefault(
+                job_type, {'nr_added': 0, 'nr_claimed': 0})
+            type_counts['nr_added'] += nr_jobs
+            type_counts['nr_claimed'] += claimed
+        query = select(
+            [table.c.current_status, func.count(),
+             func.sum(table.c.processing_time)],
+            whereclause=and_(
+                table.c.current_status.in_(DONE_STATES),
+                table.c.claimed == true()),
+            group_by=table.c.current_status)
+        for state, nr_jobs, processing_time in self.db.session.execute(
+                query):
+            field = ('nr_finished' if state == JOB_STATES.finished
+                     else 'nr_failed')
+            counts[field] = nr_jobs
+            counts['processing_time'] += processing_time or 0
+        return counts
+
+    def get_watermark(self):
+        """See parent docstring.
+
+        The timestamp columns are indexed, so this is a few index lookups.
+        """
+        table = self.db.model.__table__
+        query = select([
+            func.max(table.c.added_timestamp),
+            func.max(table.c.claimed_timestamp),
+            func.max(table.c.finished_timestamp),
+            func.max(table.c.failed_timestamp)])
+        return tuple(self.db.session.execute(query).first())
+
     def _update_job(self, job_id, data):
         """
         Args:
@@ -208,14 +726,230 @@ class SqlJobDatabase(BaseJobDatabaseAPI):
         self.db.session.flush()
         return bool(result.rowcount)
 
+    @classmethod
+    def content_hash(cls, job):
+        """Return a hash of the fields of the job that are set by the
+        user, missing fields count as None.
+        """
+        data = {}
+        for field in cls.SET_BY_USER:
+            value = job.get(field)
+            if field == 'priority':
+                # Not part of the content, the priority of an existing job
+                # can be changed with set_priority
+                continue
+            if field == 'depends_on':
+                # Left out when empty, so that hashes stored before jobs
+                # had dependencies stay valid
+                if not value:
+                    continue
+                value = sorted(set(value))
+            data[field] = None if value is None else str(value)
+        return hashlib.sha256(
+            json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def insert_job_if_not_duplicate(self, job_id, job_data):
+        """See parent docstring.
+
+        The job conflicts with an existing job with the same id unless
+        they have the same content_hash.
+        """
+        if job_data.get('id') != job_id:
+            job_data = dict(job_data, id=job_id)
+        with self.db.transaction():
+            inserted, conflicts = self._insert_jobs([job_data])
+            if conflicts:
+                raise DBConflictError(
+                    "A job with id {} already exists.".format(job_id))
+        return len(inserted)
+
+    def insert_jobs_if_not_duplicate(self, jobs, start=0):
+        """See parent docstring.
+
+        A job conflicts with an existing or earlier posted job with the
+        same id unless they have the same content_hash.
+        """
+        with self.db.transaction():
+            inserted, conflicts = self._insert_jobs(jobs)
+            if conflicts:
+                raise DBConflictError("\n".join(
+                    "Job#{}: A job with id {} already exists.".format(
+                        start + job_number, jobs[job_number]['id'])
+                    for job_number in conflicts))
+        return inserted
+
+    def _insert_jobs(self, jobs):
+        """Insert the jobs that do not exist, return the inserted jobs and
+        the indices of the conflicting jobs. Nothing more is inserted after
+        a conflict, the caller should roll back.
+
+        Per BULK_CHUNK ids one query selects the hashes of the existing
+        jobs and one INSERT adds the new jobs, so posting jobs that already
+        exist costs one query per chunk. The INSERT skips ids that were
+        added concurrently, their hashes are checked after, see
+        _insert_rows.
+        """
+        hashes = [self.content_hash(job) for job in jobs]
+        conflicts = []
+        first = OrderedDict()
+        for job_number, job in enumerate(jobs):
+            if job['id'] not in first:
+                first[job['id']] = job_number
+            elif hashes[first[job['id']]] != hashes[job_number]:
+                conflicts.append(job_number)
+
+        ids = list(first)
+        table = self.db.model.__table__
+        fields = set(field for field in self.SET_BY_USER.union(*jobs)
+                     if field in table.c)
+        inserted = []
+        for offset in range(0, len(ids), self.BULK_CHUNK):
+            chunk = ids[offset:offset + self.BULK_CHUNK]
+            existing = self._get_content_hashes(chunk)
+            for job_id in chunk:
+                if job_id in existing and (
+                        existing[job_id] != hashes[first[job_id]]):
+                    conflicts.append(first[job_id])
+            new_ids = [job_id for job_id in chunk if job_id not in existing]
+            if conflicts or not new_ids:
+                continue
+            new_jobs = [jobs[first[job_id]] for job_id in new_ids]
+            dependencies = self._get_pending_dependencies(new_jobs)
+            pending = Counter(child_id for _, child_id in dependencies)
+            # Every row of a multi-row INSERT needs the same keys
+            rows = []
+            for job in new_jobs:
+                row = {field: job.get(field) for field in fields}
+                row.update(
+                    content_hash=hashes[first[job['id']]],
+                    pending_parents=pending[job['id']],
+                    priority=job.get('priority') or 0,
+                    claimed=bool(pending[job['id']]),
+                    current_status=(
+                        JOB_STATES.waiting if pending[job['id']]
+                        else JOB_STATES.available))
+                if job.get('depends_on'):
+                    job['pending_parents'] = pending[job['id']]
+                rows.append(row)
+            inserted_ids = self._insert_rows(table, rows)
+            skipped = [job_id for job_id in new_ids
+                       if job_id not in inserted_ids]
+            if skipped:
+                # Added by someone else, they are not counted as inserted
+                for job_id, value in self._get_content_hashes(
+                        skipped).items():
+                    if value != hashes[first[job_id]]:
+                        conflicts.append(first[job_id])
+            self._insert_dependencies([
+                (parent_id, child_id) for parent_id, child_id in dependencies
+                if child_id in inserted_ids])
+            inserted.extend(
+                job for job in new_jobs if job['id'] in inserted_ids)
+        return inserted, sorted(conflicts)
+
+    def _insert_rows(self, table, rows):
+        """Insert the rows with ids that do not exist, return the ids of
+        the inserted rows.
+
+        PostgreSQL returns them from one multi-row INSERT. Elsewhere one
+        executemany INSERT runs in a savepoint, and if its rowcount shows
+        that rows were skipped it is rolled back and the rows are inserted
+        one at a time. SQLite inserts one at a time, which is what its
+        executemany does, since pysqlite does not support savepoints.
+        """
+        session = self.db.session
+        dialect = self.db.engine.dialect
+        statement = self._insert_new(table)
+        if dialect.name == 'postgresql':
+            return set(row[0] for row in session.execute(
+                statement.values(rows).returning(table.c.id)))
+        if dialect.name != 'sqlite' and dialect.supports_sane_multi_rowcount:
+            savepoint = session.begin_nested()
+            if session.execute(statement, rows).rowcount == len(rows):
+                savepoint.commit()
+                return set(row['id'] for row in rows)
+            savepoint.rollback()
+        return set(row['id'] for row in rows
+                   if session.execute(statement, row).rowcount)
+
+    def _get_pending_dependencies(self, jobs):
+        """Return the dependencies (parent_id, child_id) of the new jobs on
+        parents that are not finished.
+
+        The parents are read with a shared lock, so that they cannot finish
+        before the dependencies are committed. A parent that does not exist
+        yet is not locked, see release_stranded_jobs.
+        """
+        dependencies = set(
+            (parent_id, job['id']) for job in jobs
+            for parent_id in job.get('depends_on') or ())
+        if not dependencies:
+            return []
+        table = self.db.model.__table__
+        parent_ids = sorted(set(parent_id for parent_id, _ in dependencies))
+        finished = set()
+        for offset in range(0, len(parent_ids), self.BULK_CHUNK):
+            query = select(
+                [table.c.id, table.c.current_status],
+                table.c.id.in_(parent_ids[offset:offset + self.BULK_CHUNK])
+            ).with_for_update(read=True)
+            finished.update(
+                job_id for job_id, status in self.db.session.execute(query)
+                if status == JOB_STATES.finished)
+        return sorted((parent_id, child_id)
+                      for parent_id, child_id in dependencies
+                      if parent_id not in finished)
+
+    def _insert_dependencies(self, dependencies):
+        """Store the dependencies (parent_id, child_id)"""
+        deps = self.deps_db.model.__table__
+        rows = [{'parent_id': parent_id, 'child_id': child_id}
+                for parent_id, child_id in dependencies]
+        for offset in range(0, len(rows), self.BULK_CHUNK):
+            self.db.session.execute(
+                self._insert_new(deps), rows[offset:offset + self.BULK_CHUNK])
+
+    def _get_content_hashes(self, ids):
+        """Return the content hashes of the jobs with these ids"""
+        table = self.db.model.__table__
+        hashes = dict(self.db.session.execute(
+            select([table.c.id, table.c.content_hash],
+                   table.c.id.in_(ids))).fetchall())
+        unhashed = [job_id for job_id, value in hashes.items()
+                    if value is None]
+        if unhashed:
+            # Jobs added before the content_hash column
+            columns = [table.c[field] for field in sorted(self.SET_BY_USER)
+                       if field in table.c]
+            for row in self.db.session.execute(
+                    select(columns, table.c.id.in_(unhashed))):
+                hashes[row['id']] = self.content_hash(dict(row))
+        return hashes
+
+    def _insert_new(self, table):
+        """Return an INSERT statement that skips rows with existing primary
+        keys.
+        """
+        dialect = self.db.engine.dialect.name
+        if dialect == 'postgresql':
+            return postgresql.insert(table).on_conflict_do_nothing()
+        if dialect == 'mysql':
+            # ON DUPLICATE KEY UPDATE would count the skipped rows as
+            # affected, since the dialect sets the FOUND_ROWS flag
+            return table.insert().prefix_with('IGNORE')
+        if dialect == 'sqlite':
+            return table.insert().prefix_with('OR IGNORE')
+        return table.insert()
+
     def _insert_job(self, job_id, job):
-        job = self.db.model(**job)
-        self.db.session.add(job)
-        self.db.session.flush()
+        with self.db.transaction():
+            self._insert_jobs([dict(job, id=job_id)])
 
     def close(self):
         self.db.session.remove()
 
     def drop(self):
         self.db.model.__table__.drop(self.db.session.bind, checkfirst=True)
+        self.deps_db.model.__table__.drop(
+            self.db.session.bind, checkfirst=True)
         self.db.session.flush()
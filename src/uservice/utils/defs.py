@@ -8,6 +8,8 @@ def enum(**enums):
 
 
 JOB_STATES = enum(
+    # Waits for the jobs it depends on to finish
+    waiting='WAITING',
     available='AVAILABLE',
     claimed='CLAIMED',
     started='STARTED',
@@ -27,3 +29,9 @@ TIME_PERIOD_TO_DELTA = {
     TIME_PERIODS.daily: timedelta(days=1),
     TIME_PERIODS.hourly: timedelta(hours=1),
 }
+
+IMPORT_STATES = enum(
+    queued='QUEUED',
+    running='RUNNING',
+    done='DONE',
+    failed='FAILED')
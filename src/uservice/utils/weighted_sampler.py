@@ -0,0 +1,132 @@
+"""Weighted random sampling with a Fenwick tree"""
+import random
+
+
+class WeightedSampler:
+    """Sample keys with probability proportional to their weights.
+
+    The weights are kept in a Fenwick (binary indexed) tree, so that
+    setting the weight of a key and drawing a key are O(log n). Removed
+    keys leave a zero weight slot that is reused by the next new key.
+    """
+
+    def __init__(self, weights=None):
+        """
+        Args:
+           weights (iterable): (key, weight) pairs to start with.
+        """
+        self._keys = []
+        self._weights = []
+        self._index = {}
+        self._free = []
+        # 1-based Fenwick tree of the weights
+        self._tree = [0.]
+        for key, weight in weights or []:
+            self._index[key] = len(self._keys)
+            self._keys.append(key)
+            self._weights.append(float(weight))
+            self._tree.append(float(weight))
+        # Build in O(n)
+        for i in range(1, len(self._tree)):
+            parent = i + (i & -i)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    @property
+    def total(self):
+        """Sum of all weights"""
+        return self._prefix_sum(len(self._keys))
+
+    def get(self, key):
+        """Return the weight of a key, 0 if it is not in the sampler"""
+        if key not in self._index:
+            return 0.
+        return self._weights[self._index[key]]
+
+    def set(self, key, weight):
+        """Set the weight of a key, add the key if it is new"""
+        weight = float(weight)
+        if key not in self._index:
+            if self._free:
+                i = self._free.pop()
+            else:
+                i = self._append()
+            self._keys[i] = key
+            self._index[key] = i
+        i = self._index[key]
+        delta = weight - self._weights[i]
+        self._weights[i] = weight
+        self._add(i + 1, delta)
+
+    def remove(self, key):
+        """Remove a key, nothing happens if it is not in the sampler"""
+        if key not in self._index:
+            return
+        self.set(key, 0)
+        i = self._index.pop(key)
+        self._keys[i] = None
+        self._free.append(i)
+
+    def sample(self):
+        """Return a random key, or None if all weights are zero"""
+        total = self.total
+        if total <= 0:
+            return
+        return self.find(random.uniform(0, total))
+
+    def find(self, value):
+        """Return the first key where the cumulative weight, in insertion
+        order, reaches value. Keys with zero weight are never returned.
+        """
+        n = len(self._keys)
+        if not n:
+            return
+        pos = 0
+        step = 1 << (n.bit_length() - 1)
+        remaining = value
+        while step:
+            nxt = pos + step
+            if nxt <= n and self._tree[nxt] < remaining:
+                pos = nxt
+                remaining -= self._tree[nxt]
+            step >>= 1
+        # pos is the 0-based index of the key, step past zero weights and
+        # rounding errors at the end
+        while pos < n and self._weights[pos] <= 0:
+            pos += 1
+        if pos == n:
+            pos = n - 1
+            while pos >= 0 and self._weights[pos] <= 0:
+                pos -= 1
+            if pos < 0:
+                return
+        return self._keys[pos]
+
+    def _append(self):
+        i = len(self._keys)
+        self._keys.append(None)
+        self._weights.append(0.)
+        # The new node covers the range (j - lowbit(j), j], all other
+        # weights in it are already in the tree.
+        j = i + 1
+        self._tree.append(self._prefix_sum(j - 1) -
+                          self._prefix_sum(j - (j & -j)))
+        return i
+
+    def _add(self, j, delta):
+        while j < len(self._tree):
+            self._tree[j] += delta
+            j += j & -j
+
+    def _prefix_sum(self, j):
+        total = 0.
+        while j > 0:
+            total += self._tree[j]
+            j -= j & -j
+        return total
@@ -1,9 +1,10 @@
 """ Basic views for REST api
 """
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 from operator import itemgetter
-from random import choice
+from os import environ
+import time
 import urllib.request
 import urllib.parse
 import urllib.error
@@ -11,6 +12,7 @@ import urllib.error
 from dateutil.parser import parse as parse_datetime
 from flask import jsonify, abort as flask_abort, make_response, request, g
 from flask.views import MethodView
+from werkzeug.exceptions import BadRequest
 
 from ..utils.validate import validate_project_name
 from ..utils.logs import get_logger
@@ -18,9 +20,12 @@ from ..utils.defs import JOB_STATES, TIME_PERIODS
 from ..utils import analyze_worker_output
 
 from ..core.users import auth
+from ..core.notifier import notifier
 from ..database.basedb import get_db as get_jobs_db
 from ..database.projects import get_db as get_projects_db
 from ..database.sqldb import SqlJobDatabase
+from ..database.fetch_strategies import fetch_strategies
+from ..database.schedulers import image_affinity, scheduler
 
 
 def abort(status_code, message=None):
@@ -34,6 +39,25 @@ def abort(status_code, message=None):
         return make_response(jsonify(error=message), status_code)
 
 
+MAX_LEASE_TIME = 7 * 24 * 3600
+
+
+def get_lease_time():
+    """
+    Return the "LeaseTime" (seconds) of the request data as a timedelta,
+    or None if it is missing.
+    """
+    lease_time = (request.json or {}).get('LeaseTime')
+    if lease_time is None:
+        return None
+    if not isinstance(lease_time, (int, float)) or isinstance(
+            lease_time, bool) or not 0 < lease_time <= MAX_LEASE_TIME:
+        raise BadRequest(description=(
+            '"LeaseTime" must be a number of seconds between 0 and {}'.format(
+                MAX_LEASE_TIME)))
+    return timedelta(seconds=lease_time)
+
+
 class BasicView(MethodView):
     """Base class for views"""
     def __init__(self):
@@ -146,22 +170,111 @@ class FetchJobBase:
     JOB_FIELDS = ['id', 'source_url', 'target_url']
     PROJECT_FIELDS = ['processing_image_url', 'environment']
 
+    # Max seconds a fetch request may wait for a job (url parameter 'wait')
+    MAX_WAIT = 60
+    # Max seconds to sleep before checking for jobs added by other processes
+    POLL_INTERVAL = 2
+
     def _get_unclaimed_job(self, version, project):
-        db_jobs = self._get_jobs_database(project)
-        try:
-            jobs = list(db_jobs.get_jobs(
-                match={'claimed': False},
-                fields=self.JOB_FIELDS,
-                limit=500))
-            job = choice(jobs)
-        except (StopIteration, IndexError):
+        job = self._find_unclaimed_job(project)
+        if not job:
             return abort(404, 'No unclaimed jobs available')
+        return self._make_job_response(version, project, job)
+
+    def _find_unclaimed_job(self, project, job_types=None):
+        """Return an unclaimed job, of one of the job types if given, or
+        None.
+        """
+        return fetch_strategies.select(
+            project, self._get_jobs_database(project),
+            self._get_projects_database(), self.JOB_FIELDS,
+            worker=self._get_worker(), job_types=job_types)
+
+    @staticmethod
+    def _get_worker():
+        """Return the worker from url parameter 'worker' or the user name"""
+        return request.args.get('worker') or g.user.username
+
+    @staticmethod
+    def _get_cached_images():
+        """Return the processing images that the worker has cached, from
+        url parameter 'image' or header 'X-Cached-Images', or None.
+
+        Both can be repeated and/or be comma separated lists.
+        """
+        values = (request.args.getlist('image') +
+                  request.headers.getlist('X-Cached-Images'))
+        images = {
+            image.strip() for value in values
+            for image in value.split(',') if image.strip()}
+        return images or None
+
+    @staticmethod
+    def _get_job_types():
+        """Return the job types from url parameter 'type' or None.
+
+        The parameter can be repeated and/or be a comma separated list.
+        """
+        job_types = [
+            job_type.strip() for value in request.args.getlist('type')
+            for job_type in value.split(',') if job_type.strip()]
+        return job_types or None
+
+    def _get_wait_time(self):
+        """Return the number of seconds the request may wait for a job"""
+        wait = request.args.get('wait')
+        if not wait:
+            return 0
+        try:
+            wait = float(wait)
+        except ValueError:
+            wait = None
+        if wait is None or not wait >= 0:
+            raise BadRequest(
+                description='Bad wait time: %r' % request.args['wait'])
+        return min(wait, self.MAX_WAIT)
+
+    def _wait_for_job(self, find_job, wait, project=None):
+        """Call find_job until it returns a job or until wait seconds have
+        passed.
+
+        Between attempts the request sleeps until jobs are added or
+        released in this process (in the project, or in any project if
+        project is None). To see jobs added by other processes it also
+        wakes up every POLL_INTERVAL seconds, but only calls find_job again
+        if the job counters of the projects have changed.
+        """
+        if not wait:
+            return find_job()
+        deadline = time.monotonic() + wait
         db_projects = self._get_projects_database()
-        project_data = db_projects.get_project(
-            project, fields=self.PROJECT_FIELDS)
-        job = self._make_worker_job(project, job, project_data)
+        jobs_version = None
+        while True:
+            version = notifier.get_version(project)
+            new_jobs_version = db_projects.get_jobs_version(project)
+            if new_jobs_version != jobs_version:
+                job = find_job()
+                if job:
+                    return job
+                jobs_version = new_jobs_version
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            notifier.wait(
+                version, project, timeout=min(remaining, self.POLL_INTERVAL))
+
+    def _make_job_response(self, version, project, job_data,
+                           project_data=None):
+        """Return the response that hands a job over to a worker"""
+        if project_data is None:
+            project_data = self._get_worker_project_data(project)
+        job = self._make_worker_job(project, job_data, project_data)
         return jsonify(Version=version, Project=project, Job=job)
 
+    def _get_worker_project_data(self, project):
+        db_projects = self._get_projects_database()
+        return db_projects.get_project(project, fields=self.PROJECT_FIELDS)
+
     def _make_worker_job(self, project, job_data, project_data):
         """Create dict that contains the data needed by the worker:
 
@@ -219,6 +332,9 @@ def make_pretty_project(project, prio=None):
     project['NrJobsFailed'] = project.pop('nr_failed')
     project['TotalProcessingTime'] = project.pop('processing_time')
     project['Deadline'] = fix_timestamp(project.pop('deadline'))
+    project['FetchStrategy'] = project.pop('fetch_strategy')
+    project['Weight'] = project.pop('weight')
+    project['Paused'] = project.pop('paused')
     return project
 
 
@@ -240,6 +356,9 @@ class ListProjects(BasicView):
 class FetchJobPrio(BasicView, FetchJobBase):
     """Fetch a job from a project chosen based on prio score"""
 
+    # Max nr of projects to try per attempt to find a job
+    MAX_ATTEMPTS = int(environ.get('USERVICE_PRIO_FETCH_ATTEMPTS', 5))
+
     @auth.login_required
     def get(self, version):
         """GET"""
@@ -247,11 +366,53 @@ class FetchJobPrio(BasicView, FetchJobBase):
         return self._get_view(version)
 
     def _get_view(self, version):
+        """
+        Use url parameter 'type' to only fetch jobs of certain types and
+        'wait' to wait at most this many seconds for a job. Parameter
+        'worker' is the name of the worker, default is the user name, see
+        database.fetch_strategies. The project is picked by the scheduler
+        of the deployment, see database.schedulers, from the prio cache.
+        Use 'fresh=1' to refresh the cache, or with the prio scheduler to
+        compute the prio scores in the database. If the picked project has
+        no claimable job, the next pick is tried, at most MAX_ATTEMPTS
+        projects per try.
+
+        Workers report the processing images they have cached with url
+        parameter 'image' or header 'X-Cached-Images', projects with these
+        images are preferred, see schedulers.ImageAffinity.
+        """
+        wait = self._get_wait_time()
+        job_types = self._get_job_types()
+        fresh = bool(request.args.get('fresh'))
+        worker = self._get_worker()
+        images = self._get_cached_images()
         db = self._get_projects_database()
-        project = db.get_prio_project()
-        if not project:
+
+        def find_job():
+            tried = set()
+            for _ in range(self.MAX_ATTEMPTS):
+                project = scheduler.pick_project(
+                    db, job_types, fresh=fresh, exclude=tried,
+                    worker=worker, images=images)
+                if not project:
+                    return
+                job = self._find_unclaimed_job(project, job_types)
+                if job:
+                    return project, job
+                # The cache is behind or the counters have drifted, do not
+                # pick the project again until its counters change.
+                tried.add(project)
+                scheduler.project_drained(project, job_types)
+
+        found = self._wait_for_job(find_job, wait)
+        if not found:
             return abort(404, 'No unclaimed jobs available')
-        return self._get_unclaimed_job(version, project)
+        project, job = found
+        project_data = self._get_worker_project_data(project)
+        if images:
+            image_affinity.record_fetch(
+                worker, images, project_data['processing_image_url'])
+        return self._make_job_response(version, project, job, project_data)
 
 
 def make_job_url(endpoint, project, job_id):
@@ -282,6 +443,7 @@ def make_pretty_job(job, project):
     job['Finished'] = fix_timestamp(job.pop('finished_timestamp'))
     job['ProcessingTime'] = job.pop('processing_time')
     job['Worker'] = job.pop('worker')
+    job['Priority'] = job.pop('priority')
     return job
 
 
@@ -431,7 +593,6 @@ class FetchNextJob(BasicProjectView, FetchJobBase):
         self._check_project(project)
         return self._get_view(version, project)
 
-    # TODO: Use url parameter 'type'
     def _get_view(self, version, project):
         """
         Should return JSON object with URI for getting/delivering data etc.
@@ -444,5 +605,96 @@ class FetchNextJob(BasicProjectView, FetchJobBase):
         * Because it gives a neater interface, and because the claiming
           URI can be put in the object and included in the listing.
         * Easier to debug/get status if fetching can be done w/o auth.
+
+        Use url parameter 'type' to only fetch jobs of certain types, see
+        _get_job_types, and 'wait' to wait at most this many seconds for a
+        job to become available. Parameter 'worker' is the name of the
+        worker, default is the user name, see database.fetch_strategies.
         """
-        return self._get_unclaimed_job(version, project)
+        wait = self._get_wait_time()
+        job_types = self._get_job_types()
+        job = self._wait_for_job(
+            lambda: self._find_unclaimed_job(project, job_types), wait,
+            project)
+        if not job:
+            return abort(404, 'No unclaimed jobs available')
+        return self._make_job_response(version, project, job)
+
+
+class ClaimNextJob(BasicProjectView, FetchJobBase):
+    """View for selecting and claiming the next job in the queue in one
+    request.
+    """
+
+    CLAIM_FIELDS = FetchJobBase.JOB_FIELDS + ['type']
+
+    def _put_view(self, version, project):
+        """
+        Claim an unclaimed job for the worker and return the same job data
+        as the fetch views. Return 404 if there are no unclaimed jobs.
+        """
+        worker, now, lease_time = self._parse_claim_request()
+        db = self._get_jobs_database(project)
+        # The claim and the claimed counter of the project are updated in
+        # one transaction.
+        job = db.claim_next_job(
+            worker, job_types=self._get_job_types(), now=now,
+            fields=self.CLAIM_FIELDS, lease_time=lease_time,
+            projects_db=self._get_projects_database())
+        if not job:
+            return abort(404, 'No unclaimed jobs available')
+        self.log.info(
+            "Job {0} in project {1} claimed by {2} to worker {3}".format(
+                job['id'], project, g.user.username, worker))
+        return self._make_job_response(version, project, job)
+
+    def _parse_claim_request(self):
+        """Return worker, claim time and lease time from the request"""
+        if not request.json or 'Worker' not in request.json:
+            raise BadRequest(
+                description='Missing "Worker" field in request data')
+        now = request.args.get('now')
+        if now:
+            try:
+                now = parse_datetime(now)
+            except ValueError:
+                raise BadRequest(description='Bad time format: %r' % now)
+        else:
+            now = datetime.utcnow()
+        return request.json['Worker'], now, get_lease_time()
+
+
+class ClaimJobs(ClaimNextJob):
+    """View for claiming a batch of jobs in one request, so that workers
+    with short jobs can spread the scheduling overhead over many jobs.
+    """
+
+    MAX_JOBS = 100
+
+    def _put_view(self, version, project):
+        """
+        Claim up to "Count" unclaimed jobs for the worker. Return a list
+        with the same job data as the fetch views, or 404 if there are no
+        unclaimed jobs.
+        """
+        worker, now, lease_time = self._parse_claim_request()
+        count = request.json.get('Count', 1)
+        if not isinstance(count, int) or isinstance(count, bool) or (
+                not 0 < count <= self.MAX_JOBS):
+            return abort(
+                400, '"Count" must be an integer between 1 and {}'.format(
+                    self.MAX_JOBS))
+        db = self._get_jobs_database(project)
+        jobs = db.claim_jobs(
+            worker, count, job_types=self._get_job_types(), now=now,
+            fields=self.CLAIM_FIELDS, lease_time=lease_time,
+            projects_db=self._get_projects_database())
+        if not jobs:
+            return abort(404, 'No unclaimed jobs available')
+        self.log.info(
+            "{0} jobs in project {1} claimed by {2} to worker {3}".format(
+                len(jobs), project, g.user.username, worker))
+        project_data = self._get_worker_project_data(project)
+        jobs = [self._make_worker_job(project, job, project_data)
+                for job in jobs]
+        return jsonify(Version=version, Project=project, Jobs=jobs)
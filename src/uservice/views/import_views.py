@@ -0,0 +1,128 @@
+""" Views for adding jobs in the background
+"""
+import json
+import uuid
+from os import environ
+
+from dateutil.parser import parse as parse_datetime
+from flask import jsonify, request, g, url_for
+from werkzeug.exceptions import BadRequest
+
+from .basic_views import abort, BasicProjectView, fix_timestamp
+from ..core.importer import importer
+from ..database.imports import get_db as get_imports_db
+
+
+class ListImports(BasicProjectView):
+    """View for listing and adding imports of jobs"""
+
+    # Nr of jobs per stored chunk, the importer inserts one chunk per
+    # transaction
+    CHUNK = int(environ.get('USERVICE_IMPORT_CHUNK', 1000))
+
+    def _get_view(self, version, project):
+        """Return the imports of the project"""
+        imports = [
+            make_pretty_import(import_data, version)
+            for import_data in get_imports_db().get_imports(project)]
+        return jsonify(Version=version, Project=project, Imports=imports)
+
+    def _post_view(self, version, project):
+        """Queue jobs, a JSON list or NDJSON, for import in the
+        background.
+        """
+        now = request.args.get('now')
+        if now:
+            try:
+                now = parse_datetime(now)
+            except ValueError:
+                return abort(400, 'Bad time format: %r' % now)
+        if request.mimetype == 'application/x-ndjson':
+            lines = read_ndjson_lines(request.stream)
+        elif isinstance(request.json, list):
+            lines = (json.dumps(job) for job in request.json)
+        else:
+            return abort(400, "Invalid input")
+
+        projects_db = self._get_projects_database()
+        if not projects_db.project_exists(project):
+            projects_db.insert_project(project, g.user.username)
+        import_id = uuid.uuid4().hex
+        nr_jobs = get_imports_db().insert_import(
+            import_id, project, g.user.username,
+            make_chunks(lines, self.CHUNK), added_timestamp=now)
+        importer.wake()
+        uri = url_for('importstatus', version=version, project=project,
+                      import_id=import_id, _external=True)
+        return (
+            jsonify(Version=version, Project=project, ID=import_id,
+                    Jobs=nr_jobs, URI=uri),
+            202, {'Location': uri})
+
+
+class ImportStatus(BasicProjectView):
+    """Get the progress of an import"""
+
+    def get(self, version, project, import_id):
+        """GET"""
+        self._check_version(version)
+        self._check_project(project)
+        import_data = get_imports_db().get_import(import_id)
+        if not import_data or import_data['project_id'] != project:
+            return abort(404)
+        return jsonify(make_pretty_import(import_data, version))
+
+
+def read_ndjson_lines(stream):
+    """Yield the non-blank lines of an NDJSON stream as strings"""
+    for line in stream:
+        try:
+            line = line.decode('utf-8').strip()
+        except UnicodeDecodeError:
+            raise BadRequest(description='Invalid UTF-8 in request body')
+        if line:
+            yield line
+
+
+def make_chunks(lines, size):
+    """Yield lists of at most size lines"""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def make_pretty_import(import_data, version):
+    """Transform import to json serializable dict with good looking keys"""
+    end = import_data['finished_timestamp'] or import_data['heartbeat']
+    duration = None
+    if import_data['started_timestamp'] and end:
+        duration = (end - import_data['started_timestamp']).total_seconds()
+    return {
+        'ID': import_data['id'],
+        'URI': url_for(
+            'importstatus', version=version,
+            project=import_data['project_id'], import_id=import_data['id'],
+            _external=True),
+        'Project': import_data['project_id'],
+        'CreatedBy': import_data['created_by_user'],
+        'Created': fix_timestamp(import_data['created_timestamp']),
+        'Started': fix_timestamp(import_data['started_timestamp']),
+        'Finished': fix_timestamp(import_data['finished_timestamp']),
+        'Status': import_data['status'],
+        'Jobs': import_data['nr_jobs'],
+        'Processed': import_data['nr_processed'],
+        'Added': import_data['nr_added'],
+        'Conflicts': import_data['nr_conflicts'],
+        'Invalid': import_data['nr_invalid'],
+        'Progress': (
+            import_data['nr_processed'] / import_data['nr_jobs']
+            if import_data['nr_jobs'] else None),
+        'JobsPerSecond': (
+            import_data['nr_processed'] / duration if duration else None),
+        'Errors': import_data['errors'],
+    }
@@ -5,11 +5,13 @@ from dateutil.parser import parse as parse_datetime
 
 from flask import jsonify, request, g
 
-from ..utils.defs import JOB_STATES
-
-from .basic_views import abort, BasicProjectView
+from .basic_views import abort, BasicProjectView, get_lease_time
 from ..core.users import auth
-from ..database.basedb import STATE_TO_TIMESTAMP
+from ..core.notifier import notifier
+from ..database.basedb import DBError, DBConflictError
+from ..database.fetch_strategies import fetch_strategies
+from ..database.ready_buffer import ready_buffer
+from ..utils.defs import JOB_STATES
 
 
 class BasicJobView(BasicProjectView):
@@ -58,27 +60,21 @@ class JobStatus(BasicJobView):
         if not request.json or 'Status' not in request.json:
             return abort(400, 'Missing "Status" field in request data')
         status = request.json['Status']
-        data = {'current_status': status,
-                'processing_time': request.json.get('ProcessingTime') or 0}
-        if status in STATE_TO_TIMESTAMP:
-            now = request.args.get('now')
-            if now:
-                now = parse_datetime(now)
-            else:
-                now = datetime.utcnow()
-            data[STATE_TO_TIMESTAMP[status]] = now
-
-        if status == JOB_STATES.finished:
-            self._get_projects_database().job_finished(
-                project, data['processing_time'])
-        elif status == JOB_STATES.failed:
-            self._get_projects_database().job_failed(
-                project, data['processing_time'])
-
+        now = request.args.get('now')
+        if now:
+            now = parse_datetime(now)
+        else:
+            now = datetime.utcnow()
         db = self._get_jobs_database(project)
-        if not db.job_exists(job_id):
+        try:
+            db.update_status(
+                job_id, status, request.json.get('ProcessingTime') or 0, now,
+                projects_db=self._get_projects_database(),
+                worker=request.json.get('Worker'))
+        except DBConflictError as error:
+            return abort(409, str(error))
+        except DBError:
             return abort(404)
-        db.update_job(job_id, **data)
         self.log.info("Status of job {} was updated by {}.".format(
             job_id, g.user.username
         ))
@@ -116,7 +112,7 @@ class JobClaim(BasicJobView):
         """Used to see which Worker has claimed job and at what time"""
         db = self._get_jobs_database(project)
         job = db.get_job(job_id, fields=[
-            'claimed', 'worker', 'claimed_timestamp'])
+            'claimed', 'worker', 'claimed_timestamp', 'lease_expires'])
         if not job:
             return abort(404)
         return jsonify(
@@ -125,6 +121,10 @@ class JobClaim(BasicJobView):
             ClaimedAtTime=(
                 job['claimed_timestamp'].isoformat()
                 if job['claimed_timestamp'] else None
+            ),
+            LeaseExpires=(
+                job['lease_expires'].isoformat()
+                if job['lease_expires'] else None
             )
         )
 
@@ -137,22 +137,28 @@ class JobClaim(BasicJobView):
         #       allowed to claim jobs.
         if not request.json or 'Worker' not in request.json:
             return abort(400, 'Missing "Worker" field in request data')
-        db = self._get_jobs_database(project)
-        if not db.job_exists(job_id):
-            return abort(404)
-        if not db.claim_job(job_id):
-            return abort(409, 'The job is already claimed')
-
+        lease_time = get_lease_time()
         now = request.args.get('now')
         if now:
             now = parse_datetime(now)
         else:
             now = datetime.utcnow()
         worker = request.json['Worker']
-        db.update_job(job_id, current_status=JOB_STATES.claimed,
-                      claimed_timestamp=now, worker=worker)
+        db = self._get_jobs_database(project)
         projects_db = self._get_projects_database()
-        projects_db.job_claimed(project)
+        # The claim and the claimed counter of the project are updated in
+        # one transaction.
+        with db.db.transaction():
+            job = db.claim_job(
+                job_id, worker, now, lease_time, fields=['type'])
+            if job:
+                projects_db.job_claimed(project, job_types={job['type']: 1})
+        if not job and not db.job_exists(job_id):
+            return abort(404)
+        ready_buffer.report_claim(project, job_id, bool(job))
+        fetch_strategies.report_claim(project, job_id, bool(job))
+        if not job:
+            return abort(409, 'The job is already claimed')
         self.log.info(
             "Job {0} in project {1} claimed by {2} to worker {3}".format(
                 job_id, project, g.user.username, worker))
@@ -166,12 +172,41 @@ class JobClaim(BasicJobView):
         job = db.get_job(job_id)
         if not job:
             return abort(404)
-        if job['claimed']:
-            db.unclaim_job(job_id)
+        # Waiting jobs are released when the jobs they depend on finish
+        if job['claimed'] and job['current_status'] != JOB_STATES.waiting:
+            projects_db = self._get_projects_database()
+            with db.db.transaction():
+                db.unclaim_job(job_id)
+                projects_db.job_unclaimed(
+                    project, job['current_status'], job['type'],
+                    job['processing_time'])
             self.log.info("Job {0} in project {1} was unlocked by {2}.".format(
                 job_id, project, g.user.username))
-            projects_db = self._get_projects_database()
-            projects_db.job_unclaimed(project, bool(job['failed_timestamp']))
+            notifier.notify(project)
 
         return jsonify(Version=version, Project=project, ID=job_id,
                        Call="DELETE")
+
+
+class JobHeartbeat(BasicJobView):
+    """Extend the lease of a claimed job"""
+    def _put_view(self, version, project, job_id):
+        """
+        Used by the worker that claimed the job to show that it is still
+        alive. Return 409 CONFLICT if the job is not claimed by the worker,
+        e.g. because the lease expired and the job was requeued.
+        """
+        if not request.json or 'Worker' not in request.json:
+            return abort(400, 'Missing "Worker" field in request data')
+        lease_time = get_lease_time()
+        db = self._get_jobs_database(project)
+        if not (lease_time or db.DEFAULT_LEASE_TIME):
+            return abort(400, 'Missing "LeaseTime" field in request data')
+        lease_expires = db.extend_lease(
+            job_id, request.json['Worker'], lease_time=lease_time)
+        if not lease_expires:
+            if not db.job_exists(job_id):
+                return abort(404)
+            return abort(409, 'The job is not claimed by this worker')
+        return jsonify(Version=version, Project=project, ID=job_id,
+                       Call="PUT", LeaseExpires=lease_expires.isoformat())
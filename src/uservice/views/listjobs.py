@@ -1,10 +1,16 @@
+import json
+from collections import Counter
+from os import environ
+
 from dateutil.parser import parse as parse_datetime
 from flask import jsonify, abort as flask_abort, make_response, request, g
 from werkzeug.exceptions import BadRequest, Conflict
 
 from .basic_views import (
     BasicProjectView, abort, fix_timestamp, make_pretty_job)
+from ..core.notifier import notifier
 from ..database.basedb import DBError, DBConflictError
+from ..database.ready_buffer import ready_buffer
 from ..database.sqldb import SqlJobDatabase
 from ..utils.defs import JOB_STATES
 
@@ -12,6 +18,11 @@ from ..utils.defs import JOB_STATES
 class ListJobs(BasicProjectView):
     """View for listing and adding jobs as JSON object"""
 
+    # Nr of jobs per transaction when the jobs are posted as NDJSON
+    NDJSON_CHUNK = int(environ.get('USERVICE_NDJSON_CHUNK', 1000))
+    # Max nr of error messages to report per rejected chunk
+    MAX_CHUNK_ERRORS = 10
+
     def _get_view(self, version, project):
         """
         Return a JSON object with a list of jobs with URIs for
@@ -75,6 +86,8 @@ class ListJobs(BasicProjectView):
         """
         Used to add jobs to the database.
         """
+        if request.mimetype == 'application/x-ndjson':
+            return self.add_streamed_jobs(version, project)
         if isinstance(request.json, dict):
             self.add_one_job(project, request.json)
         elif isinstance(request.json, list):
@@ -95,12 +108,24 @@ class ListJobs(BasicProjectView):
         added_rows = self.check_for_conflicts_and_insert_one_new_job(
             job_db, job)
 
-        projects_db = self._get_projects_database()
         if added_rows != 0:
-            did_work = projects_db.job_added(project, added=added_rows)
-            if not did_work:
-                projects_db.insert_project(project, g.user.username)
-                projects_db.job_added(project, added=added_rows)
+            self.report_added_jobs(project, [job])
+
+    def report_added_jobs(self, project, jobs):
+        """Update the project counters with the added jobs"""
+        job_types, waiting = count_added_jobs(jobs)
+        projects_db = self._get_projects_database()
+        did_work = projects_db.job_added(
+            project, added=len(jobs), job_types=job_types, waiting=waiting)
+        if not did_work:
+            projects_db.insert_project(project, g.user.username)
+            projects_db.job_added(
+                project, added=len(jobs), job_types=job_types,
+                waiting=waiting)
+        if any(job.get('priority') for job in jobs):
+            # The buffer may only hold jobs with a lower priority
+            ready_buffer.flush(project)
+        notifier.notify(project)
 
     def add_multiple_jobs(self, project, jobs):
 
@@ -110,31 +135,90 @@ class ListJobs(BasicProjectView):
             raise BadRequest(description=str(error))
 
         job_db = self._get_jobs_database(project)
-        added_rows = self.check_for_conflicts_and_insert_new_jobs(job_db, jobs)
+        added = self.check_for_conflicts_and_insert_new_jobs(job_db, jobs)
 
-        projects_db = self._get_projects_database()
-        if added_rows != 0:
-            did_work = projects_db.job_added(project, added=added_rows)
-            if not did_work:
-                projects_db.insert_project(project, g.user.username)
-                projects_db.job_added(project, added=added_rows)
+        if added:
+            self.report_added_jobs(project, added)
 
-    def check_for_conflicts_and_insert_new_jobs(self, job_db, jobs):
-        job_db.db.session.begin()
-        errors = []
-        added = 0
-        for job_number, job in enumerate(jobs):
-            try:
-                added_row = self.check_for_conflicts_and_insert_one_new_job(
-                    job_db, job)
-                added = added + added_row
-            except Conflict as error:
-                errors.append(
-                    "Job#{}: {}".format(job_number, error.description))
+    def add_streamed_jobs(self, version, project):
+        """Add jobs posted as NDJSON, one JSON job per line.
+
+        The body is read and inserted in chunks of NDJSON_CHUNK jobs, with
+        a commit per chunk. A chunk with invalid or conflicting jobs is
+        rejected as a whole, the other chunks are still added. Blank lines
+        are skipped and not counted in the job numbers.
+        """
+        job_db = self._get_jobs_database(project)
+        now = request.args.get('now')
+        if now:
+            now = parse_datetime(now)
+        chunks = []
+        lines = []
+        for line in request.stream:
+            if not line.strip():
+                continue
+            lines.append(line)
+            if len(lines) == self.NDJSON_CHUNK:
+                chunks.append(self.add_chunk_of_jobs(
+                    project, job_db, lines, self.NDJSON_CHUNK * len(chunks),
+                    now))
+                lines = []
+        if lines:
+            chunks.append(self.add_chunk_of_jobs(
+                project, job_db, lines, self.NDJSON_CHUNK * len(chunks), now))
+
+        if any(chunk['Invalid'] for chunk in chunks):
+            status = 400
+        elif any(chunk['Conflicts'] for chunk in chunks):
+            status = 409
+        else:
+            status = 201
+        return jsonify(
+            Version=version, Project=project, Chunks=chunks,
+            Added=sum(chunk['Added'] for chunk in chunks)), status
+
+    def add_chunk_of_jobs(self, project, job_db, lines, start, now=None):
+        """Validate and insert the jobs in a transaction, return a report
+        with the nr of added, invalid and conflicting jobs.
+        """
+        report = {'FirstJob': start, 'Jobs': len(lines), 'Added': 0,
+                  'Invalid': 0, 'Conflicts': 0}
+        jobs, errors = parse_json_jobs(lines, start)
+        if now:
+            for job in jobs:
+                job['added_timestamp'] = now
         if errors:
-            raise Conflict(description="\n".join(errors))
+            report['Invalid'] = len(errors)
         else:
-            job_db.db.session.commit()
+            try:
+                with job_db.db.transaction():
+                    added = job_db.insert_jobs_if_not_duplicate(jobs, start)
+            except DBConflictError as error:
+                errors = str(error).split('\n')
+                report['Conflicts'] = len(errors)
+            else:
+                report['Added'] = len(added)
+                if added:
+                    self.report_added_jobs(project, added)
+        report['Errors'] = errors[:self.MAX_CHUNK_ERRORS]
+        return report
+
+    def check_for_conflicts_and_insert_new_jobs(self, job_db, jobs):
+        """Insert the new jobs, return the added jobs.
+
+        Nothing is inserted if any of the jobs conflicts with an existing
+        job.
+        """
+        now = request.args.get('now')
+        if now:
+            now = parse_datetime(now)
+            for job in jobs:
+                job['added_timestamp'] = now
+        try:
+            with job_db.db.transaction():
+                added = job_db.insert_jobs_if_not_duplicate(jobs)
+        except DBConflictError as error:
+            raise Conflict(description=str(error))
         return added
 
     def check_for_conflicts_and_insert_one_new_job(self, job_db, job):
@@ -148,6 +232,39 @@ class ListJobs(BasicProjectView):
         return rows
 
 
+class JobPriorities(BasicProjectView):
+    """View for setting the priority of many jobs in one request"""
+
+    MAX_JOBS = 100000
+
+    def _put_view(self, version, project):
+        """
+        Set the priority of the jobs in "JobIDs" to "Priority". Fetches
+        and claims take the unclaimed jobs with the highest priority first.
+        Return the nr of updated jobs, unknown job ids are ignored.
+        """
+        data = request.json
+        if not isinstance(data, dict):
+            return abort(400, "Invalid input")
+        priority = data.get('Priority')
+        if not is_priority(priority):
+            return abort(400, '"Priority" must be an integer')
+        job_ids = data.get('JobIDs')
+        if not (isinstance(job_ids, list) and
+                all(isinstance(job_id, str) for job_id in job_ids)):
+            return abort(400, '"JobIDs" must be a list of job ids')
+        if len(job_ids) > self.MAX_JOBS:
+            return abort(
+                400, 'At most {} job ids per request'.format(self.MAX_JOBS))
+        job_db = self._get_jobs_database(project)
+        updated = job_db.set_priority(sorted(set(job_ids)), priority)
+        if updated:
+            ready_buffer.flush(project)
+            notifier.notify(project)
+        return jsonify(Version=version, Project=project, Priority=priority,
+                       Updated=updated)
+
+
 class ValidationError(Exception):
     pass
 
@@ -163,6 +280,47 @@ def validate_json_job_list(jobs):
         raise ValidationError('\n'.join(errors))
 
 
+def count_added_jobs(jobs):
+    """Return the nr of added jobs per job type, and of the added jobs
+    that wait for the jobs they depend on.
+    """
+    return (Counter(job.get('type') for job in jobs),
+            Counter(job.get('type') for job in jobs
+                    if job.get('pending_parents')))
+
+
+def is_priority(value):
+    """Return True if value is a valid job priority"""
+    return isinstance(value, int) and not isinstance(value, bool) and (
+        -2**31 <= value < 2**31)
+
+
+def parse_json_jobs(lines, start=0):
+    """Return the valid jobs of lines of NDJSON and the errors of the
+    invalid ones, the jobs are numbered from start.
+    """
+    jobs = []
+    errors = []
+    for job_number, line in enumerate(lines, start):
+        try:
+            jobs.append(parse_json_job(line))
+        except ValidationError as error:
+            errors.append("Job#{}: {}".format(job_number, error))
+    return jobs, errors
+
+
+def parse_json_job(line):
+    """Return the job of one line of NDJSON"""
+    try:
+        job = json.loads(line)
+    except ValueError:
+        raise ValidationError('Invalid JSON')
+    if not isinstance(job, dict):
+        raise ValidationError('Expected a JSON object')
+    validate_json_job(job)
+    return job
+
+
 def validate_json_job(job):
     fields = set(job.keys())
     missing_required = SqlJobDatabase.REQUIRED_FIELDS - fields
@@ -176,3 +334,13 @@ def validate_json_job(job):
             .format(', '.join(unallowed)))
     if not isinstance(job['id'], str):
         raise ValidationError("Expected string in field 'id'")
+    depends_on = job.get('depends_on')
+    if depends_on is not None and not (
+            isinstance(depends_on, list) and
+            all(isinstance(parent, str) for parent in depends_on)):
+        raise ValidationError(
+            "Expected list of job ids in field 'depends_on'")
+    if depends_on and job['id'] in depends_on:
+        raise ValidationError('A job cannot depend on itself')
+    if 'priority' in job and not is_priority(job['priority']):
+        raise ValidationError("Expected integer in field 'priority'")
@@ -6,6 +6,10 @@ from flask import request, jsonify, g
 
 from ..utils.defs import JOB_STATES, TIME_PERIODS, TIME_PERIOD_TO_DELTA
 from .basic_views import BasicProjectView, abort, make_pretty_project
+from ..core.notifier import notifier
+from ..database.fetch_strategies import fetch_strategies
+from ..database.imports import get_db as get_imports_db
+from ..database.ready_buffer import ready_buffer
 
 
 class ProjectStatus(BasicProjectView):
@@ -84,16 +88,39 @@ class ProjectStatus(BasicProjectView):
             return abort(
                 400, ('These fields does not exist or are for internal use: {}'
                       ''.format(list(unallowed))))
+        weight = data.get('weight')
+        if 'weight' in data and (
+                isinstance(weight, bool) or
+                not isinstance(weight, (int, float)) or not weight > 0):
+            return abort(400, 'Bad weight: {!r}, use a positive number'
+                         ''.format(weight))
+        if 'paused' in data and not isinstance(data['paused'], bool):
+            return abort(400, 'Bad paused: {!r}, use true or false'
+                         ''.format(data['paused']))
+        strategy = data.get('fetch_strategy')
+        if strategy is not None and (
+                strategy not in fetch_strategies.strategies):
+            return abort(400, 'Unknown fetch strategy: {!r}, use one of {}'
+                         ''.format(strategy,
+                                   sorted(fetch_strategies.strategies)))
         if not db.project_exists(project):
             db.insert_project(project, g.user.username, **data)
             self._get_jobs_database(project)
             return jsonify(Version=version, ID=project), 201
         db.update_project(project, **data)
+        if 'fetch_strategy' in data:
+            fetch_strategies.strategy_changed(project)
+        if data.get('paused') is False:
+            # Resumed, wake up waiting prio fetches
+            notifier.notify(project)
         return jsonify(Version=version, ID=project), 204
 
     def _delete_view(self, version, project):
         """Used to delete project"""
         db = self._get_projects_database()
         db.remove_project(project)
+        get_imports_db().remove_imports(project)
         self._get_jobs_database(project).drop()
+        ready_buffer.clear(project)
+        fetch_strategies.clear(project)
         return jsonify(Version=version, Project=project)